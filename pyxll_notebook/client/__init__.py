@@ -8,17 +8,28 @@ in the [NOTEBOOK] section of the config.
 from pyxll import get_event_loop, xl_on_open, xl_on_reload, xl_on_close, xl_menu, get_config, xlcAlert
 from .kernel import Kernel
 from .handler import Handler
-from ..errors import KernelStartError, ExecuteRequestError
+from ..errors import KernelStartError, ExecuteRequestError, ExecuteTimeoutError, KernelConnectionError
 from .kernel_manager import KernelManager
+from .kernel_pool import KernelPool
+from .benchmark import benchmark_calls
+from .metrics import Metrics
+from .xl_func import register_known_functions
+import logging
+import pyxll
 import asyncio
 
+_log = logging.getLogger(__name__)
+
 
 __all__ = [
     "Kernel",
     "Handler",
     "KernelStartError",
     "ExecuteRequestError",
-    "KernelManager"
+    "ExecuteTimeoutError",
+    "KernelConnectionError",
+    "KernelManager",
+    "KernelPool"
 ]
 
 
@@ -26,14 +37,33 @@ __all__ = [
 @xl_on_reload
 def on_open(import_info):
     """Start the remote kernel when Excel starts up, or PyXLL is reloaded.
+
+    The kernels are started in the background unless wait_on_open is set.
+    Functions already known from before PyXLL was reloaded, or saved in the
+    function manifest by notebooks that haven't changed since, are registered
+    before the kernels start and return a placeholder value until their
+    kernel is ready.
     """
+    # Functions bound before PyXLL was reloaded need registering again
+    register_known_functions()
+
     cfg = get_config()
     start_on_open = bool(int(cfg.get("NOTEBOOK", "start_on_open", fallback=0)))
+    wait_on_open = bool(int(cfg.get("NOTEBOOK", "wait_on_open", fallback=0)))
     if start_on_open:
         km = KernelManager.instance()
         loop = get_event_loop()
+        asyncio.run_coroutine_threadsafe(km.register_manifest_functions(), loop).result()
         f = asyncio.run_coroutine_threadsafe(km.start_all_kernels(), loop)
-        f.result()
+        if wait_on_open:
+            f.result()
+        else:
+            f.add_done_callback(_log_start_error)
+
+
+def _log_start_error(f):
+    if not f.cancelled() and f.exception() is not None:
+        _log.error("Error starting Jupyter kernels", exc_info=f.exception())
 
 
 @xl_on_close
@@ -42,10 +72,13 @@ def on_close():
 
     Note: This is called when the user 'closes' Excel, but before the confirm
     prompt is shown so if they cancel then the kernel will no longer be running.
+
+    If persistent_sessions is set the kernels are left running so they can be
+    re-attached to when Excel next starts.
     """
     km = KernelManager.instance()
     loop = get_event_loop()
-    f = asyncio.run_coroutine_threadsafe(km.stop_all_kernels(), loop)
+    f = asyncio.run_coroutine_threadsafe(km.close_all_kernels(), loop)
     f.result()
 
 
@@ -67,3 +100,48 @@ def stop_kernels():
     f = asyncio.run_coroutine_threadsafe(km.stop_all_kernels(), loop)
     f.result()
     xlcAlert("Jupyter kernel stopped")
+
+
+@xl_menu("Benchmark remote calls", menu="Jupyter Notebooks")
+def benchmark_remote_calls():
+    """Compares the overhead of calling remote functions using the RPC comm and execute requests"""
+    cfg = get_config()
+    notebooks = [x for x in map(str.strip, cfg.get("NOTEBOOK", "notebooks", fallback="").split(";")) if x]
+    if not notebooks:
+        raise AssertionError("No notebooks configured")
+
+    async def run():
+        km = KernelManager.instance()
+        kernel = await km.get_kernel(notebooks[0])
+        return await benchmark_calls(kernel.select_kernel())
+
+    loop = get_event_loop()
+    f = asyncio.run_coroutine_threadsafe(run(), loop)
+    xlcAlert(f.result())
+
+
+@pyxll.xl_func("bool reset: var[][]", volatile=True)
+def pyxll_notebook_metrics(reset=False):
+    """Returns latency and throughput metrics for calls to the remote kernels.
+
+    Timings are in seconds, and the percentiles are estimated from histograms.
+    If reset is TRUE the metrics are cleared after being returned.
+    """
+    metrics = Metrics.instance()
+    table = metrics.table()
+    if reset:
+        metrics.reset()
+    return table
+
+
+@pyxll.xl_func(": var[][]", volatile=True)
+def pyxll_notebook_server_cache_stats():
+    """Returns statistics about the result cache in each remote kernel."""
+    columns = ["entries", "bytes", "max_bytes", "hits", "misses", "evictions"]
+    km = KernelManager.instance()
+    loop = get_event_loop()
+    f = asyncio.run_coroutine_threadsafe(km.get_server_cache_stats(), loop)
+    rows = [["notebook", "kernel"] + columns]
+    for notebook, kernel_id, stats in f.result():
+        rows.append([notebook, kernel_id] + [stats.get(c) for c in columns])
+    return rows
@@ -0,0 +1,32 @@
+"""
+Benchmark for measuring the overhead of calling functions in the remote kernel.
+"""
+import statistics
+import time
+
+
+async def benchmark_calls(kernel, count=200):
+    """Time calls that do nothing using the RPC comm and using execute requests.
+
+    Returns a report of the per-call latency of each method as a string.
+    """
+    lines = []
+    for name, use_rpc_comm in (("RPC comm", True), ("Execute request", False)):
+        try:
+            await kernel.ping(use_rpc_comm)  # warm up
+            times = []
+            for i in range(count):
+                start_time = time.perf_counter()
+                await kernel.ping(use_rpc_comm)
+                times.append(time.perf_counter() - start_time)
+        except Exception as e:
+            lines.append(f"{name}: failed ({e})")
+            continue
+
+        times.sort()
+        p99 = times[min(int(len(times) * 0.99), len(times) - 1)]
+        lines.append(f"{name}: mean {statistics.mean(times) * 1000:.2f}ms, "
+                     f"median {statistics.median(times) * 1000:.2f}ms, "
+                     f"p99 {p99 * 1000:.2f}ms over {count} calls")
+
+    return "\n".join(lines)
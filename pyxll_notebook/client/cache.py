@@ -0,0 +1,50 @@
+"""
+Cache for the results of remote functions, so that calls to pure functions
+with the same arguments don't need to be sent to the kernel.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """Thread safe least recently used cache, with an optional time to live for each entry."""
+
+    missing = object()
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = max(maxsize, 1)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        """Return the cached value for key, or LRUCache.missing."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.__entries[key]
+            self.misses += 1
+            return self.missing
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.__lock:
+            self.__entries[key] = (value, expires)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
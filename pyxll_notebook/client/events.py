@@ -7,11 +7,19 @@ class MessageReplyEvent(asyncio.Event):
     def __init__(self):
         super().__init__()
         self.__reply = {}
+        self.__error = None
 
     def set(self, reply={}):
         self.__reply = reply
         super().set()
 
+    def set_error(self, error):
+        """Wake up any waiters and raise error instead of returning a reply."""
+        self.__error = error
+        super().set()
+
     async def wait(self):
         await super().wait()
+        if self.__error is not None:
+            raise self.__error
         return self.__reply
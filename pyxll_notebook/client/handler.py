@@ -1,8 +1,9 @@
 """
 Handler for websocket messages received by the client.
 """
-from .xl_func import bind_xl_func
-from .rtd import xl_rtd_set_value, xl_rtd_set_error
+from .xl_func import bind_xl_func, rebind
+from .rtd import xl_rtd_set_value, xl_rtd_set_error, xl_rtd_set_snapshot, xl_rtd_apply_delta
+from .metrics import Metrics, size_buckets
 from ..serialization import deserialize_args
 import weakref
 import logging
@@ -15,7 +16,8 @@ class Handler:
     """Handler for processing messages received by the client."""
 
     def __init__(self, kernel):
-        self.__kernel = weakref.proxy(kernel)
+        self.__kernel = weakref.ref(kernel)
+        self.__deferred = []
 
     @staticmethod
     async def on_error(msg):
@@ -38,12 +40,50 @@ class Handler:
         if not content:
             raise AssertionError("xl_func message received with no content")
 
-        kwargs = dict(content)
-        func_name = kwargs.pop("func", None)
-        if not func_name:
-            raise AssertionError("xl_func message received with no function name")
+        self.__bind_xl_funcs([content], batch=False)
 
-        bind_xl_func(self.__kernel, func_name, **kwargs)
+    async def on_xl_funcs(self, msg):
+        """Registers a batch of functions, updating Excel once they have all been registered."""
+        content = msg.get("content")
+        if not content:
+            raise AssertionError("xl_funcs message received with no content")
+
+        self.__bind_xl_funcs(content.get("funcs", []), batch=True)
+
+    def __bind_xl_funcs(self, funcs, batch):
+        # Functions are bound to the kernel itself rather than a proxy so
+        # get_bound_functions can find them by identity.
+        kernel = self.__kernel()
+        if kernel is None:
+            return
+
+        # If the kernel is part of a pool, functions are registered by the
+        # primary kernel only and calls are dispatched by the pool.
+        pool = kernel.pool
+        if pool is not None:
+            if not pool.is_primary(kernel):
+                return
+
+        # Standby kernels don't replace the running kernel's functions until they are activated
+        if kernel.standby:
+            self.__deferred.extend(funcs)
+            return
+
+        registered = False
+        for content in funcs:
+            kwargs = dict(content)
+            func_name = kwargs.pop("func", None)
+            if not func_name:
+                raise AssertionError("xl_func message received with no function name")
+            registered |= bind_xl_func(pool or kernel, func_name, rebind=not batch, **kwargs)
+
+        if batch and registered:
+            rebind()
+
+    async def activate(self):
+        """Called when the kernel is taken off standby to register any deferred functions."""
+        deferred, self.__deferred = self.__deferred, []
+        self.__bind_xl_funcs(deferred, batch=True)
 
     @staticmethod
     async def on_xl_rtd_set_value(msg):
@@ -66,6 +106,34 @@ class Handler:
 
         xl_rtd_set_value(id, *args, **kwargs)
 
+    @staticmethod
+    async def on_xl_rtd_set_values(msg):
+        """Applies a batch of conflated RTD updates, with at most one update per RTD instance.
+
+        List and array values are sent as snapshots and deltas (see pyxll_notebook.client.rtd).
+        """
+        content = msg.get("content")
+        if not content:
+            raise AssertionError("xl_rtd_set_values message received with no content")
+
+        updates = content.get("updates")
+        updates = deserialize_args(updates) if updates else []
+        metrics = Metrics.instance()
+        metrics.observe("pyxll_notebook_rtd_batch_size", len(updates), size_buckets)
+
+        for id, kind, args in updates:
+            metrics.inc("pyxll_notebook_rtd_updates_total", kind=kind)
+            if kind == "value":
+                xl_rtd_set_value(id, *args)
+            elif kind == "snapshot":
+                xl_rtd_set_snapshot(id, *args)
+            elif kind == "delta":
+                xl_rtd_apply_delta(id, *args)
+            elif kind == "error":
+                xl_rtd_set_error(id, *args)
+            else:
+                _log.debug(f"Unknown RTD update '{kind}' for {id}")
+
     @staticmethod
     async def on_xl_rtd_set_error(msg):
         content = msg.get("content")
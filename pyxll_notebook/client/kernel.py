@@ -4,6 +4,9 @@ Communication is via the Jupyter Notebook REST and websockets APIs.
 """
 from .handler import Handler
 from .events import MessageReplyEvent
+from .wire import serialize_binary_message, deserialize_binary_message, get_json_loads
+from .metrics import Metrics, size_buckets
+from ..serialization import deserialize_result, loads, compress, decompress, dumps_buffers, loads_buffers
 from ..errors import *
 from typing import *
 import datetime as dt
@@ -13,7 +16,9 @@ import logging
 import aiohttp
 import asyncio
 import pickle
+import base64
 import json
+import time
 import uuid
 import os
 import re
@@ -21,118 +26,467 @@ import re
 
 _log = logging.getLogger(__name__)
 
+# Used to find the message types in a message before decoding it
+_msg_type_re = re.compile(r'"msg_type":\s*"([^"]*)"')
+
+# Used to find status messages the notebook server sends when the kernel restarts or dies
+_kernel_lost_re = re.compile(r'"execution_state":\s*"(?:restarting|dead)"')
+
+# Code used to run a chunk of notebook cells in a single execute request
+# when using the "single" notebook execution mode.
+_run_cells_code = """
+def __pyxll_notebook_run_cells__(path, cells):
+    try:
+        shell = get_ipython()
+    except NameError:
+        shell = None
+    for index, source in cells:
+        try:
+            if shell is not None:
+                source = shell.transform_cell(source)
+            code = compile(source, "<%s cell %d>" % (path, index), "exec")
+            exec(code, globals())
+        except Exception as e:
+            raise RuntimeError("Error in cell %d of %s: %s: %s" % (index, path, type(e).__name__, e))
+"""
+
+
+class _Request:
+    """A message sent to the kernel that is waiting for a reply."""
+
+    def __init__(self, msg_type, data, retry):
+        self.msg_type = msg_type
+        self.data = data
+        self.retry = retry
+        self.sent = False
+        self.connection = None
+
+
+class _XlFuncCall:
+    """An xl_func call waiting to be sent, or waiting for its result."""
+
+    def __init__(self, func_name, args, protocol, retry, future, owner=None):
+        self.func_name = func_name
+        self.args = args
+        self.owner = owner
+        self.protocol = protocol
+        self.retry = retry
+        self.future = future
+        self.batch = None
+        self.task = None
+        self.enqueue_time = time.perf_counter()
+
 
 class Kernel:
     """The Kernel starts and manages communication with the remote Jupyter kernel."""
 
     default_handler_cls = Handler
     message_protocol_version = "5.0"
+    rpc_comm_target_name = "pyxll_notebook.rpc"
+
+    # Messages that are dropped instead of queued when a handler queue is full
+    droppable_msg_types = frozenset(("stream", "error"))
+
+    def __init__(self,
+                 url,
+                 authenticator,
+                 handler=None,
+                 batch_window=0.0,
+                 max_batch_size=100,
+                 binary_buffers=True,
+                 http_session=None,
+                 reconnect_delay=0.5,
+                 reconnect_max_delay=30.0,
+                 reconnect_max_attempts=10,
+                 kernel_check_interval=5.0,
+                 execution_mode="cells",
+                 chunk_size=0,
+                 json_backend="auto",
+                 handler_concurrency=4,
+                 handler_queue_size=1000,
+                 handler_queue_warning=500,
+                 call_timeout=None,
+                 use_rpc_comm=True,
+                 session_id=None,
+                 compression_threshold=0,
+                 compression_level=6,
+                 websocket_compression=True,
+                 out_of_band_threshold=65536,
+                 rtd_interval=0.1):
+        """Kernel wrapper for running code on a notebook server.
 
-    def __init__(self, url, authenticator, handler=None):
-        """Kernel wrapper for running code on a notebook server."""
+        :param batch_window: Time in seconds to wait for more xl_func calls before sending
+                             a batch. With 0 only calls made concurrently are batched.
+                             Only thread safe functions are called concurrently by Excel,
+                             so calls to other functions are always sent one at a time.
+        :param max_batch_size: Maximum number of xl_func calls to send in a single request.
+        :param binary_buffers: Send xl_func arguments and results as binary message buffers
+                               instead of as base64 encoded strings.
+        :param http_session: Function returning a shared aiohttp.ClientSession to use for
+                             REST requests. If not set a new session is used for each request.
+        :param reconnect_delay: Initial delay in seconds before reconnecting after the websocket
+                                connection is lost. The delay is doubled after each failed attempt.
+        :param reconnect_max_delay: Maximum delay in seconds between reconnection attempts.
+        :param reconnect_max_attempts: Number of times to try reconnecting before giving up,
+                                       or 0 to keep trying until the kernel is shutdown.
+        :param kernel_check_interval: Time in seconds between checks that the kernel still exists
+                                      while requests are waiting for replies, or 0 to disable.
+                                      The websocket isn't closed if the kernel is deleted, so
+                                      without this the requests would never complete.
+        :param execution_mode: How notebooks are run. "cells" runs each cell with its own execute
+                               request. "single" sends all the cells in a single request, or in
+                               chunks of chunk_size cells if chunk_size is set.
+        :param chunk_size: Maximum number of cells to send in a request in "single" mode.
+        :param json_backend: JSON library used to decode messages ("json", "orjson", "ujson" or "auto").
+        :param handler_concurrency: Number of tasks processing messages passed to the handler.
+                                    Messages for the same RTD id are always processed in order.
+        :param handler_queue_size: Number of waiting messages for each handler task above which
+                                   printed output and errors from the kernel are dropped.
+                                   Other messages, like RTD updates, are never dropped.
+        :param handler_queue_warning: Number of waiting messages at which a warning is logged.
+        :param call_timeout: Default time in seconds to wait for an xl_func call before giving up
+                             and interrupting the kernel. None or 0 to wait indefinitely.
+        :param use_rpc_comm: Call functions in the kernel using messages sent on a comm instead of
+                             evaluating expressions in execute requests. Requires binary_buffers.
+        :param session_id: Session id to use, e.g. when attaching to a kernel started previously.
+        :param compression_threshold: Compress xl_func arguments and results larger than this many
+                                      bytes, if the kernel supports it. 0 to disable compression.
+        :param compression_level: zlib compression level used for arguments and results.
+        :param websocket_compression: Use the permessage-deflate websocket extension if the
+                                      notebook server supports it.
+        :param out_of_band_threshold: With pickle protocol 5, send buffers of at least this many bytes
+                                      (e.g. numpy arrays) as separate binary message buffers instead
+                                      of copying them into the pickled data. 0 to disable.
+        :param rtd_interval: Time in seconds the kernel conflates RTD updates over, sending only
+                             the latest value for each RTD instance. 0 sends every update.
+                             Updates to list and array values are sent as deltas either way.
+        """
         if handler is None:
             handler = self.default_handler_cls(self)
         self.__url = url
         self.__handler = handler
         self.__kernel = None
+        self.__id = None
         self.__ws = None
-        self.__session_id = uuid.uuid1().hex
+        self.__session_id = session_id or uuid.uuid1().hex
         self.__username = os.getlogin()
         self.__kernel_url = None
         self.__ws_url = None
         self.__authenticator = authenticator
+        self.__http_session = http_session
         self.__message_events: Dict[str, MessageReplyEvent] = {}
+        self.__result_events: Dict[str, MessageReplyEvent] = {}
+        self.__binary_buffers = binary_buffers
+        self.__batch_window = max(batch_window, 0.0)
+        self.__max_batch_size = max(max_batch_size, 1)
+        self.__pending_calls = []
+        self.__flush_handle = None
+        self.__notebooks = []
+        self.__requests: Dict[str, _Request] = {}
+        self.__connection = 0
+        self.__connected = asyncio.Event()
+        self.__ready = asyncio.Event()
+        self.__connection_error = None
+        self.__reconnect_task = None
+        self.__rerun_notebooks = False
+        self.__reconnect_delay = reconnect_delay
+        self.__reconnect_max_delay = reconnect_max_delay
+        self.__reconnect_max_attempts = reconnect_max_attempts
+        self.__kernel_check_interval = max(kernel_check_interval, 0)
+        self.__kernel_dead = False
+        if execution_mode not in ("cells", "single"):
+            raise AssertionError(f"Unknown notebook execution mode '{execution_mode}'.")
+        self.__execution_mode = execution_mode
+        self.__chunk_size = max(chunk_size, 0)
+        self.__json_loads = get_json_loads(json_backend)
+        self.__handled_msg_types = {n[3:] for n in dir(handler) if n.startswith("on_")}
+        self.__handler_concurrency = max(handler_concurrency, 1)
+        self.__handler_queue_size = handler_queue_size
+        self.__handler_queue_warning = handler_queue_warning
+        self.__dropped_messages = 0
+        self.__handler_queues = []
+        self.__handler_tasks = []
+        self.__call_timeout = call_timeout
+        self.__busy_msg_id = None
+        self.__abandoned_msg_ids = set()
+        self.__use_rpc_comm = use_rpc_comm and binary_buffers
+        self.__rpc_comm_task = None
+        self.__rpc_comm_ids = set()
+        self.__outstanding_calls = 0
+        self.__notebook_last_modified = {}
+        self.__closed = False
+        self.__requested_compression_threshold = max(compression_threshold, 0)
+        self.__compression_level = compression_level
+        self.__compression_threshold = 0
+        self.__websocket_compression = websocket_compression
+        self.__requested_out_of_band_threshold = max(out_of_band_threshold, 0) if binary_buffers else 0
+        self.__out_of_band_threshold = 0
+        self.__rtd_interval = max(rtd_interval, 0)
+        self.__rtd_interval_set = False
+        self.pool = None
+        self.standby = False
+
+    @property
+    def id(self):
+        """Id of the remote kernel."""
+        return self.__id
+
+    @property
+    def session_id(self):
+        """Session id used for messages to and from the remote kernel."""
+        return self.__session_id
+
+    @property
+    def kernels(self):
+        """List of kernels, for consistency with KernelPool."""
+        return [self]
+
+    @property
+    def closed(self):
+        """True once the kernel has been shutdown or disconnected from."""
+        return self.__closed
+
+    @property
+    def outstanding_calls(self):
+        """Number of xl_func calls waiting for a result."""
+        return self.__outstanding_calls
+
+    def select_kernel(self, pinned=True):
+        """Return the kernel to send a call to (see KernelPool.select_kernel)."""
+        return self
+
+    def notebook_last_modified(self, path):
+        """Return the notebook server's last modified time of a notebook when it was run in this kernel."""
+        return self.__notebook_last_modified.get(path)
+
+    async def activate(self):
+        """Take the kernel off standby, registering any functions deferred while it was on standby."""
+        self.standby = False
+        await self.__handler.activate()
 
     async def start(self):
         """Starts the kernel and opens the websocket connection."""
+        self.__start_handler_tasks()
+        await self.__start_kernel()
+        await self.__connect()
+        self.__ready.set()
+
+    async def attach(self, kernel_id):
+        """Connects to a kernel that's already running instead of starting a new one.
+
+        Returns False if the kernel no longer exists.
+        """
+        if not self.__authenticator.authenticated:
+            await self.__authenticator.authenticate()
+
+        kernel_url = self.__url + "/api/kernels/" + kernel_id
+        response = await self.__request("GET", kernel_url, allowed_status=(404,))
+        if response.status == 404:
+            return False
+
+        self.__kernel = await response.json()
+        self.__id = kernel_id
+        self.__kernel_url = kernel_url
+        _log.debug(f"Attached to existing kernel {kernel_id}.")
+
+        self.__start_handler_tasks()
+        await self.__connect()
+        self.__ready.set()
+        return True
+
+    async def __start_kernel(self):
+        """Start a new kernel on the notebook server."""
         # Call the authenticator if required
         url = self.__url
-        ws_url = None
 
         if not self.__authenticator.authenticated:
             await self.__authenticator.authenticate()
 
         kernels_url = url + "/api/kernels"
-        async with aiohttp.ClientSession(cookie_jar=self.__authenticator.cookie_jar) as session:
-            async with session.post(kernels_url, headers=self.__authenticator.headers) as response:
-                try:
-                    await response.read()
-                    response.raise_for_status()
-                except Exception:
-                    self.__authenticator.reset()
-                    raise
+        response = await self.__request("POST", kernels_url)
 
-                # If the status code is 200 and the response isn't json it's not, the most likely
-                # cause is the notebook server isn't running but the web-server is returning a restart
-                # or login page.
-                if not re.match(r"^application/(?:[\w.+-]+?\+)?json", response.content_type, re.IGNORECASE):
-                    raise KernelStartError("Response ito kernel start request is not JSON data. "
-                                           "Check the notebook server is running.")
+        # If the status code is 200 and the response isn't json it's not, the most likely
+        # cause is the notebook server isn't running but the web-server is returning a restart
+        # or login page.
+        if not re.match(r"^application/(?:[\w.+-]+?\+)?json", response.content_type, re.IGNORECASE):
+            raise KernelStartError("Response ito kernel start request is not JSON data. "
+                                   "Check the notebook server is running.")
 
-                kernel = await response.json()
-                if not "id" in kernel:
-                    raise KernelStartError(kernel.get("message"))
-                kernel_id = kernel["id"]
-                _log.debug(f"Started new kernel {kernel_id}.")
+        kernel = await response.json()
+        if not "id" in kernel:
+            raise KernelStartError(kernel.get("message"))
+        kernel_id = kernel["id"]
+        _log.debug(f"Started new kernel {kernel_id}.")
 
         self.__kernel = kernel
         self.__id = kernel_id
         self.__kernel_url = kernels_url + "/" + self.__kernel["id"]
 
-        # connect the websocket
-        if ws_url is None:
-            u = urllib.parse.urlparse(url)
-            scheme = "wss" if u.scheme == "https" else "ws"
-            port = f":{u.port}" if u.port else ""
-            ws_url = f"{scheme}://{u.hostname}{port}{u.path}"
+    async def __connect(self):
+        """Open the websocket connection to the kernel and start polling it."""
+        url = self.__url
+        kernel_id = self.__id
+
+        u = urllib.parse.urlparse(url)
+        scheme = "wss" if u.scheme == "https" else "ws"
+        port = f":{u.port}" if u.port else ""
+        ws_url = f"{scheme}://{u.hostname}{port}{u.path}"
 
         ws_headers = dict(self.__authenticator.headers)
-        cookies = self.__authenticator.cookie_jar.filter_cookies(kernels_url)
+        cookies = self.__authenticator.cookie_jar.filter_cookies(url + "/api/kernels")
         cookies = [f"{k}={c.value};" for k, c in cookies.items()]
         ws_headers["Cookie"] = " ".join(cookies)
         self.__ws_url = f"{ws_url}/api/kernels/{kernel_id}/channels?session_id={self.__session_id}"
-        self.__ws = await websockets.connect(self.__ws_url, max_size=None, extra_headers=ws_headers)
+        try:
+            ws = await websockets.connect(self.__ws_url,
+                                          max_size=None,
+                                          extra_headers=ws_headers,
+                                          compression="deflate" if self.__websocket_compression else None)
+        except websockets.exceptions.InvalidStatusCode as e:
+            if e.status_code in (401, 403):
+                self.__authenticator.reset()
+            raise
+
+        self.__ws = ws
+        self.__connection += 1
+        self.__connected.set()
 
         # start polling the websocket connection
         loop = asyncio.get_event_loop()
-        loop.create_task(self.__poll_ws())
+        loop.create_task(self.__poll_ws(ws))
+        if self.__kernel_check_interval:
+            loop.create_task(self.__check_kernel(ws))
 
     async def run_notebook(self, path):
-        """Run all cells in a notebook"""
+        """Run all cells in a notebook.
+
+        Functions registered by the notebook have been bound by the handler when this returns.
+        """
+        if path not in self.__notebooks:
+            self.__notebooks.append(path)
+        await self.__run_notebook(path, self.__ready)
+        await self.__wait_for_handlers()
+
+    async def restore_notebook(self, path, last_modified):
+        """Register the functions from a notebook that has already been run in an attached kernel.
+
+        The notebook isn't run again. Instead the server module sends its xl_func
+        registrations again, if pyxll_notebook.server was imported by the notebook.
+        """
+        if path not in self.__notebooks:
+            self.__notebooks.append(path)
+        self.__notebook_last_modified[path] = last_modified
+
+        code = ("if '__pyxll_notebook_replay_xl_funcs' in globals():\n"
+                "    __pyxll_notebook_replay_xl_funcs()")
+        await self.__execute(code, ready=self.__ready)
+        await self.__negotiate_session_options(self.__ready)
+        await self.__wait_for_handlers()
+        _log.info(f"Restored notebook {path} in existing kernel {self.__id}.")
+
+    async def __run_notebook(self, path, ready):
         url = self.__url + "/api/contents/" + path
-        async with aiohttp.ClientSession(cookie_jar=self.__authenticator.cookie_jar) as session:
-            async with session.get(url, headers=self.__authenticator.headers) as response:
-                try:
-                    await response.read()
-                    response.raise_for_status()
-                    file = await response.json()
-                except Exception:
-                    self.__authenticator.reset()
-                    raise
+        response = await self.__request("GET", url)
+        file = await response.json()
+        self.__notebook_last_modified[path] = file.get("last_modified")
+        start_time = time.perf_counter()
 
-        # set the special __pyxll_notebook_session__ and __pyxll_pickle_protocol__ variables
-        await self.execute(f"__pyxll_notebook_session__ = '{self.__session_id}'")
-        await self.execute(f"__pyxll_pickle_protocol__ = {pickle.HIGHEST_PROTOCOL}")
+        # code to set the special __pyxll_notebook_session__ and __pyxll_pickle_protocol__ variables
+        session_code = [
+            f"__pyxll_notebook_session__ = '{self.__session_id}'",
+            f"__pyxll_pickle_protocol__ = {pickle.HIGHEST_PROTOCOL}"
+        ]
 
         cells = file["content"]["cells"]
-        code = [c["source"] for c in cells if len(c["source"]) > 0 and c["cell_type"] == "code"]
+        code = [(i, c["source"]) for i, c in enumerate(cells, 1)
+                if len(c["source"]) > 0 and c["cell_type"] == "code"]
 
-        for c in code:
-            await self.execute(c)
+        if self.__execution_mode == "single":
+            # Send the cells in as few requests as possible, with the session variables set in the first one
+            chunk_size = self.__chunk_size or max(len(code), 1)
+            chunks = [code[i:i + chunk_size] for i in range(0, len(code), chunk_size)] or [[]]
+            for i, chunk in enumerate(chunks):
+                chunk_code = (_run_cells_code +
+                              f"__pyxll_notebook_run_cells__({path!r}, {chunk!r})\n"
+                              "del __pyxll_notebook_run_cells__\n")
+                if i == 0:
+                    chunk_code = "\n".join(session_code) + "\n" + chunk_code
+                await self.__execute(chunk_code, ready=ready)
+            num_requests = len(chunks)
+        else:
+            for c in session_code:
+                await self.__execute(c, ready=ready)
 
-    async def execute(self, code, user_expressions={}):
-        """Execute some code on the remote kernel and wait for it to complete."""
-        msg_id = uuid.uuid1().hex
+            for _, c in code:
+                await self.__execute(c, ready=ready)
+            num_requests = len(session_code) + len(code)
 
+        # pyxll_notebook.server may have been imported by the notebook so try opening the RPC comm again
+        task = self.__rpc_comm_task
+        if task is not None and task.done() and (task.cancelled() or task.result() is None):
+            self.__reset_rpc_comm()
+        await self.__negotiate_session_options(ready)
+
+        elapsed = time.perf_counter() - start_time
+        _log.info(f"Ran notebook {path} ({len(code)} cells) in {elapsed:.2f}s "
+                  f"using {num_requests} requests ('{self.__execution_mode}' execution mode).")
+
+    async def execute(self, code, user_expressions={}, buffers=None, msg_id=None, retry=False, timeout=None):
+        """Execute some code on the remote kernel and wait for it to complete.
+
+        Any buffers are sent with the request as binary data and can be
+        accessed by the server from the parent message.
+
+        If the connection to the kernel is lost the request is sent again
+        after reconnecting if retry is True, otherwise a KernelConnectionError
+        is raised.
+
+        If no reply is received within timeout seconds an ExecuteTimeoutError is
+        raised. If the request times out or is cancelled while the kernel is
+        running it, the kernel is interrupted.
+        """
+        return await self.__execute(code, user_expressions, buffers, msg_id, retry, self.__ready, timeout)
+
+    async def __execute(self,
+                        code,
+                        user_expressions={},
+                        buffers=None,
+                        msg_id=None,
+                        retry=False,
+                        ready=None,
+                        timeout=None):
         content = {
             'code': code,
             'silent': False,
             'user_expressions': user_expressions
         }
 
+        reply = await self.__send_shell_message("execute_request", content, buffers, msg_id, retry, ready, timeout)
+
+        content = reply.get("content", {})
+        status = content.get("status")
+        if status != "ok":
+            raise ExecuteRequestError(**content)
+
+        return content
+
+    async def __send_shell_message(self,
+                                   msg_type,
+                                   content,
+                                   buffers=None,
+                                   msg_id=None,
+                                   retry=False,
+                                   ready=None,
+                                   timeout=None):
+        """Send a message on the shell channel and return the reply message."""
+        metrics = Metrics.instance()
+        start_time = time.perf_counter()
+        if msg_id is None:
+            msg_id = uuid.uuid1().hex
+
         header = {
             'msg_id': msg_id,
-            'msg_type': 'execute_request',
+            'msg_type': msg_type,
             'username': self.__username,
             'session': self.__session_id,
             'data': dt.datetime.now().isoformat(),
@@ -147,28 +501,535 @@ class Kernel:
             'content': content,
         }
 
+        if buffers:
+            msg["buffers"] = buffers
+            data = serialize_binary_message(msg)
+        else:
+            data = json.dumps(msg)
+
+        encoded_time = time.perf_counter()
+        metrics.observe("pyxll_notebook_request_seconds", encoded_time - start_time, stage="encode", msg_type=msg_type)
+        metrics.observe("pyxll_notebook_message_bytes", len(data), size_buckets, direction="sent", msg_type=msg_type)
+        metrics.add_gauge("pyxll_notebook_requests_in_flight", 1, msg_type=msg_type)
+
         event = self.__message_events[msg_id] = MessageReplyEvent()
+        request = self.__requests[msg_id] = _Request(msg_type, data, retry)
+        try:
+            # send the message to the remote kernel and wait for a response
+            await self.__send(request, ready)
+            sent_time = time.perf_counter()
+            metrics.observe("pyxll_notebook_request_seconds", sent_time - encoded_time, stage="send", msg_type=msg_type)
 
-        # send the message to the remote kernel
-        await self.__ws.send(json.dumps(msg))
+            reply = await asyncio.wait_for(event.wait(), timeout or None)
+            metrics.observe("pyxll_notebook_request_seconds", time.perf_counter() - sent_time, stage="reply", msg_type=msg_type)
+        except asyncio.TimeoutError:
+            metrics.inc("pyxll_notebook_request_errors_total", msg_type=msg_type, reason="timeout")
+            self.__abandon(msg_id)
+            raise ExecuteTimeoutError(f"Timed out after {timeout} seconds waiting for the kernel.")
+        except asyncio.CancelledError:
+            metrics.inc("pyxll_notebook_request_errors_total", msg_type=msg_type, reason="cancelled")
+            self.__abandon(msg_id)
+            raise
+        except Exception:
+            metrics.inc("pyxll_notebook_request_errors_total", msg_type=msg_type, reason="error")
+            raise
+        finally:
+            metrics.add_gauge("pyxll_notebook_requests_in_flight", -1, msg_type=msg_type)
+            self.__message_events.pop(msg_id, None)
+            self.__requests.pop(msg_id, None)
 
-        # wait for a response
-        reply = await event.wait()
+        return reply
 
-        content = reply.get("content", {})
-        status = content.get("status")
+    async def __get_rpc_comm(self):
+        """Return the id of the comm used to call functions in the kernel, or None.
+
+        The comm is opened the first time this is called, and None is returned if the
+        server doesn't support it (e.g. if pyxll_notebook.server hasn't been imported yet).
+        """
+        if not self.__use_rpc_comm:
+            return None
+
+        if self.__rpc_comm_task is None:
+            loop = asyncio.get_event_loop()
+            self.__rpc_comm_task = loop.create_task(self.__open_rpc_comm())
+
+        return await asyncio.shield(self.__rpc_comm_task)
+
+    async def __open_rpc_comm(self):
+        try:
+            return await self.__send_rpc_comm_open()
+        except Exception:
+            _log.debug(f"Unable to open RPC comm to kernel {self.__id}", exc_info=True)
+            return None
+
+    async def __send_rpc_comm_open(self):
+        comm_id = uuid.uuid4().hex
+        content = {
+            "comm_id": comm_id,
+            "target_name": self.rpc_comm_target_name,
+            "data": {}
+        }
+
+        # The server replies on the comm if it's ready, or closes it if the target doesn't exist
+        self.__rpc_comm_ids.add(comm_id)
+        reply = await self.__send_shell_message("comm_open", content, retry=True, ready=self.__ready, timeout=30)
+        msg_type = reply.get("header", {}).get("msg_type")
+        status = reply.get("content", {}).get("data", {}).get("status")
+        if msg_type != "comm_msg" or status != "ready":
+            self.__rpc_comm_ids.discard(comm_id)
+            _log.debug(f"RPC comm not available for kernel {self.__id}, using execute requests instead.")
+            return None
+
+        _log.debug(f"Opened RPC comm {comm_id} to kernel {self.__id}.")
+        return comm_id
+
+    def __reset_rpc_comm(self):
+        """Try to open the RPC comm again next time it's needed."""
+        self.__rpc_comm_task = None
+        self.__rpc_comm_ids.clear()
+
+    async def __call_rpc(self, comm_id, method, data=None, buffers=None, retry=False, timeout=None):
+        """Call a function registered with the server's rpc_method decorator.
+
+        Returns the reply data and buffers.
+        """
+        data = dict(data or {})
+        data["method"] = method
+        content = {
+            "comm_id": comm_id,
+            "data": data
+        }
+
+        reply = await self.__send_shell_message("comm_msg",
+                                                content,
+                                                buffers=buffers,
+                                                retry=retry,
+                                                ready=self.__ready,
+                                                timeout=timeout)
+
+        data = reply.get("content", {}).get("data", {})
+        if reply.get("header", {}).get("msg_type") != "comm_msg":
+            raise ExecuteRequestError("RPC comm closed by the kernel.")
+        if data.get("status") != "ok":
+            raise ExecuteRequestError(**data)
+
+        return data, reply.get("buffers", [])
+
+    async def call_xl_rtd_method(self, id, method_name, protocol=pickle.HIGHEST_PROTOCOL):
+        """Call a method on a remote RTD instance and return the result."""
+        comm_id = await self.__get_rpc_comm()
+        if comm_id is not None:
+            data = {"id": id, "method": method_name, "protocol": protocol}
+            _, buffers = await self.__call_rpc(comm_id, "call_xl_rtd_method", data, retry=True)
+            return loads(buffers[0])
+
+        expr = f"__pyxll_notebook_call_xl_rtd_method('{id}', '{method_name}', protocol={protocol})"
+        reply = await self.execute('', user_expressions={"result": expr}, retry=True)
+        result = self.__get_user_expression_result(reply)
+        return deserialize_result(result["data"]["text/plain"])
+
+    async def request_rtd_snapshot(self, id):
+        """Ask the kernel to send the full value of an RTD instance after missing an update to it."""
+        comm_id = await self.__get_rpc_comm()
+        if comm_id is not None:
+            await self.__call_rpc(comm_id, "rtd_snapshot", {"id": id}, retry=True)
+            return
+
+        await self.execute(f"__pyxll_notebook_rtd_snapshot({id!r})", retry=True)
+
+    async def release_objects(self, owners):
+        """Release the objects returned to cells (owners) that no longer use them."""
+        comm_id = await self.__get_rpc_comm()
+        if comm_id is not None:
+            await self.__call_rpc(comm_id, "release_objects", {"owners": owners}, retry=True)
+            return
+
+        await self.execute(f"__pyxll_notebook_release_objects({owners!r})", retry=True)
+
+    async def get_server_cache_stats(self):
+        """Return a dict of statistics about the kernel's server side result cache."""
+        comm_id = await self.__get_rpc_comm()
+        if comm_id is not None:
+            data, _ = await self.__call_rpc(comm_id, "cache_stats", retry=True)
+            return data["stats"]
+
+        expr = f"__pyxll_notebook_cache_stats(protocol={pickle.HIGHEST_PROTOCOL})"
+        reply = await self.execute('', user_expressions={"result": expr}, retry=True)
+        result = self.__get_user_expression_result(reply)
+        return deserialize_result(result["data"]["text/plain"])
+
+    async def ping(self, use_rpc_comm=True):
+        """Send a call that does nothing to the kernel and wait for the reply.
+
+        Used to measure the overhead of calling a function in the kernel,
+        either using the RPC comm or execute requests.
+        """
+        comm_id = await self.__get_rpc_comm() if use_rpc_comm else None
+        if use_rpc_comm and comm_id is None:
+            raise AssertionError("RPC comm is not available.")
+
+        if comm_id is not None:
+            await self.__call_rpc(comm_id, "ping", retry=True)
+        else:
+            reply = await self.execute('', user_expressions={"result": "__pyxll_notebook_ping()"}, retry=True)
+            self.__get_user_expression_result(reply)
+
+    def __abandon(self, msg_id):
+        """Called when no longer waiting for a reply to a request.
+
+        If the kernel is running the request it is interrupted, or if it hasn't
+        started running it yet it will be interrupted when it starts.
+        """
+        request = self.__requests.get(msg_id)
+        if request is None or not request.sent:
+            return
+
+        if self.__busy_msg_id == msg_id:
+            self.__interrupt()
+        else:
+            self.__abandoned_msg_ids.add(msg_id)
+
+    def __on_status(self, msg):
+        """Keep track of which request the kernel is running, interrupting abandoned requests."""
+        msg_id = msg.get("parent_header", {}).get("msg_id")
+        state = msg.get("content", {}).get("execution_state")
+        if state == "busy":
+            self.__busy_msg_id = msg_id
+            if msg_id in self.__abandoned_msg_ids:
+                self.__interrupt()
+        elif state == "idle":
+            self.__abandoned_msg_ids.discard(msg_id)
+            if self.__busy_msg_id == msg_id:
+                self.__busy_msg_id = None
+
+    def __interrupt(self):
+        """Interrupt the kernel in the background."""
+        async def interrupt():
+            try:
+                await self.interrupt()
+            except Exception:
+                _log.error(f"Error interrupting kernel {self.__id}", exc_info=True)
+
+        loop = asyncio.get_event_loop()
+        loop.create_task(interrupt())
+
+    async def interrupt(self):
+        """Interrupt the kernel, stopping the code it's currently running."""
+        if self.__kernel is None:
+            return
+        _log.debug(f"Interrupting kernel {self.__id}")
+        await self.__request("POST", self.__kernel_url + "/interrupt")
+
+    async def __send(self, request, ready):
+        """Send a request to the kernel, waiting for the connection to be ready first.
+
+        If the connection is lost before the request is sent it will be sent
+        once the connection has been re-established.
+        """
+        while not request.sent:
+            await ready.wait()
+            if self.__connection_error is not None:
+                raise self.__connection_error
+
+            ws = self.__ws
+            try:
+                request.connection = self.__connection
+                await ws.send(request.data)
+                request.sent = True
+            except websockets.exceptions.ConnectionClosed:
+                self.__on_connection_lost(ws)
+
+    async def call_xl_func(self,
+                           func_name,
+                           args,
+                           protocol=pickle.HIGHEST_PROTOCOL,
+                           retry=True,
+                           timeout=None,
+                           owner=None):
+        """Call a remote @xl_func function and return the result.
+
+        Calls made within the batch window are collected and sent to the kernel
+        together as a single execute request.
+
+        If retry is False the call will fail rather than be sent again if the
+        connection to the kernel is lost while it is running.
+
+        If the call takes longer than timeout seconds (or the kernel's default
+        call_timeout if not set) an ExecuteTimeoutError is raised. If the call
+        times out or is cancelled and the kernel is still running it, the kernel
+        is interrupted.
+
+        For functions that return objects, owner is the cell the returned object
+        belongs to and is released when the cell no longer uses it.
+        """
+        if timeout is None:
+            timeout = self.__call_timeout
+
+        loop = asyncio.get_event_loop()
+        call = _XlFuncCall(func_name, args, protocol, retry, loop.create_future(), owner)
+        self.__pending_calls.append(call)
+        self.__outstanding_calls += 1
+
+        metrics = Metrics.instance()
+        metrics.add_gauge("pyxll_notebook_calls_in_flight", 1, function=func_name)
+
+        if len(self.__pending_calls) >= self.__max_batch_size:
+            self.__flush_calls()
+        elif self.__flush_handle is None:
+            if self.__batch_window > 0:
+                self.__flush_handle = loop.call_later(self.__batch_window, self.__flush_calls)
+            else:
+                self.__flush_handle = loop.call_soon(self.__flush_calls)
+
+        try:
+            return await asyncio.wait_for(call.future, timeout or None)
+        except asyncio.TimeoutError:
+            metrics.inc("pyxll_notebook_call_errors_total", function=func_name, reason="timeout")
+            self.__abandon_call(call)
+            raise ExecuteTimeoutError(f"{func_name} timed out after {timeout} seconds.")
+        except asyncio.CancelledError:
+            metrics.inc("pyxll_notebook_call_errors_total", function=func_name, reason="cancelled")
+            self.__abandon_call(call)
+            raise
+        except Exception:
+            metrics.inc("pyxll_notebook_call_errors_total", function=func_name, reason="error")
+            raise
+        finally:
+            self.__outstanding_calls -= 1
+            metrics.add_gauge("pyxll_notebook_calls_in_flight", -1, function=func_name)
+
+    def __abandon_call(self, call):
+        """Called when an xl_func call is no longer wanted.
+
+        If the call hasn't been sent it is removed from the pending calls, otherwise
+        if there are no other calls in the same batch still waiting the batch is cancelled.
+        """
+        if call in self.__pending_calls:
+            self.__pending_calls.remove(call)
+            return
+
+        if call.task is not None and all(c.future.done() for c in call.batch):
+            call.task.cancel()
+
+    def __flush_calls(self):
+        """Send all pending xl_func calls as a batch."""
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        batch, self.__pending_calls = self.__pending_calls, []
+        if batch:
+            loop = asyncio.get_event_loop()
+            task = loop.create_task(self.__send_calls(batch))
+            for call in batch:
+                call.batch = batch
+                call.task = task
+
+    async def __send_calls(self, batch):
+        """Call a batch of remote functions and set the result of each call's future."""
+        metrics = Metrics.instance()
+        start_time = time.perf_counter()
+        for call in batch:
+            metrics.observe("pyxll_notebook_call_seconds", start_time - call.enqueue_time,
+                            stage="queue", function=call.func_name)
+        metrics.observe("pyxll_notebook_batch_size", len(batch), size_buckets)
+
+        try:
+            protocol = min(c.protocol for c in batch)
+            retry = all(c.retry for c in batch)
+            calls = tuple((c.func_name, c.args) if c.owner is None else (c.func_name, c.args, c.owner)
+                          for c in batch)
+            comm_id = await self.__get_rpc_comm()
+            binary = comm_id is not None or self.__binary_buffers
+
+            serialize_start_time = time.perf_counter()
+            out_of_band_threshold = self.__out_of_band_threshold if binary else 0
+            data, *out_of_band = dumps_buffers(calls,
+                                               protocol=protocol,
+                                               compression_threshold=0,
+                                               out_of_band_threshold=out_of_band_threshold)
+            payload = compress(data, self.__compression_threshold, self.__compression_level)
+            self.__observe_payload(data, payload, out_of_band, "sent")
+            if binary:
+                calls = [payload] + out_of_band
+                num_bytes = sum(len(b) for b in calls)
+            else:
+                calls = base64.b64encode(payload).decode()
+                num_bytes = len(calls)
+            metrics.observe("pyxll_notebook_batch_seconds", time.perf_counter() - serialize_start_time, stage="serialize")
+            metrics.observe("pyxll_notebook_batch_bytes", num_bytes, size_buckets, direction="sent")
+
+            send_start_time = time.perf_counter()
+            if comm_id is not None:
+                data = {"protocol": pickle.HIGHEST_PROTOCOL}
+                _, buffers = await self.__call_rpc(comm_id, "call_xl_func_batch", data, calls, retry)
+            elif binary:
+                buffers = await self.__send_calls_binary(calls, retry)
+            else:
+                expr = f"__pyxll_notebook_call_xl_func_batch('{calls}', protocol={pickle.HIGHEST_PROTOCOL})"
+                reply = await self.execute('', user_expressions={"result": expr}, retry=retry)
+                result = self.__get_user_expression_result(reply)
+                data = result["data"]["text/plain"]
+                buffers = [base64.b64decode(data)]
+
+            deserialize_start_time = time.perf_counter()
+            metrics.observe("pyxll_notebook_batch_seconds", deserialize_start_time - send_start_time, stage="roundtrip")
+            metrics.observe("pyxll_notebook_batch_bytes", len(data) if not binary else sum(len(b) for b in buffers),
+                            size_buckets, direction="received")
+
+            payload, *out_of_band = buffers
+            data = decompress(payload)
+            self.__observe_payload(data, payload, out_of_band, "received")
+            results = loads_buffers([data] + out_of_band)
+            metrics.observe("pyxll_notebook_batch_seconds", time.perf_counter() - deserialize_start_time, stage="deserialize")
+        except Exception as e:
+            # Calls sent on the RPC comm that the kernel hadn't run before it was restarted
+            # are sent again once the notebooks have been re-run.
+            if isinstance(e, KernelRestartedError) and retry:
+                return await self.__send_calls(batch)
+
+            for call in batch:
+                if not call.future.done():
+                    call.future.set_exception(e)
+            return
+
+        for call, result in zip(batch, results):
+            # Newer servers also return the time taken to run each function
+            status, value = result[:2]
+            if len(result) > 2:
+                metrics.observe("pyxll_notebook_call_seconds", result[2], stage="execute", function=call.func_name)
+            if call.future.done():
+                continue
+            if status == "ok":
+                call.future.set_result(value)
+            else:
+                call.future.set_exception(ExecuteRequestError(**value))
+
+    @staticmethod
+    def __observe_payload(data, payload, out_of_band, direction):
+        """Record the size of xl_func call data before and after compression, and of any out-of-band buffers."""
+        metrics = Metrics.instance()
+        metrics.inc("pyxll_notebook_payload_bytes_total", len(data), direction=direction, encoding="uncompressed")
+        metrics.inc("pyxll_notebook_payload_bytes_total", len(payload), direction=direction, encoding="wire")
+        if payload is not data:
+            metrics.inc("pyxll_notebook_compressed_batches_total", direction=direction)
+        if out_of_band:
+            metrics.inc("pyxll_notebook_out_of_band_bytes_total",
+                        sum(memoryview(b).nbytes for b in out_of_band),
+                        direction=direction)
+
+    async def __negotiate_session_options(self, ready):
+        """Enable compression and out-of-band buffers for xl_func arguments and results,
+        and set the RTD update interval, if the kernel supports them.
+
+        The server functions are only available once a notebook has imported
+        pyxll_notebook.server, so this is done after running each notebook.
+        """
+        expressions = {}
+        if self.__requested_compression_threshold and not self.__compression_threshold:
+            threshold = self.__requested_compression_threshold
+            expressions["compression"] = f"__pyxll_notebook_set_compression({threshold}, {self.__compression_level})"
+        if self.__requested_out_of_band_threshold and not self.__out_of_band_threshold:
+            threshold = self.__requested_out_of_band_threshold
+            expressions["out_of_band"] = f"__pyxll_notebook_set_out_of_band_buffers({threshold})"
+        if not self.__rtd_interval_set:
+            expressions["rtd"] = f"__pyxll_notebook_set_rtd_interval({self.__rtd_interval})"
+        if not expressions:
+            return
+
+        try:
+            reply = await self.__execute('', user_expressions=expressions, ready=ready)
+        except Exception:
+            _log.debug("Error enabling compression and out-of-band buffers", exc_info=True)
+            return
+
+        for name in expressions:
+            try:
+                self.__get_user_expression_result(reply, name)
+            except Exception:
+                _log.debug(f"Kernel doesn't support '{name}'", exc_info=True)
+                continue
+
+            if name == "rtd":
+                self.__rtd_interval_set = True
+            elif name == "compression":
+                self.__compression_threshold = self.__requested_compression_threshold
+                _log.debug(f"Compressing xl_func arguments and results larger than "
+                           f"{self.__compression_threshold} bytes.")
+            else:
+                self.__out_of_band_threshold = self.__requested_out_of_band_threshold
+                _log.debug(f"Sending buffers of at least {self.__out_of_band_threshold} bytes out-of-band.")
+
+    async def __send_calls_binary(self, calls, retry):
+        """Send a batch of serialized calls as binary buffers and return the binary result buffers."""
+        msg_id = uuid.uuid1().hex
+        event = self.__result_events[msg_id] = MessageReplyEvent()
+        try:
+            expr = f"__pyxll_notebook_call_xl_func_batch(protocol={pickle.HIGHEST_PROTOCOL})"
+            reply = await self.execute('',
+                                       user_expressions={"result": expr},
+                                       buffers=calls,
+                                       msg_id=msg_id,
+                                       retry=retry)
+            self.__get_user_expression_result(reply)
+
+            # The results are sent on the iopub channel and may arrive before or after the reply
+            msg = await event.wait()
+            return msg["buffers"]
+        finally:
+            self.__result_events.pop(msg_id, None)
+
+    @staticmethod
+    def __get_user_expression_result(reply, name="result"):
+        """Return a user expression from an execute reply, raising an error if it failed."""
+        result = reply["user_expressions"][name]
+        status = result.get("status")
         if status != "ok":
-            raise ExecuteRequestError(**content)
+            raise ExecuteRequestError(**result)
+        return result
 
-        return content
+    async def __poll_ws(self, ws):
+        """Read messages from the websocket.
+
+        Replies are processed immediately, and any other messages are queued
+        to be processed by the handler tasks so that they don't hold up replies.
+        """
+        session_id = self.__session_id
+        session_id_bytes = session_id.encode()
+        metrics = Metrics.instance()
 
-    async def __poll_ws(self):
-        while self.__ws is not None:
+        while self.__ws is ws:
             try:
-                msg = json.loads(await self.__ws.recv())
+                data = await ws.recv()
+            except websockets.exceptions.ConnectionClosed:
+                self.__on_connection_lost(ws)
+                return
 
-                # Only process messages for our session
+            try:
+                # Skip messages for other sessions or of types we don't handle without decoding them.
+                # This is only a quick check on the raw data, and the message is checked again below.
+                if isinstance(data, bytes):
+                    if session_id_bytes not in data:
+                        continue
+                    msg = deserialize_binary_message(data, loads=self.__json_loads)
+                else:
+                    if not self.__is_handled(data) \
+                            or (session_id not in data and not _kernel_lost_re.search(data)):
+                        continue
+                    msg = self.__json_loads(data)
+
+                # The notebook server sends status messages with no parent to every
+                # session when the kernel has been restarted or has died.
                 parent_header = msg.get("parent_header", {})
+                if not parent_header and msg.get("header", {}).get("msg_type") == "status":
+                    state = msg.get("content", {}).get("execution_state")
+                    if state in ("restarting", "dead"):
+                        reason = f"Kernel {self.__id} was restarted" if state == "restarting" \
+                            else f"Kernel {self.__id} died"
+                        self.__on_kernel_lost(ws, reason, dead=state == "dead")
+                        return
+
+                # Only process messages for our session
                 parent_session_id = parent_header.get("session")
                 if parent_session_id != self.__session_id:
                     continue
@@ -176,6 +1037,8 @@ class Kernel:
                 # Dispatch the message based on the message type
                 header = msg.get("header", {})
                 msg_type = header.get("msg_type")
+                metrics.observe("pyxll_notebook_message_bytes", len(data), size_buckets,
+                                direction="received", msg_type=msg_type)
 
                 if "." in msg_type:
                     ns, msg_type = msg_type.split(".", 1)
@@ -185,49 +1048,348 @@ class Kernel:
                 # All replies are processed by the kernel to signal any waiting events
                 if msg_type.endswith("_reply"):
                     await self.__on_reply(msg)
+                elif msg_type == "xl_func_batch_result":
+                    await self.__on_reply(msg, self.__result_events)
+                elif msg_type == "status":
+                    self.__on_status(msg)
+                elif msg_type in ("comm_msg", "comm_close") \
+                        and msg.get("content", {}).get("comm_id") in self.__rpc_comm_ids:
+                    await self.__on_reply(msg)
+                    continue
 
                 # And pass all messages to the handler
                 func = getattr(self.__handler, f"on_{msg_type}", None)
                 if func:
-                    await func(msg)
+                    self.__queue_handler(func, msg_type, msg)
+            except Exception:
+                _log.error("An error occurred processing a message from the kernel", exc_info=True)
+
+    def __is_handled(self, data):
+        """Return True if a raw message may be a reply or a message type we have a handler for."""
+        for msg_type in _msg_type_re.findall(data):
+            if msg_type.startswith("pyxll."):
+                msg_type = msg_type[6:]
+            if msg_type.endswith("_reply") \
+                    or msg_type in ("xl_func_batch_result", "status", "comm_msg", "comm_close") \
+                    or msg_type in self.__handled_msg_types:
+                return True
+        return False
+
+    def __start_handler_tasks(self):
+        """Start the tasks that pass messages to the handler."""
+        if self.__handler_tasks:
+            return
+
+        loop = asyncio.get_event_loop()
+        for i in range(self.__handler_concurrency):
+            queue = asyncio.Queue()
+            self.__handler_queues.append(queue)
+            self.__handler_tasks.append(loop.create_task(self.__process_handler_queue(queue)))
+
+    def __stop_handler_tasks(self):
+        tasks, self.__handler_tasks = self.__handler_tasks, []
+        self.__handler_queues = []
+        for task in tasks:
+            task.cancel()
+
+    async def __wait_for_handlers(self):
+        """Wait until all messages received so far have been processed by the handler."""
+        await asyncio.gather(*[q.join() for q in self.__handler_queues])
+
+    def __queue_handler(self, func, msg_type, msg):
+        """Queue a message to be processed by the handler.
+
+        Messages are queued by RTD id (or message type if there's no id)
+        so messages for the same RTD instance are processed in order.
+
+        Queuing never waits, as that would stop the websocket being read and
+        hold up replies to Excel function calls. Instead, once a queue has
+        handler_queue_size messages, printed output and errors are dropped.
+        Messages that can't be dropped are always queued.
+        """
+        content = msg.get("content")
+        key = content.get("id") if isinstance(content, dict) else None
+        if key is None:
+            key = msg_type
+
+        queue = self.__handler_queues[hash(key) % len(self.__handler_queues)]
+        if self.__handler_queue_warning and queue.qsize() == self.__handler_queue_warning:
+            _log.warning(f"{queue.qsize()} messages are waiting to be processed for kernel {self.__id}.")
+
+        if self.__handler_queue_size and queue.qsize() >= self.__handler_queue_size \
+                and msg_type in self.droppable_msg_types:
+            self.__dropped_messages += 1
+            if self.__dropped_messages % 1000 == 1:
+                _log.warning(f"Dropped {self.__dropped_messages} output messages from kernel {self.__id} "
+                             "as they are not being processed quickly enough.")
+            return
+
+        queue.put_nowait((func, msg))
+
+    async def __process_handler_queue(self, queue):
+        while True:
+            func, msg = await queue.get()
+            try:
+                await func(msg)
             except Exception:
                 _log.error("An error occurred processing a message from the kernel", exc_info=True)
+            finally:
+                queue.task_done()
+
+    def __on_connection_lost(self, ws, reason=None):
+        """Called when the websocket connection is found to be closed.
+
+        Requests that have been sent and can't be safely retried are failed,
+        and a task is started to reconnect to the kernel.
+        """
+        if ws is not self.__ws or self.__kernel is None:
+            return
+
+        # If the connection is lost while re-running notebooks after a previous
+        # reconnect then start again, re-running the notebooks on the new connection.
+        if self.__reconnect_task is not None:
+            self.__reconnect_task.cancel()
+
+        if reason is None:
+            reason = f"Connection to kernel {self.__id} lost"
+        _log.warning(f"{reason}, reconnecting.")
+        self.__ws = None
+        self.__connected.clear()
+        self.__ready.clear()
+        self.__busy_msg_id = None
+        self.__abandoned_msg_ids.clear()
+
+        for msg_id, request in list(self.__requests.items()):
+            if request.sent and not request.retry:
+                self.__fail_request(msg_id, KernelConnectionError("Connection to the kernel was lost."))
+
+        loop = asyncio.get_event_loop()
+        self.__reconnect_task = loop.create_task(self.__reconnect())
 
-    async def __on_reply(self, msg):
+    def __on_kernel_lost(self, ws, reason, dead=False):
+        """Called when the kernel has been restarted, has died or no longer exists
+        but the websocket connection to it is still open.
+
+        Nothing sent to the old kernel will get a reply. The request the kernel was
+        running when it died is failed, so a request that kills the kernel isn't sent
+        again, and everything else is treated as if the connection had been lost.
+        The connection is re-established, re-running the notebooks first (in a new
+        kernel if the kernel is dead or no longer exists), and retryable requests
+        are sent again.
+        """
+        if ws is not self.__ws or self.__kernel is None:
+            return
+
+        if self.__busy_msg_id is not None:
+            self.__fail_request(self.__busy_msg_id, KernelConnectionError("The kernel was restarted."))
+
+        self.__kernel_dead = dead
+        self.__on_kernel_restarted()
+
+        self.__on_connection_lost(ws, reason)
+
+        loop = asyncio.get_event_loop()
+        loop.create_task(ws.close())
+
+    def __on_kernel_restarted(self):
+        """Reset anything that doesn't survive the kernel being restarted or replaced."""
+        self.__rerun_notebooks = True
+
+        # session options are negotiated again after re-running the notebooks
+        self.__compression_threshold = 0
+        self.__out_of_band_threshold = 0
+        self.__rtd_interval_set = False
+
+        # comms don't exist in the new kernel so any requests sent on them can't be sent
+        # again, but retryable requests are failed with KernelRestartedError so the
+        # caller can retry them on a new comm.
+        self.__reset_rpc_comm()
+        for msg_id, request in list(self.__requests.items()):
+            if request.msg_type.startswith("comm_"):
+                error_cls = KernelRestartedError if request.retry else KernelConnectionError
+                self.__fail_request(msg_id, error_cls("The kernel was restarted."))
+
+    async def __check_kernel(self, ws):
+        """Check the kernel still exists every kernel_check_interval seconds while requests
+        are waiting for replies, for as long as ws is the current connection.
+        """
+        while True:
+            await asyncio.sleep(self.__kernel_check_interval)
+            if ws is not self.__ws:
+                return
+
+            if not any(r.sent for r in self.__requests.values()):
+                continue
+
+            try:
+                exists = await self.__kernel_exists()
+            except Exception:
+                _log.debug(f"Error checking kernel {self.__id} exists", exc_info=True)
+                continue
+
+            if not exists:
+                self.__on_kernel_lost(ws, f"Kernel {self.__id} no longer exists")
+                return
+
+    def __fail_request(self, msg_id, error):
+        self.__requests.pop(msg_id, None)
+        event = self.__message_events.pop(msg_id, None)
+        if event:
+            event.set_error(error)
+
+    async def __reconnect(self):
+        """Reconnect to the kernel with exponential backoff.
+
+        If the kernel no longer exists a new one is started and any notebooks
+        are re-run before sending any retryable requests again.
+        """
+        delay = self.__reconnect_delay
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if not self.__authenticator.authenticated:
+                    await self.__authenticator.authenticate()
+
+                if self.__kernel_dead:
+                    # remove the dead kernel from the notebook server before replacing it
+                    try:
+                        await self.__request("DELETE", self.__kernel_url, allowed_status=(404,))
+                    except Exception:
+                        _log.debug(f"Error deleting dead kernel {self.__id}", exc_info=True)
+
+                if self.__kernel_dead or not await self.__kernel_exists():
+                    _log.warning(f"Kernel {self.__id} no longer exists, starting a new kernel.")
+                    await self.__start_kernel()
+                    self.__kernel_dead = False
+                    self.__on_kernel_restarted()
+
+                await self.__connect()
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if self.__reconnect_max_attempts and attempt >= self.__reconnect_max_attempts:
+                    _log.error(f"Failed to reconnect to kernel {self.__id}.", exc_info=True)
+                    self.__reconnect_task = None
+                    self.__set_connection_error(KernelConnectionError("Unable to reconnect to the kernel."))
+                    return
+
+                _log.warning(f"Failed to reconnect to kernel {self.__id}, retrying in {delay:.1f}s.",
+                             exc_info=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.__reconnect_max_delay)
+
+        # re-run notebooks in the new kernel before anything else is sent
+        if self.__rerun_notebooks:
+            for path in self.__notebooks:
+                try:
+                    await self.__run_notebook(path, self.__connected)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    _log.error(f"Error re-running notebook {path} after restarting the kernel", exc_info=True)
+            self.__rerun_notebooks = False
+            await self.__negotiate_session_options(self.__connected)
+
+        self.__reconnect_task = None
+        self.__ready.set()
+
+        # send requests that were sent on the previous connection again
+        loop = asyncio.get_event_loop()
+        for request in list(self.__requests.values()):
+            if request.sent and request.connection != self.__connection:
+                request.sent = False
+                loop.create_task(self.__send(request, self.__ready))
+
+        _log.info(f"Reconnected to kernel {self.__id}.")
+
+    def __set_connection_error(self, error):
+        """Fail all waiting requests, and any future requests, with error."""
+        self.__connection_error = error
+        for msg_id in list(self.__requests.keys()):
+            self.__fail_request(msg_id, error)
+        self.__connected.set()
+        self.__ready.set()
+
+    async def __kernel_exists(self):
+        """Return True if the kernel is still running on the notebook server."""
+        response = await self.__request("GET", self.__kernel_url, allowed_status=(404,))
+        return response.status != 404
+
+    async def __on_reply(self, msg, events=None):
         """Sets any waiting events when a message reply is received."""
+        if events is None:
+            events = self.__message_events
+
         msg_id = msg.get("parent_header", {}).get("msg_id")
         if not msg_id:
             _log.debug(f"Message reply received with no msg_id in the parent_header: {msg}")
             return
 
-        event = self.__message_events.pop(msg_id, None)
+        event = events.pop(msg_id, None)
         if event:
             event.set(msg)
 
+    async def __request(self, method, url, allowed_status=()):
+        """Make a REST request to the notebook server and return the response.
+
+        The response body is read before returning so the connection can be re-used.
+        Error responses with a status in allowed_status are returned instead of raised.
+        """
+        if self.__http_session is not None:
+            return await self.__send_request(self.__http_session(), method, url, allowed_status)
+
+        async with aiohttp.ClientSession(cookie_jar=self.__authenticator.cookie_jar) as session:
+            return await self.__send_request(session, method, url, allowed_status)
+
+    async def __send_request(self, session, method, url, allowed_status):
+        auth = self.__authenticator
+        async with session.request(method, url, headers=auth.headers) as response:
+            try:
+                await response.read()
+                if response.status not in allowed_status:
+                    response.raise_for_status()
+            except Exception:
+                auth.reset()
+                raise
+            return response
+
     async def shutdown(self):
         """Sends the shutdown command to the kernel and closes the websocket connection"""
         kernel_url = self.__kernel_url
         kernel = self.__kernel
-        auth = self.__authenticator
         ws = self.__ws
-
-        self.__kernel = None
-        self.__ws = None
+        self.__close(KernelConnectionError("The kernel has been shutdown."))
 
         if kernel:
-            tasks = []
+            tasks = [self.__request("DELETE", kernel_url)]
             if ws:
                 tasks.append(ws.close())
 
-            async with aiohttp.ClientSession(cookie_jar=auth.cookie_jar) as session:
-                async with session.delete(kernel_url, headers=auth.headers) as response:
-                    try:
-                        tasks.append(response.read())
-                        await asyncio.gather(*tasks)
-                    except Exception:
-                        auth.reset()
-                        raise
-                    _log.debug(f"Shutdown kernel {kernel['id']}")
+            await asyncio.gather(*tasks)
+            _log.debug(f"Shutdown kernel {kernel['id']}")
+
+    async def disconnect(self):
+        """Closes the websocket connection but leaves the kernel running so it can be attached to later."""
+        ws = self.__ws
+        self.__close(KernelConnectionError("The kernel has been disconnected."))
+        if ws:
+            await ws.close()
+        _log.debug(f"Disconnected from kernel {self.__id}")
+
+    def __close(self, error):
+        """Stop using the kernel, failing anything waiting for it with error."""
+        self.__closed = True
+        self.__kernel = None
+        self.__ws = None
+
+        if self.__reconnect_task is not None:
+            self.__reconnect_task.cancel()
+            self.__reconnect_task = None
+
+        self.__set_connection_error(error)
+        self.__stop_handler_tasks()
 
     def __del__(self):
         if self.__kernel:
@@ -2,11 +2,20 @@
 KernelManager class for starting and stopping the remote
 kernels for each notebook in the configuration.
 """
-from pyxll import get_config
+from pyxll import get_config, get_event_loop
 from .kernel import Kernel
+from .kernel_pool import KernelPool
+from .metrics import monitor_event_loop, write_metrics_file
+from .xl_func import recalculate_waiting_cells, register_stub_functions, unbind_stub_functions, get_bound_functions
 from . import authenticators
+import logging
 import asyncio
 import aiohttp
+import atexit
+import json
+import os
+
+_log = logging.getLogger(__name__)
 
 
 class KernelManager:
@@ -17,9 +26,78 @@ class KernelManager:
         self.__notebooks = [x for x in map(str.strip, notebooks.split(";")) if x]
         self.__url = cfg.get("NOTEBOOK", "url", fallback="https://localhost:8888")
         self.__auth_class = cfg.get("NOTEBOOK", "auth_class")
+        self.__batch_window = float(cfg.get("NOTEBOOK", "batch_window", fallback=0))
+        self.__max_batch_size = int(cfg.get("NOTEBOOK", "max_batch_size", fallback=100))
+        self.__binary_buffers = bool(int(cfg.get("NOTEBOOK", "binary_buffers", fallback=1)))
+        self.__http_connection_limit = int(cfg.get("NOTEBOOK", "http_connection_limit", fallback=100))
+        self.__http_connection_limit_per_host = int(cfg.get("NOTEBOOK", "http_connection_limit_per_host", fallback=0))
+        self.__http_dns_cache_ttl = int(cfg.get("NOTEBOOK", "http_dns_cache_ttl", fallback=300))
+        self.__http_keepalive_timeout = float(cfg.get("NOTEBOOK", "http_keepalive_timeout", fallback=60))
+        self.__reconnect_delay = float(cfg.get("NOTEBOOK", "reconnect_delay", fallback=0.5))
+        self.__reconnect_max_delay = float(cfg.get("NOTEBOOK", "reconnect_max_delay", fallback=30))
+        self.__reconnect_max_attempts = int(cfg.get("NOTEBOOK", "reconnect_max_attempts", fallback=10))
+        self.__kernel_check_interval = float(cfg.get("NOTEBOOK", "kernel_check_interval", fallback=5))
+        self.__execution_mode = cfg.get("NOTEBOOK", "execution_mode", fallback="cells").strip().lower()
+        self.__chunk_size = int(cfg.get("NOTEBOOK", "chunk_size", fallback=0))
+        self.__json_backend = cfg.get("NOTEBOOK", "json_backend", fallback="auto").strip().lower()
+        self.__handler_concurrency = int(cfg.get("NOTEBOOK", "handler_concurrency", fallback=4))
+        self.__handler_queue_size = int(cfg.get("NOTEBOOK", "handler_queue_size", fallback=1000))
+        self.__handler_queue_warning = int(cfg.get("NOTEBOOK", "handler_queue_warning", fallback=500))
+        self.__call_timeout = float(cfg.get("NOTEBOOK", "call_timeout", fallback=0))
+        self.__use_rpc_comm = bool(int(cfg.get("NOTEBOOK", "use_rpc_comm", fallback=1)))
+        self.__compression_threshold = int(cfg.get("NOTEBOOK", "compression_threshold", fallback=0))
+        self.__compression_level = int(cfg.get("NOTEBOOK", "compression_level", fallback=6))
+        self.__websocket_compression = bool(int(cfg.get("NOTEBOOK", "websocket_compression", fallback=1)))
+        self.__out_of_band_threshold = int(cfg.get("NOTEBOOK", "out_of_band_threshold", fallback=65536))
+        self.__rtd_interval = float(cfg.get("NOTEBOOK", "rtd_interval", fallback=0.1))
+        self.__pool_size = int(cfg.get("NOTEBOOK", "pool_size", fallback=1))
+        pool_sizes = cfg.get("NOTEBOOK", "pool_sizes", fallback="")
+        pool_sizes = [x.rsplit("=", 1) for x in map(str.strip, pool_sizes.split(";")) if x]
+        self.__pool_sizes = {k.strip(): int(v) for k, v in pool_sizes}
+        self.__metrics_file = cfg.get("NOTEBOOK", "metrics_file", fallback="").strip()
+        self.__metrics_interval = float(cfg.get("NOTEBOOK", "metrics_interval", fallback=10))
+        self.__event_loop_monitor_interval = float(cfg.get("NOTEBOOK", "event_loop_monitor_interval", fallback=1))
+        self.__metrics_tasks = None
+        self.__warm_standby = int(cfg.get("NOTEBOOK", "warm_standby", fallback=0))
+        self.__standby_kernels = {}
+        self.__starting_kernels = {}
+        self.__status = "Not running"
+        self.__status_callbacks = []
+        self.__startup_concurrency = max(int(cfg.get("NOTEBOOK", "startup_concurrency", fallback=4)), 0)
+        dependencies = cfg.get("NOTEBOOK", "notebook_dependencies", fallback="")
+        dependencies = [x.split("=", 1) for x in map(str.strip, dependencies.split(";")) if x]
+        self.__notebook_dependencies = {
+            k.strip(): [d for d in map(str.strip, v.split(",")) if d in self.__notebooks]
+            for k, v in dependencies
+        }
+        self.__check_notebook_dependencies()
+        self.__persistent_sessions = bool(int(cfg.get("NOTEBOOK", "persistent_sessions", fallback=0)))
+        default_session_file = os.path.join(os.path.expanduser("~"), ".pyxll-notebook-sessions.json")
+        self.__session_file = os.path.expanduser(cfg.get("NOTEBOOK", "session_file", fallback=default_session_file))
+        self.__function_manifest = bool(int(cfg.get("NOTEBOOK", "function_manifest", fallback=1)))
+        default_manifest_file = os.path.join(os.path.expanduser("~"), ".pyxll-notebook-manifest.json")
+        self.__manifest_file = os.path.expanduser(cfg.get("NOTEBOOK", "manifest_file", fallback=default_manifest_file))
         self.__cfg = cfg
         self.__authenticator = None
+        self.__http_session = None
         self.__kernels = {}
+        atexit.register(self.__close_http_session_at_exit)
+
+    def __check_notebook_dependencies(self):
+        """Raise an error if the notebook dependencies are circular."""
+        checked = set()
+
+        def check(notebook, path):
+            if notebook in path:
+                raise AssertionError("Circular notebook dependencies: " + " -> ".join(path + [notebook]))
+            if notebook in checked:
+                return
+            for dependency in self.__notebook_dependencies.get(notebook, []):
+                check(dependency, path + [notebook])
+            checked.add(notebook)
+
+        for notebook in self.__notebook_dependencies:
+            check(notebook, [])
 
     @classmethod
     def instance(cls):
@@ -33,6 +111,23 @@ class KernelManager:
         """Returns true if there are any kernels running."""
         return bool(self.__kernels)
 
+    @property
+    def status(self):
+        """Short description of what the kernels are doing, e.g. for showing in the ribbon."""
+        return self.__status
+
+    def add_status_callback(self, callback):
+        """Add a function to be called with the new status whenever the status changes."""
+        self.__status_callbacks.append(callback)
+
+    def __set_status(self, status):
+        self.__status = status
+        for callback in self.__status_callbacks:
+            try:
+                callback(status)
+            except Exception:
+                _log.debug("Error in status callback", exc_info=True)
+
     def __get_authenticator(self):
         """Return the authenticator for connecting to the notebook server."""
         if self.__authenticator:
@@ -54,30 +149,444 @@ class KernelManager:
 
         return self.__authenticator
 
+    def __get_http_session(self):
+        """Return the aiohttp session shared by all kernels for REST requests.
+
+        The session is re-created if the authenticator has been reset since
+        it was created, as that replaces the authenticator's cookie jar.
+        """
+        auth = self.__get_authenticator()
+        session = self.__http_session
+        if session is not None and not session.closed and session.cookie_jar is auth.cookie_jar:
+            return session
+
+        if session is not None and not session.closed:
+            asyncio.get_event_loop().create_task(session.close())
+
+        connector = aiohttp.TCPConnector(limit=self.__http_connection_limit,
+                                         limit_per_host=self.__http_connection_limit_per_host,
+                                         ttl_dns_cache=self.__http_dns_cache_ttl,
+                                         keepalive_timeout=self.__http_keepalive_timeout)
+
+        self.__http_session = aiohttp.ClientSession(cookie_jar=auth.cookie_jar, connector=connector)
+        return self.__http_session
+
+    async def __close_http_session(self):
+        session = self.__http_session
+        self.__http_session = None
+        if session is not None and not session.closed:
+            await session.close()
+
+    def __close_http_session_at_exit(self):
+        """Close the shared aiohttp session when Python exits."""
+        session = self.__http_session
+        if session is None or session.closed:
+            return
+
+        try:
+            loop = get_event_loop()
+            if loop.is_running():
+                f = asyncio.run_coroutine_threadsafe(self.__close_http_session(), loop)
+                f.result(timeout=5)
+        except Exception:
+            _log.debug("Error closing HTTP session at exit", exc_info=True)
+
+    def __start_metrics_tasks(self):
+        """Start monitoring the event loop and writing the metrics file, if configured."""
+        if self.__metrics_tasks is not None:
+            return
+
+        loop = asyncio.get_event_loop()
+        self.__metrics_tasks = []
+        if self.__event_loop_monitor_interval > 0:
+            self.__metrics_tasks.append(loop.create_task(monitor_event_loop(self.__event_loop_monitor_interval)))
+        if self.__metrics_file:
+            task = write_metrics_file(self.__metrics_file, self.__metrics_interval)
+            self.__metrics_tasks.append(loop.create_task(task))
+
     async def start_all_kernels(self):
-        """Start or restart the remote kernels"""
+        """Start or restart the remote kernels.
+
+        If warm_standby is set, running kernels are replaced by standby kernels
+        that have already run the notebook and the old kernels are shutdown in
+        the background.
+        """
         await asyncio.sleep(0)  # make sure we're on the asyncio thread
 
-        # stop any running kernel
-        await self.stop_all_kernels()
+        # kernels left running when Excel was last closed are re-attached to if possible
+        saved_sessions = {}
+        if self.__persistent_sessions and not self.__kernels:
+            saved_sessions = self.__load_sessions()
+
+        loop = asyncio.get_event_loop()
+        if self.__warm_standby <= 0:
+            # stop any running kernel
+            await self.stop_all_kernels()
+        else:
+            for notebook in list(self.__kernels.keys()):
+                if notebook not in self.__notebooks:
+                    loop.create_task(self.__shutdown_kernel(self.__kernels.pop(notebook)))
+
+        # run the notebooks listed in the config concurrently, after any notebooks they depend on
+        semaphore = asyncio.Semaphore(self.__startup_concurrency or max(len(self.__notebooks), 1))
+        tasks = {}
+        num_started = 0
+        self.__set_status(f"Starting kernels (0/{len(self.__notebooks)})")
+
+        async def start_notebook(notebook):
+            nonlocal num_started
+            for dependency in self.__notebook_dependencies.get(notebook, []):
+                await tasks[dependency]
+            async with semaphore:
+                await self.__start_notebook(notebook, saved_sessions.pop(notebook, None))
+
+            self.__update_manifest(notebook)
+
+            # cells that called this notebook's functions before they were ready can be recalculated now
+            recalculate_waiting_cells()
+            num_started += 1
+            self.__set_status(f"Starting kernels ({num_started}/{len(self.__notebooks)})")
+
+        for notebook in self.__notebooks:
+            tasks[notebook] = loop.create_task(start_notebook(notebook))
+        results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+        if self.__warm_standby > 0:
+            self.__start_standby_kernels()
+
+        # shutdown any saved kernels for notebooks that are no longer configured
+        for saved in saved_sessions.values():
+            await self.__delete_kernels(saved)
+
+        if self.__persistent_sessions:
+            self.__save_sessions(self.__kernels)
+
+        errors = [(n, e) for n, e in zip(tasks.keys(), results) if isinstance(e, BaseException)]
+        for notebook, error in errors:
+            _log.error(f"Error starting kernel for {notebook}", exc_info=error)
+        if errors:
+            self.__set_status(f"Error starting kernels ({len(errors)}/{len(self.__notebooks)} failed)")
+            raise errors[0][1]
+
+        self.__set_status("Kernels ready")
+
+    async def __start_notebook(self, notebook, saved=None):
+        """Start the kernel for a notebook, using a standby kernel if there is one ready."""
+        old_kernel = self.__kernels.pop(notebook, None)
+        kernel = await self.__take_standby_kernel(notebook)
+        if kernel is not None:
+            self.__kernels[notebook] = kernel
+            await kernel.activate()
+            if old_kernel is not None:
+                asyncio.get_event_loop().create_task(self.__shutdown_kernel(old_kernel))
+            return kernel
+
+        if old_kernel is not None:
+            await old_kernel.shutdown()
+        return await self.__start_notebook_kernel(notebook, saved)
+
+    async def __start_notebook_kernel(self, notebook, saved=None):
+        """Start a kernel and run a notebook in it, or re-attach to the saved kernel for the notebook."""
+        if saved is not None:
+            kernel = await self.__restore_kernel(notebook, saved)
+            if kernel is not None:
+                self.__kernels[notebook] = kernel
+                return kernel
+
+        kernel = await self.get_kernel(notebook)
+        await kernel.run_notebook(notebook)
+        return kernel
+
+    async def __restore_kernel(self, notebook, saved):
+        """Re-attach to the saved kernels for a notebook.
+
+        Returns None if the kernels are no longer running or the notebook has
+        changed since they ran it, in which case they are shutdown.
+        """
+        try:
+            last_modified = await self.__get_notebook_last_modified(notebook)
+        except Exception:
+            _log.warning(f"Unable to check if {notebook} has changed.", exc_info=True)
+            last_modified = None
+
+        pool_size = max(self.__pool_sizes.get(notebook, self.__pool_size), 1)
+        if last_modified is None \
+                or last_modified != saved.get("last_modified") \
+                or len(saved["kernels"]) != pool_size:
+            _log.info(f"Not re-attaching to kernels for {notebook} as it has changed since they were started.")
+            await self.__delete_kernels(saved)
+            return None
+
+        self.__start_metrics_tasks()
+        kernels = [self.__create_kernel(session_id=k["session_id"]) for k in saved["kernels"]]
+        try:
+            attached = await asyncio.gather(*[k.attach(s["kernel_id"]) for k, s in zip(kernels, saved["kernels"])])
+            if all(attached):
+                kernel = KernelPool(kernels) if len(kernels) > 1 else kernels[0]
+                await kernel.restore_notebook(notebook, last_modified)
+                return kernel
+            _log.info(f"Kernels for {notebook} are no longer running.")
+        except Exception:
+            _log.warning(f"Unable to re-attach to kernels for {notebook}.", exc_info=True)
+
+        await asyncio.gather(*[self.__shutdown_kernel(k) for k in kernels])
+        return None
+
+    def __load_sessions(self):
+        """Return the kernels saved for each notebook by __save_sessions."""
+        return self.__read_notebooks_file(self.__session_file)
+
+    def __save_sessions(self, kernels):
+        """Save the ids of kernels so they can be re-attached to after Excel restarts."""
+        notebooks = {}
+        for notebook, kernel in kernels.items():
+            notebooks[notebook] = {
+                "last_modified": kernel.notebook_last_modified(notebook),
+                "kernels": [{"kernel_id": k.id, "session_id": k.session_id} for k in kernel.kernels]
+            }
+
+        self.__write_notebooks_file(self.__session_file, notebooks)
+
+    async def register_manifest_functions(self):
+        """Register the functions saved in the manifest for the configured notebooks.
+
+        This is called before the kernels are started so that formulas using the
+        functions don't show #NAME? errors while waiting for the notebooks to run.
+
+        Functions are only registered for notebooks that haven't changed since
+        they were saved, as functions may have been removed or renamed since.
+        """
+        if not self.__function_manifest:
+            return
 
-        # run any notebooks listed in the config
+        manifest = self.__read_notebooks_file(self.__manifest_file)
+        notebooks = [n for n in self.__notebooks if manifest.get(n, {}).get("funcs")]
+
+        async def get_last_modified(notebook):
+            try:
+                return await self.__get_notebook_last_modified(notebook)
+            except Exception:
+                _log.warning(f"Unable to check if {notebook} has changed.", exc_info=True)
+                return None
+
+        last_modified = await asyncio.gather(*[get_last_modified(n) for n in notebooks])
+        funcs = []
+        for notebook, modified in zip(notebooks, last_modified):
+            saved = manifest[notebook]
+            if modified is None or modified != saved.get("last_modified"):
+                _log.info(f"Not registering saved functions for {notebook} as it has changed since they were saved.")
+                continue
+            funcs.extend(saved["funcs"])
+        register_stub_functions(funcs)
+
+    def __update_manifest(self, notebook):
+        """Save the functions registered by a notebook, and remove any it no longer registers."""
+        if not self.__function_manifest:
+            return
+
+        kernel = self.__kernels.get(notebook)
+        if kernel is None:
+            return
+
+        manifest = self.__read_notebooks_file(self.__manifest_file)
+        funcs = get_bound_functions(kernel)
+        names = {f.get("name", f["func"]) for f in funcs}
+        old_funcs = manifest.get(notebook, {}).get("funcs", [])
+        unbind_stub_functions([n for n in (f.get("name", f["func"]) for f in old_funcs) if n not in names])
+
+        manifest[notebook] = {
+            "last_modified": kernel.notebook_last_modified(notebook),
+            "funcs": funcs
+        }
+        self.__write_notebooks_file(self.__manifest_file, manifest)
+
+    def __read_notebooks_file(self, path):
+        """Read a json file of data saved per notebook for the current notebook server url."""
+        if not os.path.exists(path):
+            return {}
+
+        try:
+            with open(path) as fh:
+                data = json.load(fh)
+        except Exception:
+            _log.warning(f"Unable to read {path}.", exc_info=True)
+            return {}
+
+        if data.get("url") != self.__url:
+            return {}
+        return data.get("notebooks", {})
+
+    def __write_notebooks_file(self, path, notebooks):
+        try:
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump({"url": self.__url, "notebooks": notebooks}, fh, indent=2)
+            os.replace(tmp_path, path)
+        except Exception:
+            _log.warning(f"Unable to write {path}.", exc_info=True)
+
+    async def __delete_kernels(self, saved):
+        """Shutdown saved kernels without connecting to them."""
+        auth = self.__get_authenticator()
+        for k in saved["kernels"]:
+            url = self.__url + "/api/kernels/" + k["kernel_id"]
+            try:
+                if not auth.authenticated:
+                    await auth.authenticate()
+
+                session = self.__get_http_session()
+                async with session.delete(url, headers=auth.headers) as response:
+                    await response.read()
+                    if response.status != 404:
+                        response.raise_for_status()
+            except Exception:
+                _log.warning(f"Unable to shutdown kernel {k['kernel_id']}.", exc_info=True)
+
+    def __start_standby_kernels(self):
+        """Start standby kernels for each notebook until there are warm_standby of them."""
+        loop = asyncio.get_event_loop()
         for notebook in self.__notebooks:
-            kernel = await self.get_kernel(notebook)
+            tasks = self.__standby_kernels.setdefault(notebook, [])
+            while len(tasks) < self.__warm_standby:
+                tasks.append(loop.create_task(self.__start_standby_kernel(notebook)))
+
+    async def __start_standby_kernel(self, notebook):
+        """Start a kernel and run the notebook in it, without registering its functions."""
+        kernel = self.__new_kernel(notebook)
+        kernel.standby = True
+        try:
+            await kernel.start()
             await kernel.run_notebook(notebook)
+        except BaseException:
+            await self.__shutdown_kernel(kernel)
+            raise
+        _log.debug(f"Standby kernel for {notebook} is ready.")
+        return kernel
+
+    async def __take_standby_kernel(self, notebook):
+        """Return a standby kernel for a notebook, or None if there isn't a usable one.
+
+        Kernels that are ready are used first. Kernels that ran an older version
+        of the notebook are shutdown.
+        """
+        tasks = self.__standby_kernels.get(notebook, [])
+        tasks.sort(key=lambda t: not t.done())
+        while tasks:
+            task = tasks.pop(0)
+            try:
+                kernel = await task
+            except Exception:
+                _log.warning(f"Standby kernel for {notebook} failed to start.", exc_info=True)
+                continue
+
+            try:
+                last_modified = await self.__get_notebook_last_modified(notebook)
+            except Exception:
+                _log.warning(f"Unable to check if {notebook} has changed.", exc_info=True)
+                last_modified = None
+
+            if last_modified is not None and last_modified == kernel.notebook_last_modified(notebook):
+                return kernel
+
+            _log.info(f"Not using standby kernel as {notebook} has changed since it was started.")
+            asyncio.get_event_loop().create_task(self.__shutdown_kernel(kernel))
+
+        return None
+
+    async def __stop_standby_kernel(self, task):
+        if not task.done():
+            task.cancel()
+        try:
+            kernel = await task
+        except (asyncio.CancelledError, Exception):
+            return
+        await kernel.shutdown()
+
+    @staticmethod
+    async def __shutdown_kernel(kernel):
+        """Shutdown a kernel, logging rather than raising any error."""
+        try:
+            await kernel.shutdown()
+        except Exception:
+            _log.warning("Error shutting down kernel", exc_info=True)
 
     async def get_kernel(self, notebook):
-        """Get a kernel for a notebook, and start one if it doesn't already exist"""
+        """Get a kernel for a notebook, and start one if it doesn't already exist.
+
+        If the pool size for the notebook is more than one a KernelPool is returned.
+        """
         kernel = self.__kernels.get(notebook)
         if kernel:
             return kernel
 
-        auth = self.__get_authenticator()
-        kernel = Kernel(self.__url, authenticator=auth)
-        await kernel.start()
+        # Only start one kernel for a notebook if this is called again while it's starting
+        task = self.__starting_kernels.get(notebook)
+        if task is None:
+            loop = asyncio.get_event_loop()
+            task = self.__starting_kernels[notebook] = loop.create_task(self.__start_kernel(notebook))
+
+            def on_done(t):
+                if self.__starting_kernels.get(notebook) is t:
+                    del self.__starting_kernels[notebook]
+            task.add_done_callback(on_done)
+
+        return await asyncio.shield(task)
+
+    async def __start_kernel(self, notebook):
+        self.__start_metrics_tasks()
+        kernel = self.__new_kernel(notebook)
+        try:
+            await kernel.start()
+        except BaseException:
+            await self.__shutdown_kernel(kernel)
+            raise
+
         self.__kernels[notebook] = kernel
         return kernel
 
+    def __new_kernel(self, notebook):
+        """Create a Kernel, or a KernelPool if the pool size for the notebook is more than one."""
+        pool_size = self.__pool_sizes.get(notebook, self.__pool_size)
+        if pool_size > 1:
+            return KernelPool([self.__create_kernel() for i in range(pool_size)])
+        return self.__create_kernel()
+
+    def __create_kernel(self, session_id=None):
+        auth = self.__get_authenticator()
+        return Kernel(self.__url,
+                      authenticator=auth,
+                      http_session=self.__get_http_session,
+                      batch_window=self.__batch_window,
+                      max_batch_size=self.__max_batch_size,
+                      binary_buffers=self.__binary_buffers,
+                      reconnect_delay=self.__reconnect_delay,
+                      reconnect_max_delay=self.__reconnect_max_delay,
+                      reconnect_max_attempts=self.__reconnect_max_attempts,
+                      kernel_check_interval=self.__kernel_check_interval,
+                      execution_mode=self.__execution_mode,
+                      chunk_size=self.__chunk_size,
+                      json_backend=self.__json_backend,
+                      handler_concurrency=self.__handler_concurrency,
+                      handler_queue_size=self.__handler_queue_size,
+                      handler_queue_warning=self.__handler_queue_warning,
+                      call_timeout=self.__call_timeout,
+                      use_rpc_comm=self.__use_rpc_comm,
+                      session_id=session_id,
+                      compression_threshold=self.__compression_threshold,
+                      compression_level=self.__compression_level,
+                      websocket_compression=self.__websocket_compression,
+                      out_of_band_threshold=self.__out_of_band_threshold,
+                      rtd_interval=self.__rtd_interval)
+
+    async def get_server_cache_stats(self):
+        """Return a list of (notebook, kernel id, stats) for the server cache in each kernel."""
+        results = []
+        for notebook, kernel in list(self.__kernels.items()):
+            for k in kernel.kernels:
+                stats = await k.get_server_cache_stats()
+                results.append((notebook, k.id, stats))
+        return results
+
     async def get_notebooks(self):
         """Return a list of available notebooks from the notebook server"""
         auth = self.__get_authenticator()
@@ -85,24 +594,68 @@ class KernelManager:
             await auth.authenticate()
 
         url = self.__url + "/api/contents"
-        async with aiohttp.ClientSession(cookie_jar=auth.cookie_jar) as session:
-            async with session.get(url, headers=auth.headers) as response:
-                try:
-                    await response.read()
-                    response.raise_for_status()
-                    contents = await response.json()
-                except Exception:
-                    auth.reset()
-                    raise
+        session = self.__get_http_session()
+        async with session.get(url, headers=auth.headers) as response:
+            try:
+                await response.read()
+                response.raise_for_status()
+                contents = await response.json()
+            except Exception:
+                auth.reset()
+                raise
 
-                return [x["path"] for x in contents["content"] if x.get("type") == "notebook"]
+            return [x["path"] for x in contents["content"] if x.get("type") == "notebook"]
+
+    async def __get_notebook_last_modified(self, notebook):
+        """Return the last modified time of a notebook from the notebook server."""
+        auth = self.__get_authenticator()
+        if not auth.authenticated:
+            await auth.authenticate()
+
+        url = self.__url + "/api/contents/" + notebook + "?content=0"
+        session = self.__get_http_session()
+        async with session.get(url, headers=auth.headers) as response:
+            try:
+                await response.read()
+                response.raise_for_status()
+                model = await response.json()
+            except Exception:
+                auth.reset()
+                raise
+
+            return model.get("last_modified")
 
     async def stop_all_kernels(self):
         """Shutdown the remotes kernel"""
+        await self.__stop_all_kernels(keep_running=False)
+
+    async def close_all_kernels(self):
+        """Called when Excel is closing.
+
+        If persistent_sessions is set the kernels are disconnected from but left
+        running so they can be re-attached to next time, otherwise they are shutdown.
+        """
+        await self.__stop_all_kernels(keep_running=self.__persistent_sessions)
+
+    async def __stop_all_kernels(self, keep_running):
         await asyncio.sleep(0)  # make sure we're on the asyncio thread
 
+        if self.__persistent_sessions:
+            self.__save_sessions(self.__kernels if keep_running else {})
+
+        while self.__starting_kernels:
+            notebook, task = self.__starting_kernels.popitem()
+            task.cancel()
+
         tasks = []
         while self.__kernels:
             notebook, kernel = self.__kernels.popitem()
-            tasks.append(kernel.shutdown())
+            tasks.append(kernel.disconnect() if keep_running else kernel.shutdown())
+        while self.__standby_kernels:
+            notebook, standby_tasks = self.__standby_kernels.popitem()
+            tasks.extend(self.__stop_standby_kernel(t) for t in standby_tasks)
         await asyncio.gather(*tasks)
+
+        # close the shared session now there are no kernels using it
+        await self.__close_http_session()
+        self.__set_status("Not running")
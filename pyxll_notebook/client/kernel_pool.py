@@ -0,0 +1,76 @@
+"""
+KernelPool class for running the same notebook in several kernels.
+"""
+import asyncio
+
+
+class KernelPool:
+    """A pool of kernels all running the same notebook.
+
+    Functions are only registered in Excel by the primary kernel. Calls to
+    thread safe functions are sent to whichever kernel has the fewest calls
+    outstanding, and calls to all other functions are sent to the primary kernel.
+    """
+
+    def __init__(self, kernels):
+        if not kernels:
+            raise AssertionError("A KernelPool needs at least one kernel.")
+        self.__kernels = list(kernels)
+        for kernel in self.__kernels:
+            kernel.pool = self
+
+    @property
+    def primary(self):
+        """The kernel that registers functions and runs functions that aren't thread safe."""
+        return self.__kernels[0]
+
+    @property
+    def kernels(self):
+        return list(self.__kernels)
+
+    @property
+    def closed(self):
+        return self.primary.closed
+
+    @property
+    def standby(self):
+        return self.primary.standby
+
+    @standby.setter
+    def standby(self, standby):
+        for kernel in self.__kernels:
+            kernel.standby = standby
+
+    def notebook_last_modified(self, path):
+        return self.primary.notebook_last_modified(path)
+
+    def is_primary(self, kernel):
+        return kernel.id == self.primary.id
+
+    def select_kernel(self, pinned=True):
+        """Return the kernel to send a call to.
+
+        :param pinned: If True the primary kernel is returned, otherwise the
+                       kernel with the fewest outstanding calls.
+        """
+        if pinned:
+            return self.primary
+        return min(self.__kernels, key=lambda k: k.outstanding_calls)
+
+    async def start(self):
+        await asyncio.gather(*[k.start() for k in self.__kernels])
+
+    async def run_notebook(self, path):
+        await asyncio.gather(*[k.run_notebook(path) for k in self.__kernels])
+
+    async def restore_notebook(self, path, last_modified):
+        await asyncio.gather(*[k.restore_notebook(path, last_modified) for k in self.__kernels])
+
+    async def disconnect(self):
+        await asyncio.gather(*[k.disconnect() for k in self.__kernels])
+
+    async def activate(self):
+        await asyncio.gather(*[k.activate() for k in self.__kernels])
+
+    async def shutdown(self):
+        await asyncio.gather(*[k.shutdown() for k in self.__kernels])
@@ -0,0 +1,180 @@
+"""
+Latency and throughput metrics for calls to the remote kernel.
+
+Metrics are collected in a single Metrics instance and can be viewed in
+Excel or written to a file in the Prometheus text format.
+"""
+import threading
+import asyncio
+import bisect
+import math
+import os
+
+# Default histogram bucket upper bounds, in seconds for timings
+_default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Bucket upper bounds for sizes (message bytes and batch sizes)
+size_buckets = tuple(4 ** i for i in range(16))
+
+
+class Histogram:
+    """Counts observations in buckets, for estimating percentiles."""
+
+    def __init__(self, buckets=_default_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Return an estimate of the p'th percentile (0-100), as the upper bound of its bucket."""
+        if not self.count:
+            return 0.0
+        target = math.ceil(self.count * p / 100.0)
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Metrics:
+    """Collection of named histograms, counters and gauges, each with optional labels."""
+
+    _instance = None
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__histograms = {}
+        self.__counters = {}
+        self.__gauges = {}
+
+    @classmethod
+    def instance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    @staticmethod
+    def __key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, buckets=_default_buckets, **labels):
+        """Add an observation to a histogram."""
+        key = self.__key(name, labels)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def add_gauge(self, name, value, **labels):
+        """Add to (or subtract from) a gauge."""
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__gauges[key] = self.__gauges.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self.__key(name, labels)
+        with self.__lock:
+            self.__gauges[key] = value
+
+    def reset(self):
+        """Clear the histograms and counters. Gauges track current values and are kept."""
+        with self.__lock:
+            self.__histograms.clear()
+            self.__counters.clear()
+
+    def table(self):
+        """Return the metrics as a list of rows, with a header row, for displaying in Excel."""
+        rows = [["metric", "labels", "count", "mean", "p50", "p95", "p99", "max"]]
+        with self.__lock:
+            for (name, labels), h in sorted(self.__histograms.items()):
+                rows.append([name, _format_labels(labels), h.count, h.mean,
+                             h.percentile(50), h.percentile(95), h.percentile(99), h.max])
+            for (name, labels), value in sorted(self.__counters.items()):
+                rows.append([name, _format_labels(labels), value, None, None, None, None, None])
+            for (name, labels), value in sorted(self.__gauges.items()):
+                rows.append([name, _format_labels(labels), value, None, None, None, None, None])
+        return rows
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.__lock:
+            for type_, items in (("histogram", self.__histograms),
+                                 ("counter", self.__counters),
+                                 ("gauge", self.__gauges)):
+                seen = set()
+                for (metric, labels), value in sorted(items.items()):
+                    if metric not in seen:
+                        lines.append(f"# TYPE {metric} {type_}")
+                        seen.add(metric)
+                    if type_ != "histogram":
+                        lines.append(f"{metric}{_format_labels(labels, True)} {value}")
+                        continue
+                    total = 0
+                    for bound, count in zip(value.buckets + (math.inf,), value.counts):
+                        total += count
+                        le = "+Inf" if bound == math.inf else repr(float(bound))
+                        bucket_labels = labels + (("le", le),)
+                        lines.append(f"{metric}_bucket{_format_labels(bucket_labels, True)} {total}")
+                    lines.append(f"{metric}_sum{_format_labels(labels, True)} {value.sum}")
+                    lines.append(f"{metric}_count{_format_labels(labels, True)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path):
+        """Write the metrics to a file in the Prometheus text format."""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+
+def _format_labels(labels, prometheus=False):
+    if not labels:
+        return ""
+    if prometheus:
+        escaped = ((k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+    return ", ".join(f"{k}={v}" for k, v in labels)
+
+
+async def monitor_event_loop(interval=1.0):
+    """Measure how late the event loop runs a task scheduled interval seconds in the future.
+
+    Lag here means everything else using the event loop, including all remote calls, is delayed.
+    """
+    metrics = Metrics.instance()
+    loop = asyncio.get_event_loop()
+    while True:
+        start_time = loop.time()
+        await asyncio.sleep(interval)
+        metrics.observe("pyxll_notebook_event_loop_lag_seconds", max(loop.time() - start_time - interval, 0.0))
+
+
+async def write_metrics_file(path, interval=10.0):
+    """Periodically write the metrics to a file in the Prometheus text format."""
+    metrics = Metrics.instance()
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(interval)
+        await loop.run_in_executor(None, metrics.write_prometheus_file, path)
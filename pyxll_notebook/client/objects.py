@@ -0,0 +1,122 @@
+"""
+Tracks the cells holding handles to objects kept in a remote kernel.
+
+Functions using the "object" type return a handle to Excel and the object
+stays in the kernel, owned by the cell that called the function. When that
+cell is recalculated the kernel replaces the object itself. When the cell is
+cleared or overwritten, or its workbook is closed, the kernel is told to
+release the object here using Excel's application events.
+"""
+import pyxll
+import threading
+import asyncio
+import logging
+
+_log = logging.getLogger(__name__)
+
+_tracked_cells = {}
+_tracked_cells_lock = threading.Lock()
+_app_events = None
+
+
+class _TrackedCell:
+    """A cell owning an object in a kernel, and the function that returned it."""
+
+    def __init__(self, address, kernel, xl_name):
+        self.address = address
+        self.kernel = kernel
+        self.xl_name = xl_name
+
+
+class _AppEvents:
+    """Excel.Application event handler used with win32com DispatchWithEvents."""
+
+    def OnSheetChange(self, sheet, target):
+        try:
+            _on_sheet_change(target)
+        except Exception:
+            _log.debug("Error checking for cells that no longer use objects", exc_info=True)
+
+    def OnWorkbookBeforeClose(self, wb, cancel):
+        try:
+            prefix = f"[{wb.Name}]"
+            _release(lambda tracked: prefix in tracked.address)
+        except Exception:
+            _log.debug("Error releasing objects used by a closed workbook", exc_info=True)
+
+
+def get_owner():
+    """Return the owner for an object returned to the calling cell, or None."""
+    try:
+        cell = pyxll.xlfCaller()
+    except Exception:
+        return None
+    if cell is None:
+        return None
+    return cell.address
+
+
+def track_cell(owner, kernel, xl_name):
+    """Remember that the cell owner holds a handle to an object in kernel."""
+    global _app_events
+    with _tracked_cells_lock:
+        _tracked_cells[owner] = _TrackedCell(owner, kernel, xl_name)
+        if _app_events is not None:
+            return
+        _app_events = False
+
+    # Excel's events have to be connected on the main thread
+    pyxll.schedule_call(_connect_app_events)
+
+
+def _connect_app_events():
+    global _app_events
+    try:
+        from win32com.client import DispatchWithEvents
+        _app_events = DispatchWithEvents(pyxll.xl_app(), _AppEvents)
+    except Exception:
+        _log.warning("Unable to watch for cells using objects being cleared. "
+                     "Objects will be kept until their cells are recalculated or the kernel is restarted.",
+                     exc_info=True)
+
+
+def _on_sheet_change(target):
+    xl = pyxll.xl_app()
+    sheet = target.Worksheet
+    sheet_address = f"[{sheet.Parent.Name}]{sheet.Name}!"
+
+    def changed(tracked):
+        if not tracked.address.startswith(sheet_address) and \
+                not tracked.address.startswith(f"'{sheet_address}"):
+            return False
+        address = tracked.address.split("!", 1)[1]
+        cell = sheet.Range(address)
+        if xl.Intersect(cell, target) is None:
+            return False
+        return tracked.xl_name.lower() not in str(cell.Formula).lower()
+
+    _release(changed)
+
+
+def _release(predicate):
+    """Release the objects of tracked cells matching predicate."""
+    released = {}
+    with _tracked_cells_lock:
+        for address, tracked in list(_tracked_cells.items()):
+            if predicate(tracked):
+                del _tracked_cells[address]
+                released.setdefault(tracked.kernel, []).append(address)
+
+    loop = pyxll.get_event_loop()
+    for kernel, owners in released.items():
+        if kernel.closed:
+            continue
+        f = asyncio.run_coroutine_threadsafe(kernel.release_objects(owners), loop)
+        f.add_done_callback(_log_release_error)
+
+
+def _log_release_error(f):
+    try:
+        f.result()
+    except Exception:
+        _log.warning("Error releasing objects in the kernel", exc_info=True)
@@ -22,6 +22,18 @@ def on_load(control):
     global _ribbon
     _ribbon = control
     _init_notebooks()
+    KernelManager.instance().add_status_callback(_on_status_changed)
+
+
+def _on_status_changed(status):
+    # Called on the asyncio event loop thread, so update the ribbon in Excel's main thread
+    if _ribbon:
+        pyxll.schedule_call(_ribbon.InvalidateControl, "pyxll.notebooks.status")
+
+
+def get_status(control):
+    """Returns the label showing the status of the kernels."""
+    return KernelManager.instance().status
 
 
 def start_kernels(*args):
@@ -1,10 +1,17 @@
 """
 Implementation of RTD class to receive updates from the remote RTD instance.
+
+List and array values may be sent as a snapshot followed by deltas of the
+cells that have changed. Each has a sequence number, and if a delta doesn't
+follow on from the last update received a new snapshot is requested.
 """
-from ..errors import ExecuteRequestError
 import pyxll
+import logging
+import asyncio
 import pickle
 
+_log = logging.getLogger(__name__)
+
 _active_rtd_instances = {}
 
 
@@ -15,16 +22,12 @@ class RTD(pyxll.RTD):
         self.__kernel = kernel
         self.__id = id
         self.__pickle_protocol = min(pickle_protocol, pickle.HIGHEST_PROTOCOL)
+        self.__seq = None
+        self.__snapshot_requested = False
         _active_rtd_instances[self.__id] = self
 
     async def connect(self):
-        expr = f"__pyxll_notebook_call_xl_rtd_method('{self.__id}', 'connect')"
-        reply = await self.__kernel.execute('', user_expressions={"result": expr})
-
-        result = reply["user_expressions"]["result"]
-        status = result.get("status")
-        if status != "ok":
-            raise ExecuteRequestError(**result)
+        await self.__kernel.call_xl_rtd_method(self.__id, "connect", protocol=self.__pickle_protocol)
 
     async def disconnect(self):
         try:
@@ -32,13 +35,65 @@ class RTD(pyxll.RTD):
         except KeyError:
             pass
 
-        expr = f"__pyxll_notebook_call_xl_rtd_method('{self.__id}', 'disconnect')"
-        reply = await self.__kernel.execute('', user_expressions={"result": expr})
+        await self.__kernel.call_xl_rtd_method(self.__id, "disconnect", protocol=self.__pickle_protocol)
+
+    def set_snapshot(self, seq, value):
+        """Set the full value, with the sequence number of the update."""
+        self.__seq = seq
+        self.__snapshot_requested = False
+        self.value = value
+
+    def apply_delta(self, seq, base_seq, changes):
+        """Update the value with a list of (row, column, value) changes to the value with sequence number base_seq.
+
+        If the last update received wasn't base_seq a new snapshot is requested.
+        """
+        if self.__seq is None or self.__seq != base_seq:
+            self.__request_snapshot()
+            return
+
+        self.__seq = seq
+        self.value = _patch(self.value, changes)
+
+    def __request_snapshot(self):
+        if self.__snapshot_requested:
+            return
+        self.__snapshot_requested = True
+        _log.debug(f"Missed an update for RTD {self.__id}, requesting a snapshot.")
+
+        async def request_snapshot():
+            try:
+                await self.__kernel.request_rtd_snapshot(self.__id)
+            except Exception:
+                self.__snapshot_requested = False
+                _log.warning(f"Error requesting a snapshot for RTD {self.__id}", exc_info=True)
+
+        asyncio.get_event_loop().create_task(request_snapshot())
 
-        result = reply["user_expressions"]["result"]
-        status = result.get("status")
-        if status != "ok":
-            raise ExecuteRequestError(**result)
+
+def _patch(value, changes):
+    """Return a copy of value with the changes applied. Rows that haven't changed are shared."""
+    if hasattr(value, "shape"):
+        value = value.copy()
+        for i, j, x in changes:
+            if j is None:
+                value[i] = x
+            else:
+                value[i, j] = x
+        return value
+
+    value = list(value)
+    copied = set()
+    for i, j, x in changes:
+        if j is None:
+            value[i] = x
+            copied.add(i)
+            continue
+        if i not in copied:
+            value[i] = list(value[i])
+            copied.add(i)
+        value[i][j] = x
+    return value
 
 
 def create_client_rtd(kernel, server_rtd, pickle_protocol=pickle.HIGHEST_PROTOCOL):
@@ -52,6 +107,18 @@ def xl_rtd_set_value(id, value):
         rtd.value = value
 
 
+def xl_rtd_set_snapshot(id, seq, value):
+    rtd = _active_rtd_instances.get(id)
+    if rtd is not None:
+        rtd.set_snapshot(seq, value)
+
+
+def xl_rtd_apply_delta(id, seq, base_seq, changes):
+    rtd = _active_rtd_instances.get(id)
+    if rtd is not None:
+        rtd.apply_delta(seq, base_seq, changes)
+
+
 def xl_rtd_set_error(id, *args, **kwargs):
     rtd = _active_rtd_instances.get(id)
     if rtd is not None:
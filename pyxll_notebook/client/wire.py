@@ -0,0 +1,66 @@
+"""
+Binary websocket message format used by the Jupyter notebook server.
+
+Messages with buffers are sent as a single binary frame made up of a table
+of offsets, followed by the JSON encoded message and then the raw buffers.
+This avoids having to encode binary data as text inside the message.
+"""
+import struct
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def get_json_loads(backend="auto"):
+    """Return the function used to decode JSON messages.
+
+    :param backend: "json", "orjson", "ujson", or "auto" to use the fastest one installed.
+    """
+    if backend == "auto":
+        backend = "orjson" if orjson else "ujson" if ujson else "json"
+
+    if backend == "orjson" and orjson:
+        return orjson.loads
+    if backend == "ujson" and ujson:
+        return ujson.loads
+    if backend == "json":
+        return json.loads
+
+    raise AssertionError(f"JSON backend '{backend}' is not available.")
+
+
+def serialize_binary_message(msg):
+    """Serialize a message dict with a list of buffers to a binary websocket frame."""
+    msg = dict(msg)
+    buffers = list(msg.pop("buffers", None) or [])
+    buffers.insert(0, json.dumps(msg).encode("utf-8"))
+    nbufs = len(buffers)
+    offsets = [4 * (nbufs + 1)]
+    for buf in buffers[:-1]:
+        offsets.append(offsets[-1] + len(buf))
+    offsets_buf = struct.pack("!" + "I" * (nbufs + 1), nbufs, *offsets)
+    buffers.insert(0, offsets_buf)
+    return b"".join(buffers)
+
+
+def deserialize_binary_message(bmsg, loads=json.loads):
+    """Deserialize a binary websocket frame to a message dict with a list of buffers.
+
+    The buffers are memoryviews into the received frame so they aren't copied.
+    """
+    view = memoryview(bmsg)
+    nbufs = struct.unpack("!i", view[:4])[0]
+    offsets = list(struct.unpack("!" + "I" * nbufs, view[4:4 * (nbufs + 1)]))
+    offsets.append(None)
+    bufs = [view[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+    msg = loads(bytes(bufs[0]))
+    msg["buffers"] = bufs[1:]
+    return msg
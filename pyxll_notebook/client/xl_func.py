@@ -3,21 +3,254 @@ Implementation of @xl_func wrapper to call the function in the remote kernel.
 
 bind_xl_func is called from the Kernel handler in response to a "pyxll.xl_func"
 message from the server.
+
+Functions that have been bound are remembered so they can be registered again
+before their kernel is ready (e.g. when PyXLL is reloaded). Until then they
+return a placeholder value, and the cells that called them are recalculated
+once the kernel is ready.
 """
 import pyxll
 from .rtd import create_client_rtd
+from .metrics import Metrics
+from .cache import LRUCache
+from . import objects
 from ..server.rtd import RTD
-from ..serialization import serialize_args, deserialize_args, deserialize_result
-from ..errors import ExecuteRequestError
+from ..serialization import deserialize_args, dumps, array_types, pack_args
 from functools import wraps
 from itertools import chain
+import concurrent.futures
+import threading
+import logging
+import json
 import pickle
 import asyncio
+import time
+
+_log = logging.getLogger(__name__)
+
+_bound_functions = {}
+_waiting_cells = {}
+_waiting_cells_lock = threading.Lock()
+_loading_value = None
+
+# Time to wait for more functions to be bound before calling pyxll.rebind,
+# and the longest rebinding can be put off for while functions keep being bound.
+_rebind_delay = 0.1
+_rebind_max_delay = 1.0
+_rebind_handle = None
+_rebind_first_time = None
+
+
+class _BoundFunction:
+    """A remote function registered in Excel and the kernel its calls are sent to."""
+
+    def __init__(self, kernel, func_name, kwargs):
+        self.kernel = kernel
+        self.func_name = func_name
+        self.kwargs = kwargs
+        self.key = json.dumps([func_name, kwargs], sort_keys=True)
+        self.wrapper = None
+        self.xl_func_kwargs = None
+
+        # Results of pure functions (or any function with a cache_ttl) are cached,
+        # unless they're handles to objects owned by the calling cell.
+        self.cache = None
+        if (kwargs.get("pure") or kwargs.get("cache_ttl")) and not kwargs.get("returns_object"):
+            self.cache = LRUCache(maxsize=kwargs.get("cache_maxsize") or 1024, ttl=kwargs.get("cache_ttl"))
 
+    @property
+    def ready(self):
+        return self.kernel is not None and not self.kernel.closed
 
-def bind_xl_func(kernel, func_name, **kwargs):
-    """Creates a wrapper function for calling a remote @xl_func function."""
+
+def bind_xl_func(kernel, func_name, rebind=True, **kwargs):
+    """Creates a wrapper function for calling a remote @xl_func function.
+
+    kernel may be a Kernel or a KernelPool. With a KernelPool, calls to thread
+    safe functions are load balanced across the pool's kernels.
+
+    If the function is already registered with the same signature only the
+    kernel it calls is updated. Otherwise it's registered and, if rebind is
+    True, pyxll.rebind is called once no more functions have been bound for
+    a short time. If rebind is False the caller should call rebind itself.
+
+    Returns True if the function was registered, or False if it was already.
+    Must be called on the asyncio event loop thread.
+    """
     xl_name = kwargs.get("name", func_name)
+    bound = _BoundFunction(kernel, func_name, dict(kwargs))
+    existing = _bound_functions.get(xl_name)
+    if existing is not None and existing.key == bound.key:
+        # The notebook has been run again, so cached results may no longer be valid
+        existing.kernel = kernel
+        if existing.cache is not None:
+            existing.cache.clear()
+        return False
+
+    _bound_functions[xl_name] = bound
+    _register_xl_func(xl_name)
+    if rebind:
+        _schedule_rebind()
+
+    # Cells may have called the function while it was registered with a different signature
+    if xl_name in _waiting_cells:
+        recalculate_waiting_cells()
+    return True
+
+
+def rebind():
+    """Update Excel's functions after binding functions with rebind=False."""
+    global _rebind_handle, _rebind_first_time
+    if _rebind_handle is not None:
+        _rebind_handle.cancel()
+    _rebind_handle = None
+    _rebind_first_time = None
+    pyxll.rebind()
+
+
+def _schedule_rebind():
+    global _rebind_handle, _rebind_first_time
+    loop = asyncio.get_event_loop()
+    now = loop.time()
+    if _rebind_first_time is None:
+        _rebind_first_time = now
+    elif now - _rebind_first_time >= _rebind_max_delay:
+        rebind()
+        return
+
+    if _rebind_handle is not None:
+        _rebind_handle.cancel()
+    _rebind_handle = loop.call_later(_rebind_delay, rebind)
+
+
+def register_stub_functions(funcs):
+    """Register functions that aren't bound to a kernel yet, e.g. from a saved manifest.
+
+    funcs is a list of registration details as returned by get_bound_functions.
+    The functions return a placeholder value until they're bound to a kernel.
+    """
+    registered = False
+    for content in funcs:
+        kwargs = dict(content)
+        func_name = kwargs.pop("func")
+        xl_name = kwargs.get("name", func_name)
+        if xl_name in _bound_functions:
+            continue
+        _bound_functions[xl_name] = _BoundFunction(None, func_name, kwargs)
+        _register_xl_func(xl_name)
+        registered = True
+
+    if registered:
+        pyxll.rebind()
+
+
+def unbind_stub_functions(xl_names):
+    """Remove functions registered by register_stub_functions that haven't been bound to a kernel.
+
+    Calls to the functions then raise an error, as they can't be unregistered from Excel.
+    """
+    unbound = []
+    for xl_name in xl_names:
+        bound = _bound_functions.get(xl_name)
+        if bound is not None and bound.kernel is None:
+            del _bound_functions[xl_name]
+            unbound.append(xl_name)
+
+    cells = []
+    with _waiting_cells_lock:
+        for xl_name in unbound:
+            cells.extend(_waiting_cells.pop(xl_name, []))
+
+    if cells:
+        pyxll.schedule_call(_recalculate, cells)
+
+
+def get_bound_functions(kernel):
+    """Return the registration details of the functions bound to a kernel (or KernelPool)."""
+    return [dict(b.kwargs, func=b.func_name) for b in _bound_functions.values() if b.kernel is kernel]
+
+
+def register_known_functions():
+    """Register all functions that have been bound before, without waiting for their kernels.
+
+    Calls to functions whose kernel isn't ready return a placeholder value
+    until recalculate_waiting_cells is called.
+    """
+    for xl_name in list(_bound_functions):
+        _register_xl_func(xl_name)
+    if _bound_functions:
+        pyxll.rebind()
+
+
+def recalculate_waiting_cells():
+    """Recalculate cells that returned the placeholder value and whose functions are now ready."""
+    cells = []
+    with _waiting_cells_lock:
+        for xl_name in list(_waiting_cells):
+            bound = _bound_functions.get(xl_name)
+            if bound is not None and bound.ready:
+                cells.extend(_waiting_cells.pop(xl_name))
+
+    if cells:
+        pyxll.schedule_call(_recalculate, cells)
+
+
+def _recalculate(cells):
+    xl = pyxll.xl_app()
+    try:
+        for cell in cells:
+            cell.to_range().Dirty()
+        xl.Calculate()
+    except Exception:
+        _log.debug("Unable to recalculate waiting cells, recalculating all workbooks.", exc_info=True)
+        xl.CalculateFull()
+
+
+def _get_loading_value():
+    global _loading_value
+    if _loading_value is None:
+        cfg = pyxll.get_config()
+        _loading_value = cfg.get("NOTEBOOK", "loading_value", fallback="#LOADING")
+    return _loading_value
+
+
+def _loading(xl_name):
+    """Return the placeholder value, and remember the calling cell to recalculate later."""
+    try:
+        cell = pyxll.xlfCaller()
+    except Exception:
+        cell = None
+
+    if cell is not None:
+        with _waiting_cells_lock:
+            _waiting_cells.setdefault(xl_name, []).append(cell)
+
+    return _get_loading_value()
+
+
+def _register_xl_func(xl_name):
+    """Register a wrapper function in Excel for a bound function."""
+    bound = _bound_functions[xl_name]
+    if bound.wrapper is None:
+        bound.wrapper, bound.xl_func_kwargs = _create_wrapper(xl_name, bound.func_name, dict(bound.kwargs))
+    pyxll.xl_func(**bound.xl_func_kwargs)(bound.wrapper)
+
+
+def _create_wrapper(xl_name, func_name, kwargs):
+    """Return a wrapper function that calls the remote function, and the kwargs to register it with."""
+    retry = not kwargs.get("macro")
+    pinned = not kwargs.get("thread_safe") or bool(kwargs.get("macro"))
+    timeout = kwargs.pop("timeout", None)
+    for key in ("pure", "cache_ttl", "cache_maxsize"):
+        kwargs.pop(key, None)
+
+    # Objects are kept in the kernel that created them, so calls using them go to the primary kernel
+    object_args = kwargs.pop("object_args", False)
+    returns_object = kwargs.pop("returns_object", False)
+    pinned = pinned or object_args or returns_object
+
+    # numpy arrays passed for array types are sent as typed buffers
+    arg_array_types = array_types(kwargs.get("signature"))[0]
     args = kwargs.pop("args", None) or []
     varargs = kwargs.pop("varargs", None)
     pickle_protocol = min(kwargs.pop("pickle_protocol", pickle.HIGHEST_PROTOCOL), pickle.HIGHEST_PROTOCOL)
@@ -46,27 +279,75 @@ def bind_xl_func(kernel, func_name, **kwargs):
 
     @wraps(dummy_func)
     def wrapper_function(*args):
-        async def call_remote_function(args):
-            args = serialize_args(args, protocol=pickle_protocol)
-            expr = f"__pyxll_notebook_call_xl_func('{xl_name}', '{args}', protocol={pickle.HIGHEST_PROTOCOL})"
-            reply = await kernel.execute('', user_expressions={"result": expr})
+        # The kernel is looked up for each call as the function may have been re-bound
+        bound = _bound_functions.get(xl_name)
+        if bound is None:
+            raise RuntimeError(f"{xl_name} is no longer registered by any notebook.")
+        if not bound.ready:
+            return _loading(xl_name)
+        kernel = bound.kernel
+
+        metrics = Metrics.instance()
+        metrics.inc("pyxll_notebook_calls_total", function=xl_name)
 
-            result = reply["user_expressions"]["result"]
-            status = result.get("status")
-            if status != "ok":
-                raise ExecuteRequestError(**result)
+        cache = bound.cache
+        cache_key = None
+        if cache is not None:
+            try:
+                cache_key = dumps(args, protocol=pickle_protocol)
+            except Exception:
+                _log.debug(f"Arguments to {xl_name} can't be used as a cache key", exc_info=True)
 
-            data = result["data"]["text/plain"]
-            result = deserialize_result(data)
+            if cache_key is not None:
+                result = cache.get(cache_key)
+                if result is not LRUCache.missing:
+                    metrics.inc("pyxll_notebook_cache_hits_total", function=xl_name)
+                    return result
+                metrics.inc("pyxll_notebook_cache_misses_total", function=xl_name)
+
+        owner = objects.get_owner() if returns_object else None
+        submit_time = time.perf_counter()
+        packed_args = pack_args(args, arg_array_types)
+
+        async def call_remote_function(args):
+            # Time spent waiting for the event loop to run this call
+            metrics.observe("pyxll_notebook_call_seconds", time.perf_counter() - submit_time,
+                            stage="loop_wait", function=xl_name)
+            target = kernel.select_kernel(pinned)
+            result = await target.call_xl_func(xl_name,
+                                               args,
+                                               protocol=pickle_protocol,
+                                               retry=retry,
+                                               timeout=timeout,
+                                               owner=owner)
+            if owner is not None:
+                objects.track_cell(owner, target, xl_name)
             if isinstance(result, RTD):
-                result = create_client_rtd(kernel, result, pickle_protocol)
+                result = create_client_rtd(target, result, pickle_protocol)
             return result
 
         loop = pyxll.get_event_loop()
-        f = asyncio.run_coroutine_threadsafe(call_remote_function(args), loop)
-        return f.result()
+        f = asyncio.run_coroutine_threadsafe(call_remote_function(packed_args), loop)
 
-    wrapper_function.__name__ = func_name
+        # Wait in short intervals so that if the function is aborted by pressing Esc
+        # in Excel the KeyboardInterrupt is raised here, and the remote call is cancelled.
+        try:
+            while True:
+                try:
+                    result = f.result(timeout=0.1)
+                    break
+                except concurrent.futures.TimeoutError:
+                    continue
+                except KeyboardInterrupt:
+                    f.cancel()
+                    raise
+        finally:
+            metrics.observe("pyxll_notebook_call_seconds", time.perf_counter() - submit_time,
+                            stage="total", function=xl_name)
 
-    pyxll.xl_func(**kwargs)(wrapper_function)
-    pyxll.rebind()
+        if cache_key is not None and not isinstance(result, pyxll.RTD):
+            cache.set(cache_key, result)
+        return result
+
+    wrapper_function.__name__ = func_name
+    return wrapper_function, kwargs
@@ -16,3 +16,15 @@ class ExecuteRequestError(RuntimeError):
 
 class AuthenticationError(RuntimeError):
     pass
+
+
+class KernelConnectionError(RuntimeError):
+    pass
+
+
+class KernelRestartedError(KernelConnectionError):
+    pass
+
+
+class ExecuteTimeoutError(RuntimeError):
+    pass
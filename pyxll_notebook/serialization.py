@@ -3,18 +3,63 @@ Serialization for sending arguments and results between the client (Excel)
 and server (IPyKernel).
 
 Args and results are serialized to strings so that they can be used
-in code snippets and passed around easily.
+in code snippets and passed around easily, or to bytes when they are
+sent as binary message buffers.
+
+numpy arrays for arguments and return types like float[][] or numpy_array
+are packed into a NumericArray before pickling so they're sent as a single
+typed buffer. They're unpacked as numpy arrays, or as lists for the list
+types so that the other side doesn't need numpy.
+
+Serialized data larger than the compression threshold is compressed with
+zlib and prefixed with COMPRESSED_PREFIX. Compression is only used once the
+client and server have both enabled it (see set_compression), but compressed
+data is always recognized when it's deserialized.
+
+With pickle protocol 5, dumps_buffers sends the data of large numpy arrays
+out-of-band as separate binary message buffers next to the pickle stream,
+instead of copying it into it. bytes and bytearray values are always pickled
+in-band.
 """
 import pickle
 import base64
+import array
+import zlib
+import sys
 
 try:
     from ipykernel.kernelapp import IPKernelApp
 except ImportError:
     IPKernelApp = None
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 _default_pickle_protocol = None
 
+# Pickled data never starts with a null byte
+COMPRESSED_PREFIX = b"\x00Z"
+
+_compression_threshold = 0
+_compression_level = 6
+
+# Minimum size in bytes of buffers sent out-of-band, or 0 to disable
+_out_of_band_threshold = 0
+
+# xl_func types that numpy arrays are sent as NumericArrays for, and whether
+# they're unpacked as numpy arrays or lists.
+_array_types = {
+    "float[]": "list",
+    "float[][]": "list",
+    "int[]": "list",
+    "int[][]": "list",
+    "numpy_array": "numpy",
+    "numpy_row": "numpy",
+    "numpy_column": "numpy",
+}
+
 
 def _get_default_pickle_protocol():
     """Return the highest pickle prootocol supported by both server and client."""
@@ -33,11 +78,103 @@ def _get_default_pickle_protocol():
     return _default_pickle_protocol
 
 
-def serialize_args(args, protocol=None):
-    """serialize a tuple of args to an escaped string"""
+def set_compression(threshold, level=6):
+    """Compress serialized data larger than threshold bytes, or disable compression if threshold is 0."""
+    global _compression_threshold, _compression_level
+    _compression_threshold = max(int(threshold or 0), 0)
+    _compression_level = level
+
+
+def compress(data, threshold=None, level=None):
+    """Return data compressed if it's larger than the threshold, or unchanged otherwise.
+
+    threshold and level default to the values set by set_compression.
+    """
+    if threshold is None:
+        threshold = _compression_threshold
+    if level is None:
+        level = _compression_level
+    if not threshold or len(data) <= threshold:
+        return data
+    compressed = COMPRESSED_PREFIX + zlib.compress(bytes(data), level)
+    return compressed if len(compressed) < len(data) else data
+
+
+def decompress(data):
+    """Return data decompressed if it was compressed by compress, or unchanged otherwise."""
+    if bytes(data[:len(COMPRESSED_PREFIX)]) == COMPRESSED_PREFIX:
+        return zlib.decompress(bytes(data[len(COMPRESSED_PREFIX):]))
+    return data
+
+
+def dumps(obj, protocol=None, compression_threshold=None):
+    """serialize an object to bytes, compressed if larger than the compression threshold"""
+    if protocol is None:
+        protocol = _get_default_pickle_protocol()
+    return compress(pickle.dumps(obj, protocol=protocol), compression_threshold)
+
+
+def loads(data):
+    """deserialize an object from bytes (or any bytes-like object)"""
+    return pickle.loads(decompress(data))
+
+
+def set_out_of_band_buffers(threshold):
+    """Send buffers of at least threshold bytes out-of-band with dumps_buffers, or disable it if threshold is 0."""
+    global _out_of_band_threshold
+    _out_of_band_threshold = max(int(threshold or 0), 0)
+
+
+def dumps_buffers(obj, protocol=None, compression_threshold=None, out_of_band_threshold=None):
+    """serialize an object to a list of buffers, to send as binary message buffers.
+
+    The first buffer is the pickle stream (compressed as with dumps) and is
+    followed by any buffers of at least out_of_band_threshold bytes that were
+    pickled out-of-band. These are views of the data of numpy arrays and
+    NumericArrays, which pickle exposes as PickleBuffers. Buffers are only sent
+    out-of-band with pickle protocol 5 or later.
+    """
     if protocol is None:
         protocol = _get_default_pickle_protocol()
-    data = pickle.dumps(args, protocol=protocol)
+    if out_of_band_threshold is None:
+        out_of_band_threshold = _out_of_band_threshold
+    if protocol < 5 or not out_of_band_threshold:
+        return [dumps(obj, protocol=protocol, compression_threshold=compression_threshold)]
+
+    buffers = []
+
+    def buffer_callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            return True
+        if raw.nbytes < out_of_band_threshold:
+            return True
+        buffers.append(raw)
+        return False
+
+    data = pickle.dumps(obj, protocol=protocol, buffer_callback=buffer_callback)
+    return [compress(data, compression_threshold)] + buffers
+
+
+def loads_buffers(buffers, writable=False):
+    """deserialize an object from a list of buffers returned by dumps_buffers.
+
+    numpy arrays are rebuilt as views of the out-of-band buffers without
+    copying them, so they're read-only if the buffers are. If writable is True
+    each out-of-band buffer is copied once into a bytearray first.
+    """
+    if len(buffers) == 1:
+        return loads(buffers[0])
+    out_of_band = buffers[1:]
+    if writable:
+        out_of_band = [bytearray(b) for b in out_of_band]
+    return pickle.loads(decompress(buffers[0]), buffers=out_of_band)
+
+
+def serialize_args(args, protocol=None, compression_threshold=None):
+    """serialize a tuple of args to an escaped string"""
+    data = dumps(args, protocol=protocol, compression_threshold=compression_threshold)
     encoded = base64.b64encode(data).decode()
     if not isinstance(encoded, str):
         encoded = str(encoded)
@@ -46,14 +183,12 @@ def serialize_args(args, protocol=None):
 
 def deserialize_args(args):
     data = base64.b64decode(args)
-    return pickle.loads(data)
+    return loads(data)
 
 
 def serialize_result(result, protocol=None):
     """serialize result from a Python function to send to the client"""
-    if protocol is None:
-        protocol = _get_default_pickle_protocol()
-    data = pickle.dumps(result, protocol=protocol)
+    data = dumps(result, protocol=protocol)
     encoded = base64.b64encode(data).decode()
     if not isinstance(encoded, str):
         encoded = str(encoded)
@@ -62,4 +197,125 @@ def serialize_result(result, protocol=None):
 
 def deserialize_result(result):
     data = base64.b64decode(result)
-    return pickle.loads(data)
+    return loads(data)
+
+
+class NumericArray(object):
+    """A 1d or 2d numpy array, pickled as its dtype, shape and raw bytes.
+
+    It's unpickled as a numpy array, or as a list (of lists) if as_list is
+    set or numpy isn't available, without converting each element in Python.
+    """
+
+    def __init__(self, dtype, shape, data, as_list=False):
+        self.dtype = dtype
+        self.shape = shape
+        self.data = data
+        self.as_list = as_list
+
+    def __reduce_ex__(self, protocol):
+        # With protocol 5 the data can be sent out-of-band by dumps_buffers, and
+        # is otherwise unpickled as a bytearray if it's writable.
+        if protocol >= 5 and hasattr(pickle, "PickleBuffer"):
+            data = pickle.PickleBuffer(self.data)
+        else:
+            data = bytearray(self.data)
+        return _unpack_array, (self.dtype, self.shape, data, self.as_list)
+
+
+def _unpack_array(dtype, shape, data, as_list):
+    if not as_list and numpy is not None:
+        # A view of the data, which is read-only if the data is
+        return numpy.frombuffer(data, dtype=numpy.dtype(dtype)).reshape(shape)
+
+    values = array.array(_get_array_typecode(dtype))
+    if hasattr(values, "frombytes"):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if (dtype[0] == "<" and sys.byteorder == "big") or (dtype[0] == ">" and sys.byteorder == "little"):
+        values.byteswap()
+    values = values.tolist()
+
+    if len(shape) == 1:
+        return values
+    rows, columns = shape
+    return [values[i * columns:(i + 1) * columns] for i in range(rows)]
+
+
+def _get_array_typecode(dtype):
+    """Return the array typecode for a numpy dtype string, e.g. '<f8'."""
+    kind, size = dtype[1], int(dtype[2:])
+    for typecode in {"f": "fd", "i": "bhilq", "u": "BHILQ"}.get(kind, ""):
+        try:
+            if array.array(typecode).itemsize == size:
+                return typecode
+        except ValueError:
+            continue
+    raise TypeError("Unsupported array dtype '%s'" % dtype)
+
+
+def pack_array(value, as_list=False):
+    """Return value as a NumericArray if it's a 1d or 2d numeric numpy array, or value unchanged otherwise.
+
+    Lists are left unchanged as pickle already handles lists of numbers
+    efficiently, and copying them into a typed buffer first is slower.
+    """
+    if numpy is None or not isinstance(value, numpy.ndarray):
+        return value
+    if value.ndim not in (1, 2) or value.dtype.kind not in "fiu":
+        return value
+    value = numpy.ascontiguousarray(value)
+    return NumericArray(value.dtype.str, value.shape, memoryview(value).cast("B"), as_list=as_list)
+
+
+def _split_types(types):
+    """Split a comma separated list of types, ignoring commas inside <...>."""
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(types):
+        if c == "<":
+            depth += 1
+        elif c == ">":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(types[start:i])
+            start = i + 1
+    parts.append(types[start:])
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _array_type(type_str):
+    return _array_types.get(type_str.split("<")[0].strip())
+
+
+def array_types(signature):
+    """Return the array types for the args and return type of an xl_func signature.
+
+    Returns (arg_types, return_type) where each is "numpy", "list", or None
+    for types that numpy arrays are not sent as NumericArrays for.
+    """
+    if not signature:
+        return [], None
+    args, _, return_type = signature.rpartition(":") if ":" in signature else (signature, None, "")
+    if "(" in args:
+        args = args[args.index("(") + 1:args.rindex(")")]
+
+    # Each arg is "type name"
+    arg_types = [_array_type(a.rsplit(None, 1)[0]) if len(a.split()) > 1 else None
+                 for a in _split_types(args)]
+    return arg_types, _array_type(return_type)
+
+
+def pack_result(result, array_type):
+    """Pack a result for the return array type (as returned by array_types)."""
+    if array_type is None:
+        return result
+    return pack_array(result, as_list=array_type == "list")
+
+
+def pack_args(args, array_types):
+    """Pack args for their array types (as returned by array_types)."""
+    if not any(array_types):
+        return args
+    packed = [pack_array(a, as_list=t == "list") if t else a for a, t in zip(args, array_types)]
+    return tuple(packed) + tuple(args[len(array_types):])
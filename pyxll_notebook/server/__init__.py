@@ -3,10 +3,19 @@ Equivalent functions to the main pyxll module, but that work with a remote
 Excel client instead of running in-process.
 """
 from .xl_func import xl_func
-from .rtd import RTD
+from .rtd import RTD, set_rtd_interval
+from .cache import invalidate_cache, set_cache_size, cache_stats
+from .objects import get_object, clear_objects, set_max_unowned_objects
 
 
 __all__ = [
     "xl_func",
-    "RTD"
+    "RTD",
+    "set_rtd_interval",
+    "invalidate_cache",
+    "set_cache_size",
+    "cache_stats",
+    "get_object",
+    "clear_objects",
+    "set_max_unowned_objects"
 ]
@@ -0,0 +1,149 @@
+"""
+Cache for the results of remote functions in the kernel.
+
+Functions registered with xl_func(server_cache=True) have their results cached
+in the kernel, keyed by the function name and pickled arguments, so that the
+same results requested by different cells or Excel sessions are only computed
+once. Results are stored pickled and the least recently used are evicted when
+the cache is larger than its maximum size in bytes.
+"""
+from .session import register_server_function
+from .rpc import rpc_method
+from ..serialization import serialize_result
+from collections import OrderedDict
+import threading
+import pickle
+
+_default_max_bytes = 256 * 1024 * 1024
+
+
+class ResultCache(object):
+    """Memory bounded least recently used cache of pickled results."""
+
+    def __init__(self, max_bytes=_default_max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()
+        self.__bytes = 0
+
+    def call(self, func_name, func, args, tags=()):
+        """Return func(*args) from the cache, or call it and cache the result."""
+        try:
+            key = (func_name, pickle.dumps(args, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return func(*args)
+
+        with self.__lock:
+            entry = self.__entries.pop(key, None)
+            if entry is not None:
+                self.__entries[key] = entry
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if entry is not None:
+            return pickle.loads(entry[0])
+
+        result = func(*args)
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return result
+
+        if len(data) <= self.max_bytes:
+            with self.__lock:
+                old = self.__entries.pop(key, None)
+                if old is not None:
+                    self.__bytes -= len(old[0])
+                self.__entries[key] = (data, frozenset(tags or ()))
+                self.__bytes += len(data)
+                self.__evict()
+
+        return result
+
+    def __evict(self):
+        while self.__bytes > self.max_bytes and self.__entries:
+            key, (data, tags) = self.__entries.popitem(last=False)
+            self.__bytes -= len(data)
+            self.evictions += 1
+
+    def invalidate(self, func_name=None, tag=None):
+        """Remove entries for a function and/or with a tag, or all entries if neither is set."""
+        with self.__lock:
+            for key, (data, tags) in list(self.__entries.items()):
+                if func_name is not None and key[0] != func_name:
+                    continue
+                if tag is not None and tag not in tags:
+                    continue
+                del self.__entries[key]
+                self.__bytes -= len(data)
+
+    def resize(self, max_bytes):
+        with self.__lock:
+            self.max_bytes = max_bytes
+            self.__evict()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+_cache = ResultCache()
+
+
+def get_cache():
+    """Return the ResultCache used for functions registered with server_cache=True."""
+    return _cache
+
+
+def invalidate_cache(func=None, tag=None):
+    """Remove cached results.
+
+    Call this when the data used by cached functions changes.
+
+    :param func: Function (or the name it's registered in Excel with) to remove results for.
+    :param tag: Remove results for functions registered with this tag in cache_tags.
+
+    If neither func or tag are set all cached results are removed.
+    """
+    if func is None or isinstance(func, str):
+        _cache.invalidate(func_name=func, tag=tag)
+        return
+
+    # Find the name(s) the function is registered with
+    from .xl_func import _registered_xl_funcs
+    names = [name for name, f in _registered_xl_funcs.items() if f is func] or [func.__name__]
+    for name in names:
+        _cache.invalidate(func_name=name, tag=tag)
+
+
+def set_cache_size(max_bytes):
+    """Set the maximum size of the server cache in bytes."""
+    _cache.resize(max_bytes)
+
+
+def cache_stats():
+    """Return a dict of statistics about the server cache."""
+    return _cache.stats()
+
+
+@rpc_method("cache_stats")
+def _rpc_cache_stats(data, buffers):
+    """Called from the client over the RPC comm to get the server cache statistics."""
+    return {"stats": _cache.stats()}, None
+
+
+@register_server_function("__pyxll_notebook_cache_stats")
+def _cache_stats(protocol=pickle.HIGHEST_PROTOCOL):
+    """Called from the client to get the server cache statistics."""
+    return serialize_result(_cache.stats(), protocol=min(protocol, pickle.HIGHEST_PROTOCOL))
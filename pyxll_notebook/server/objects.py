@@ -0,0 +1,208 @@
+"""
+Object handles for keeping objects in the kernel instead of sending them to Excel.
+
+Functions registered with xl_func using the "object" type in their signature
+return a handle string to Excel instead of the object itself. The object is
+kept in the kernel until the cell that returned it is recalculated, cleared or
+overwritten, and handles passed back as arguments are replaced by the objects
+they refer to before the function is called.
+"""
+from .session import register_server_function
+from .rpc import rpc_method
+from ..serialization import _split_types
+from collections import OrderedDict
+import threading
+import uuid
+import re
+
+_handle_re = re.compile(r"^<[\w.]+ [0-9a-f]{12}>$")
+_object_type_re = re.compile(r"\bobject\b")
+
+
+def _split_signature(signature):
+    """Split an xl_func signature into (prefix, [(type, name)], suffix, return_type).
+
+    Args without a type have a type of None. prefix and suffix are the
+    function name and parentheses if the signature includes them, and
+    suffix includes the ":" before the return type.
+    """
+    args, sep, return_type = signature.rpartition(":") if ":" in signature else (signature, "", "")
+    prefix, suffix = "", sep
+    if "(" in args:
+        start, end = args.index("(") + 1, args.rindex(")")
+        prefix, args, suffix = args[:start], args[start:end], args[end:] + sep
+
+    # Each arg is "type name"
+    typed_args = []
+    for arg in _split_types(args):
+        parts = arg.rsplit(None, 1)
+        typed_args.append((parts[0], parts[1]) if len(parts) > 1 else (None, arg))
+    return prefix, typed_args, suffix, return_type
+
+
+def _is_object_type(type_str):
+    return type_str is not None and bool(_object_type_re.search(type_str))
+
+
+def uses_objects(signature):
+    """Return (object_args, returns_object) for an xl_func signature."""
+    if not signature:
+        return False, False
+    _, args, _, return_type = _split_signature(signature)
+    return any(_is_object_type(t) for t, _ in args), _is_object_type(return_type)
+
+
+def client_signature(signature):
+    """Return the signature to register in Excel, with object types replaced by str for the handles."""
+    object_args, returns_object = uses_objects(signature)
+    if not object_args and not returns_object:
+        return signature
+
+    prefix, args, suffix, return_type = _split_signature(signature)
+    args = [name if t is None else "%s %s" % (_object_type_re.sub("str", t), name) for t, name in args]
+    return prefix + ", ".join(args) + suffix + _object_type_re.sub("str", return_type)
+
+
+class ObjectCache(object):
+    """Objects referred to by handles, and the cells (owners) using them.
+
+    Objects added without an owner (e.g. returned to a macro rather than a
+    cell) can't be released by the client, so only the max_unowned most
+    recently used of them are kept.
+    """
+
+    def __init__(self, max_unowned=100):
+        self.__lock = threading.Lock()
+        self.__objects = {}
+        self.__owners = {}
+        self.__handles_by_owner = {}
+        self.__handles_by_id = {}
+        self.__unowned = OrderedDict()
+        self.__max_unowned = max_unowned
+
+    def __len__(self):
+        return len(self.__objects)
+
+    def add(self, obj, owner=None):
+        """Add an object and return its handle.
+
+        If owner is set the object is kept until the owner is released or adds
+        another object. Objects added without an owner are kept until cleared,
+        or until max_unowned more recently used objects have been added without one.
+        """
+        with self.__lock:
+            handle = self.__handles_by_id.get(id(obj))
+            if handle is None or self.__objects.get(handle) is not obj:
+                handle = "<%s %s>" % (type(obj).__name__, uuid.uuid4().hex[:12])
+                self.__objects[handle] = obj
+                self.__owners[handle] = set()
+                self.__handles_by_id[id(obj)] = handle
+
+            if self.__handles_by_owner.get(owner) != handle:
+                self.__release(owner)
+            self.__owners[handle].add(owner)
+            if owner is not None:
+                self.__handles_by_owner[owner] = handle
+            else:
+                self.__unowned[handle] = None
+                self.__unowned.move_to_end(handle)
+                self.__evict_unowned()
+
+            return handle
+
+    def get(self, handle):
+        """Return the object for a handle, or raise a KeyError."""
+        with self.__lock:
+            obj = self.__objects[handle]
+            if handle in self.__unowned:
+                self.__unowned.move_to_end(handle)
+            return obj
+
+    def resize(self, max_unowned):
+        """Set the number of objects without an owner that are kept."""
+        with self.__lock:
+            self.__max_unowned = max(int(max_unowned), 0)
+            self.__evict_unowned()
+
+    def __evict_unowned(self):
+        while len(self.__unowned) > self.__max_unowned:
+            handle, _ = self.__unowned.popitem(last=False)
+            owners = self.__owners[handle]
+            owners.discard(None)
+            if not owners:
+                self.__remove(handle)
+
+    def resolve(self, value):
+        """Return the object for value if it's a handle, or value otherwise."""
+        if isinstance(value, (str, type(u""))) and _handle_re.match(value):
+            try:
+                return self.get(value)
+            except KeyError:
+                raise KeyError("Object '%s' not found. The kernel may have been restarted." % value)
+        return value
+
+    def release(self, owners):
+        """Release the objects used by a list of owners."""
+        with self.__lock:
+            for owner in owners:
+                self.__release(owner)
+
+    def __release(self, owner):
+        if owner is None:
+            return
+        handle = self.__handles_by_owner.pop(owner, None)
+        if handle is None:
+            return
+        owners = self.__owners.get(handle)
+        owners.discard(owner)
+        if not owners:
+            self.__remove(handle)
+
+    def __remove(self, handle):
+        obj = self.__objects.pop(handle)
+        del self.__owners[handle]
+        self.__handles_by_id.pop(id(obj), None)
+
+    def clear(self):
+        with self.__lock:
+            self.__objects.clear()
+            self.__owners.clear()
+            self.__handles_by_owner.clear()
+            self.__handles_by_id.clear()
+            self.__unowned.clear()
+
+
+_objects = ObjectCache()
+
+
+def get_objects():
+    """Return the ObjectCache holding the objects returned to Excel as handles."""
+    return _objects
+
+
+def get_object(handle):
+    """Return the object for a handle returned to Excel."""
+    return _objects.get(handle)
+
+
+def clear_objects():
+    """Remove all objects returned to Excel as handles."""
+    _objects.clear()
+
+
+def set_max_unowned_objects(count):
+    """Set how many objects returned without a calling cell (e.g. to a macro) are kept."""
+    _objects.resize(count)
+
+
+@rpc_method("release_objects")
+def _rpc_release_objects(data, buffers):
+    """Called from the client over the RPC comm when cells using objects have been cleared."""
+    _objects.release(data.get("owners", []))
+    return None, None
+
+
+@register_server_function("__pyxll_notebook_release_objects")
+def _release_objects(owners):
+    """Called from the client when cells using objects have been cleared."""
+    _objects.release(owners)
@@ -0,0 +1,99 @@
+"""
+Comm target used by the client to call functions in the kernel.
+
+Calls are sent as comm messages and handled directly rather than going
+through IPython's code execution, and replies are sent back on the same comm.
+"""
+from .session import register_server_function
+import traceback
+import logging
+import sys
+
+try:
+    from ipykernel.kernelapp import IPKernelApp
+except ImportError:
+    IPKernelApp = None
+
+try:
+    from comm import get_comm_manager
+except ImportError:
+    get_comm_manager = None
+
+_log = logging.getLogger(__name__)
+
+comm_target_name = "pyxll_notebook.rpc"
+
+_rpc_methods = {}
+
+
+def rpc_method(name):
+    """Registers a function that can be called from the client over the RPC comm.
+
+    The function is called with the data and buffers from the request and
+    should return a (data, buffers) tuple to send back in the reply.
+    """
+    def decorator(func):
+        _rpc_methods[name] = func
+        return func
+    return decorator
+
+
+def format_error():
+    """Return the current exception in the same form as a failed user_expression."""
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    return {
+        "ename": exc_type.__name__,
+        "evalue": str(exc_value),
+        "traceback": traceback.format_exception(exc_type, exc_value, exc_traceback)
+    }
+
+
+def _on_comm_open(comm, open_msg):
+    """Called when the client opens the RPC comm."""
+    def on_msg(msg):
+        data = msg["content"]["data"]
+        try:
+            func = _rpc_methods[data["method"]]
+            result, buffers = func(data, msg.get("buffers") or [])
+            reply = {"status": "ok"}
+            reply.update(result or {})
+        except Exception:
+            reply = {"status": "error"}
+            reply.update(format_error())
+            buffers = None
+        comm.send(reply, buffers=buffers)
+
+    comm.on_msg(on_msg)
+    comm.send({"status": "ready"})
+
+
+@rpc_method("ping")
+def _ping(data, buffers):
+    """Does nothing, used to measure the call overhead."""
+    return None, buffers
+
+
+@register_server_function("__pyxll_notebook_ping")
+def _ping_execute():
+    """Does nothing, used to measure the call overhead when not using the RPC comm."""
+    return None
+
+
+def _register_comm_target():
+    app = IPKernelApp.instance() if IPKernelApp else None
+    kernel = getattr(app, "kernel", None) if app else None
+    if kernel is None:
+        return
+
+    comm_manager = getattr(kernel, "comm_manager", None)
+    if comm_manager is None and get_comm_manager is not None:
+        comm_manager = get_comm_manager()
+
+    if comm_manager is None:
+        _log.warning("No comm manager found, the PyXLL client will use execute requests instead.")
+        return
+
+    comm_manager.register_target(comm_target_name, _on_comm_open)
+
+
+_register_comm_target()
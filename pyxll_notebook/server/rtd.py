@@ -1,13 +1,285 @@
 """
 RTD equivalent for sending real time data to Excel from a remote notebook.
+
+Once the client has set an update interval (see set_rtd_interval), updates
+are conflated by the RTD publisher. Only the latest value for each RTD
+instance is kept, and the pending updates for all instances are sent
+together in one "xl_rtd_set_values" message per interval.
+
+Updates to list and array values are sent as deltas of the cells (or rows)
+that have changed since the last value sent, with a sequence number. A full
+snapshot is sent when Excel connects, when the shape of the value changes,
+when most of it has changed, and when the client finds a gap in the sequence.
 """
 from .session import get_session, send_message, register_server_function
-from ..serialization import serialize_args, deserialize_args, serialize_result
+from .rpc import rpc_method
+from ..serialization import serialize_args, deserialize_args, serialize_result, dumps, loads
+from collections import OrderedDict
 from uuid import uuid4
+import threading
+import logging
 import pickle
+import time
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_log = logging.getLogger(__name__)
 
 _active_rtd_instances = {}
 
+# A snapshot is sent instead of a delta if more than this fraction of the cells have changed
+_max_delta_fraction = 0.5
+
+
+def _shape(value):
+    """Return the shape of a list (of equal length lists) or a 1d or 2d numpy array, or None."""
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.shape if value.ndim in (1, 2) else None
+    if not isinstance(value, list) or not value:
+        return None
+    if isinstance(value[0], list):
+        columns = len(value[0])
+        if any(not isinstance(row, list) or len(row) != columns for row in value):
+            return None
+        return (len(value), columns)
+    return (len(value),)
+
+
+def _copy(value):
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return value.copy()
+    if value and isinstance(value[0], list):
+        return [list(row) for row in value]
+    return list(value)
+
+
+def _changed(a, b):
+    """Return True if a cell has changed. NaNs are treated as equal to each other."""
+    return a != b and not (a != a and b != b)
+
+
+def _diff(old, new, shape):
+    """Return a list of (row, column, value) changes from old to new, or None if a snapshot should be sent.
+
+    column is None if the whole row (or item of a 1d list) has changed.
+    """
+    size = shape[0] * (shape[1] if len(shape) > 1 else 1)
+    max_changes = int(size * _max_delta_fraction)
+
+    if numpy is not None and isinstance(new, numpy.ndarray):
+        changed = old != new
+        if new.dtype.kind in "fc" and getattr(old, "dtype", None) is not None and old.dtype.kind in "fc":
+            changed &= ~(numpy.isnan(old) & numpy.isnan(new))
+        changed = numpy.argwhere(changed)
+        if len(changed) > max_changes:
+            return None
+        if len(shape) == 1:
+            return [(int(i), None, new[i].item()) for (i,) in changed]
+        return [(int(i), int(j), new[i, j].item()) for i, j in changed]
+
+    changes = []
+    if len(shape) == 1:
+        for i, (a, b) in enumerate(zip(old, new)):
+            if _changed(a, b):
+                changes.append((i, None, b))
+                if len(changes) > max_changes:
+                    return None
+        return changes
+
+    columns = shape[1]
+    num_changes = 0
+    for i, (old_row, new_row) in enumerate(zip(old, new)):
+        if old_row == new_row:
+            continue
+        row_changes = [(i, j, b) for j, (a, b) in enumerate(zip(old_row, new_row)) if _changed(a, b)]
+        if not row_changes:
+            continue
+        if len(row_changes) > columns // 2:
+            # Send the whole row when most of it has changed
+            row_changes = [(i, None, list(new_row))]
+        changes.extend(row_changes)
+        num_changes += len(row_changes) if row_changes[0][1] is not None else columns
+        if num_changes > max_changes:
+            return None
+    return changes
+
+
+class _RTDPublisher(object):
+    """Sends RTD updates to the client, conflating them by RTD id.
+
+    Until the client enables batches each update is sent as its own message.
+    With an interval of 0 each update is sent in a batch as soon as it's made.
+    """
+
+    def __init__(self):
+        self.interval = 0
+        self.batches = False
+        self.__lock = threading.Lock()
+        self.__pending = OrderedDict()
+        self.__event = threading.Event()
+        self.__thread = None
+
+        # Last (sequence number, value) sent for list and array values, by RTD id
+        self.__state_lock = threading.Lock()
+        self.__sent = {}
+        self.__sequence = {}
+
+    def publish(self, id, kind, args):
+        """Send or queue an update.
+
+        :param kind: "value" or "error".
+        :param args: Args for the client RTD's set_value or set_error method.
+        """
+        session = get_session()
+        if not session:
+            return
+
+        if not self.batches:
+            send_message(session, "xl_rtd_set_%s" % kind, {
+                "id": id,
+                "args": serialize_args(args),
+            })
+            return
+
+        if not self.interval:
+            self.__send(OrderedDict([(id, (kind, args))]))
+            return
+
+        with self.__lock:
+            # Only the latest update for each RTD instance is sent
+            self.__pending[id] = (kind, args)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name="pyxll-notebook-rtd-publisher")
+                self.__thread.daemon = True
+                self.__thread.start()
+        self.__event.set()
+
+    def send_snapshot(self, id, value):
+        """Send the value as a full snapshot rather than as a delta."""
+        self.forget(id)
+        self.publish(id, "value", (value,))
+
+    def forget(self, id):
+        """Forget the last value sent, so the next update is sent as a snapshot."""
+        with self.__state_lock:
+            self.__sent.pop(id, None)
+            self.__sequence.pop(id, None)
+
+    def __run(self):
+        while True:
+            self.__event.wait()
+            time.sleep(self.interval)
+            with self.__lock:
+                self.__event.clear()
+                pending, self.__pending = self.__pending, OrderedDict()
+
+            if pending:
+                try:
+                    self.__send(pending)
+                except Exception:
+                    _log.error("Error sending RTD updates", exc_info=True)
+
+    def __send(self, pending):
+        with self.__state_lock:
+            updates = [self.__encode(id, kind, args) for id, (kind, args) in pending.items()]
+
+        try:
+            data = serialize_args(updates)
+        except Exception:
+            # Find the updates that can't be serialized and send errors for those instead
+            data = serialize_args([self.__check_serializable(u) for u in updates])
+
+        send_message(get_session(), "xl_rtd_set_values", {"updates": data})
+
+    def __encode(self, id, kind, args):
+        """Return the update to send, as a delta or snapshot for list and array values."""
+        if kind != "value":
+            return (id, kind, args)
+
+        value = args[0]
+        shape = _shape(value)
+        if shape is None:
+            self.__sent.pop(id, None)
+            return (id, kind, args)
+
+        seq = self.__sequence.get(id, 0) + 1
+        self.__sequence[id] = seq
+
+        last = self.__sent.get(id)
+        changes = None
+        if last is not None and _shape(last[1]) == shape:
+            changes = _diff(last[1], value, shape)
+        self.__sent[id] = (seq, _copy(value))
+
+        if changes is None:
+            return (id, "snapshot", (seq, value))
+        return (id, "delta", (seq, last[0], changes))
+
+    @staticmethod
+    def __check_serializable(update):
+        try:
+            dumps(update)
+            return update
+        except Exception:
+            exc_type, exc_value, _ = sys.exc_info()
+            return (update[0], "error", (exc_type, exc_value, None))
+
+
+_publisher = _RTDPublisher()
+
+
+def set_rtd_interval(interval):
+    """Set the time in seconds to conflate RTD updates over before sending them to Excel.
+
+    This is normally set by the client from its rtd_interval setting.
+    If 0, every update is sent as soon as it's made.
+    """
+    _publisher.interval = max(float(interval or 0), 0)
+
+
+@register_server_function("__pyxll_notebook_set_rtd_interval")
+def _set_rtd_interval(interval):
+    """Called from the client to set the interval RTD updates are conflated over.
+
+    This also tells the kernel that the client accepts batches of updates and deltas.
+    """
+    set_rtd_interval(interval)
+    _publisher.batches = True
+    return True
+
+
+def _request_snapshot(id):
+    rtd = _active_rtd_instances.get(id)
+    if rtd is not None:
+        _publisher.send_snapshot(id, rtd.value)
+
+
+@register_server_function("__pyxll_notebook_rtd_snapshot")
+def _rtd_snapshot(id):
+    """Called from the client when it's missed an update to an RTD instance to get its full value."""
+    _request_snapshot(id)
+
+
+@rpc_method("rtd_snapshot")
+def _rpc_rtd_snapshot(data, buffers):
+    """Called from the client over the RPC comm when it's missed an update to an RTD instance."""
+    _request_snapshot(data["id"])
+    return None, None
+
+
+def _on_rtd_method_called(id, method_name, rtd):
+    """Send a snapshot when Excel connects to an RTD instance, and forget it when it disconnects."""
+    if not _publisher.batches:
+        return
+    if method_name == "connect":
+        _publisher.send_snapshot(id, rtd.value)
+    elif method_name == "disconnect":
+        _publisher.forget(id)
+
 
 @register_server_function("__pyxll_notebook_call_xl_rtd_method")
 def _call_xl_rtd_method(id, method_name, args=None, protocol=pickle.HIGHEST_PROTOCOL):
@@ -22,9 +294,29 @@ def _call_xl_rtd_method(id, method_name, args=None, protocol=pickle.HIGHEST_PROT
     method = getattr(rtd, method_name)
     args = deserialize_args(args) if args else tuple()
     result = method(*args)
+    _on_rtd_method_called(id, method_name, rtd)
     return serialize_result(result, protocol=min(protocol, pickle.HIGHEST_PROTOCOL))
 
 
+@rpc_method("call_xl_rtd_method")
+def _rpc_call_xl_rtd_method(data, buffers):
+    """Called from the client over the RPC comm to invoke a method on an RTD instance"""
+    rtd = _active_rtd_instances[data["id"]]
+    method_name = data["method"]
+
+    # remove the RTD instance if disconnecting from Excel
+    if method_name == "disconnect":
+        del _active_rtd_instances[data["id"]]
+
+    # call the method and return the result
+    method = getattr(rtd, method_name)
+    args = loads(buffers[0]) if buffers else tuple()
+    result = method(*args)
+    _on_rtd_method_called(data["id"], method_name, rtd)
+    protocol = min(data.get("protocol", pickle.HIGHEST_PROTOCOL), pickle.HIGHEST_PROTOCOL)
+    return None, [dumps(result, protocol=protocol)]
+
+
 class RTD:
     """RTD is a base class that should be derived from for use by functions
     wishing to return real time ticking data instead of a static value.
@@ -49,21 +341,11 @@ class RTD:
         self.__value = value
 
         # send the update back to Excel
-        session = get_session()
-        if session:
-            send_message(session, "xl_rtd_set_value", {
-                "id": self.__id,
-                "args": serialize_args((value,)),
-            })
+        _publisher.publish(self.__id, "value", (value,))
 
     def set_error(self, exc_type, exc_value, exc_traceback):
         # send the update back to Excel
-        session = get_session()
-        if session:
-            send_message(session, "xl_rtd_set_error", {
-                "id": self.__id,
-                "args": serialize_args((exc_type, exc_value, exc_traceback)),
-            })
+        _publisher.publish(self.__id, "error", (exc_type, exc_value, exc_traceback))
 
     def connect(self):
         """Called when Excel connects to this RTD instance, which occurs shortly after
@@ -21,8 +21,32 @@ def get_session():
     return _session
 
 
-def send_message(session, msg_type, content):
-    """Sends a message back to the client."""
+def get_shell():
+    """Return the IPython shell, or None if not running in an IPython kernel."""
+    app = IPKernelApp.instance() if IPKernelApp else None
+    return app.shell if app is not None else None
+
+
+def get_parent():
+    """Return the message currently being handled by the kernel, including any buffers."""
+    app = IPKernelApp.instance() if IPKernelApp else None
+    if app is None:
+        raise AssertionError("No IPKernelApp found.")
+
+    kernel = app.kernel
+    if hasattr(kernel, "get_parent"):
+        return kernel.get_parent("shell")
+
+    # older versions of ipykernel
+    return getattr(kernel, "_parent", None) or {}
+
+
+def send_message(session, msg_type, content, buffers=None, msg_id=None):
+    """Sends a message back to the client.
+
+    If msg_id is set it is used as the parent message id so the client can
+    match the message to the request it was sent in response to.
+    """
     app = IPKernelApp.instance() if IPKernelApp else None
     if app is None:
         raise AssertionError("No IPKernelApp found.")
@@ -36,10 +60,14 @@ def send_message(session, msg_type, content):
         }
     }
 
+    if msg_id is not None:
+        parent["header"]["msg_id"] = msg_id
+
     app.session.send(app.iopub_socket,
                      msg_type,
                      content=content,
-                     parent=parent)
+                     parent=parent,
+                     buffers=buffers)
 
 
 def register_server_function(name):
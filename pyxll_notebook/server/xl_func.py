@@ -1,23 +1,185 @@
 """
 @xl_func decorator equivalent for registering remote notebook functions.
 """
-from .session import get_session, send_message, register_server_function
-from ..serialization import serialize_args, deserialize_args, serialize_result
+from .session import get_session, get_parent, get_shell, send_message, register_server_function
+from .rpc import rpc_method, format_error
+from .cache import get_cache
+from .objects import get_objects, uses_objects, client_signature
+from ..serialization import serialize_args, deserialize_args, serialize_result, dumps
+from ..serialization import array_types, pack_result, set_compression
+from ..serialization import set_out_of_band_buffers, dumps_buffers, loads_buffers
+import timeit
 import inspect
 import pickle
 
 _registered_xl_funcs = {}
+_server_cache_tags = {}
+_object_funcs = {}
+_return_array_types = {}
+_xl_func_messages = {}
+_pending_xl_func_messages = []
+_flush_registered = False
 
 
 @register_server_function("__pyxll_notebook_call_xl_func")
 def _call_xl_func(func_name, args, protocol=pickle.HIGHEST_PROTOCOL):
     """Called from the client to invoke a registered xl_func"""
-    func = _registered_xl_funcs[func_name]
     args = deserialize_args(args)
-    result = func(*args)
+    result = _call(func_name, args)
     return serialize_result(result, protocol=min(protocol, pickle.HIGHEST_PROTOCOL))
 
 
+def _call(func_name, args, owner=None):
+    """Call a registered xl_func, using the server cache if it's enabled for the function.
+
+    For functions using the object type, object handles in args are resolved
+    and returned objects are replaced with handles owned by owner (the calling cell).
+    numpy arrays returned for array types are packed to be sent as typed buffers.
+    """
+    func = _registered_xl_funcs[func_name]
+    object_args, returns_object = _object_funcs.get(func_name, (False, False))
+    if object_args:
+        func = _resolve_object_args(func)
+
+    tags = _server_cache_tags.get(func_name)
+    if tags is None:
+        result = func(*args)
+    else:
+        result = get_cache().call(func_name, func, args, tags)
+
+    if returns_object:
+        return get_objects().add(result, owner)
+    return pack_result(result, _return_array_types.get(func_name))
+
+
+def _resolve_object_args(func):
+    objects = get_objects()
+
+    def resolve_and_call(*args):
+        return func(*[objects.resolve(a) for a in args])
+    return resolve_and_call
+
+
+@register_server_function("__pyxll_notebook_call_xl_func_batch")
+def _call_xl_func_batch(calls=None, protocol=pickle.HIGHEST_PROTOCOL):
+    """Called from the client to invoke a batch of registered xl_funcs.
+
+    Each call returns its own ("ok", result) or ("error", error) tuple so
+    that one failing call doesn't fail the rest of the batch.
+
+    If calls is None the calls are read from the binary buffers of the
+    request, and the results are sent back to the client as a binary
+    "xl_func_batch_result" message instead of being returned.
+    """
+    protocol = min(protocol, pickle.HIGHEST_PROTOCOL)
+    parent = None
+    if calls is None:
+        parent = get_parent()
+        calls = loads_buffers(parent["buffers"], writable=True)
+    else:
+        calls = deserialize_args(calls)
+
+    results = _run_xl_func_batch(calls)
+    if parent is None:
+        return _serialize_results(results, serialize_result, protocol)
+
+    buffers = _serialize_results(results, dumps_buffers, protocol)
+    msg_id = parent["header"]["msg_id"]
+    send_message(get_session(), "xl_func_batch_result", {}, buffers=buffers, msg_id=msg_id)
+
+
+@rpc_method("call_xl_func_batch")
+def _rpc_call_xl_func_batch(data, buffers):
+    """Called from the client over the RPC comm to invoke a batch of registered xl_funcs."""
+    protocol = min(data.get("protocol", pickle.HIGHEST_PROTOCOL), pickle.HIGHEST_PROTOCOL)
+    results = _run_xl_func_batch(loads_buffers(buffers, writable=True))
+    return None, _serialize_results(results, dumps_buffers, protocol)
+
+
+@register_server_function("__pyxll_notebook_set_compression")
+def _set_compression(threshold, level=6):
+    """Called from the client to compress results larger than threshold bytes."""
+    set_compression(threshold, level)
+    return True
+
+
+@register_server_function("__pyxll_notebook_set_out_of_band_buffers")
+def _set_out_of_band_buffers(threshold):
+    """Called from the client to send buffers of at least threshold bytes out-of-band."""
+    set_out_of_band_buffers(threshold)
+    return True
+
+
+@register_server_function("__pyxll_notebook_replay_xl_funcs")
+def _replay_xl_funcs():
+    """Called from the client after re-attaching to the kernel to register the functions in Excel again."""
+    send_message(get_session(), "xl_funcs", {"funcs": list(_xl_func_messages.values())})
+
+
+def _queue_xl_func_message(msg):
+    """Queue a function registration to be sent to the client at the end of the current cell.
+
+    Sending the registrations together means the client only has to update
+    Excel's functions once. If not running in IPython it's sent immediately.
+    """
+    global _flush_registered
+    shell = get_shell()
+    if shell is None:
+        send_message(get_session(), "xl_func", msg)
+        return
+
+    if not _flush_registered:
+        shell.events.register("post_execute", _flush_xl_func_messages)
+        _flush_registered = True
+    _pending_xl_func_messages.append(msg)
+
+
+def _flush_xl_func_messages():
+    """Send any queued function registrations to the client."""
+    if not _pending_xl_func_messages:
+        return
+    funcs = list(_pending_xl_func_messages)
+    del _pending_xl_func_messages[:]
+    send_message(get_session(), "xl_funcs", {"funcs": funcs})
+
+
+def _run_xl_func_batch(calls):
+    """Run a batch of (func_name, args[, owner]) calls, returning a list of (status, result, elapsed) tuples.
+
+    owner is the cell calling functions that return objects. elapsed is the
+    time in seconds taken to run the function, for the client's metrics.
+    """
+    results = []
+    for call in calls:
+        func_name, args = call[:2]
+        owner = call[2] if len(call) > 2 else None
+        start_time = timeit.default_timer()
+        try:
+            result = _call(func_name, args, owner)
+            results.append(("ok", result, timeit.default_timer() - start_time))
+        except Exception:
+            results.append(("error", format_error(), timeit.default_timer() - start_time))
+    return results
+
+
+def _serialize_results(results, serialize, protocol):
+    try:
+        return serialize(results, protocol=protocol)
+    except Exception:
+        # Something in the batch can't be serialized, so find out which
+        # results are the problem and return errors for just those.
+        return serialize([_check_serializable(r, protocol) for r in results], protocol=protocol)
+
+
+def _check_serializable(result, protocol):
+    """Return result, or an error if it can't be serialized."""
+    try:
+        dumps(result, protocol=protocol)
+        return result
+    except Exception:
+        return ("error", format_error()) + tuple(result[2:])
+
+
 def xl_func(signature=None,
             category="PyXLL",
             help_topic="",
@@ -29,7 +191,13 @@ def xl_func(signature=None,
             disable_replace_calc=False,
             name=None,
             auto_resize=False,
-            hidden=False):
+            hidden=False,
+            timeout=None,
+            pure=False,
+            cache_ttl=None,
+            cache_maxsize=None,
+            server_cache=False,
+            cache_tags=None):
     """
     xl_func is decorator used to expose python functions to Excel.
 
@@ -37,6 +205,21 @@ def xl_func(signature=None,
     appear in the Excel function wizard.
 
     See pyxll.xl_func for full details.
+
+    :param thread_safe: If True Excel may call the function from multiple threads at once, and
+                        concurrent calls are sent to the kernel in batches. Other functions are
+                        called one at a time and each call is sent on its own.
+    :param timeout: Time in seconds Excel will wait for the function to complete before
+                    interrupting it. If not set the client's call_timeout is used.
+    :param pure: If True the function always returns the same result for the same
+                 arguments, and results are cached by the client.
+    :param cache_ttl: Time in seconds to keep cached results for. If set, results are
+                      cached even if pure is False.
+    :param cache_maxsize: Maximum number of results to cache.
+    :param server_cache: If True results are cached in the kernel and shared by all
+                         clients. See pyxll_notebook.server.cache.
+    :param cache_tags: List of tags that can be passed to invalidate_cache to remove
+                       this function's results from the server cache.
     """
     # xl_func may be called with no arguments as a plain decorator, in which
     # case the first argument will be the function it's applied to.
@@ -51,6 +234,13 @@ def xl_func(signature=None,
         if session:
             # func will be called via _call_xl_func from the client
             _registered_xl_funcs[xl_name] = func
+            if server_cache:
+                _server_cache_tags[xl_name] = tuple(cache_tags or ())
+            else:
+                _server_cache_tags.pop(xl_name, None)
+            get_cache().invalidate(func_name=xl_name)
+            object_args, returns_object = _object_funcs[xl_name] = uses_objects(signature)
+            _return_array_types[xl_name] = array_types(signature)[1]
 
             # register the function on the client
             getargspec = inspect.getfullargspec if hasattr(inspect, "getfullargspec") else inspect.getargspec
@@ -62,7 +252,9 @@ def xl_func(signature=None,
                 "defaults": serialize_args(spec.defaults) if spec.defaults else None,
                 "pickle_protocol": pickle.HIGHEST_PROTOCOL,
                 "doc": func.__doc__,
-                "signature": signature,
+                "signature": client_signature(signature),
+                "object_args": object_args,
+                "returns_object": returns_object,
                 "category": category,
                 "help_topic": help_topic,
                 "thread_safe": thread_safe,
@@ -73,9 +265,14 @@ def xl_func(signature=None,
                 "disable_replace_calc": disable_replace_calc,
                 "name": xl_name,
                 "auto_resize": auto_resize,
-                "hidden": hidden
+                "hidden": hidden,
+                "timeout": timeout,
+                "pure": pure,
+                "cache_ttl": cache_ttl,
+                "cache_maxsize": cache_maxsize
             }
-            send_message(session, "xl_func", msg)
+            _xl_func_messages[xl_name] = msg
+            _queue_xl_func_message(msg)
 
         return func
 
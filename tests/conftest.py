@@ -0,0 +1,163 @@
+"""
+Fixtures for testing the client package outside of Excel, using a
+stand-in for the pyxll module, and for running notebooks in kernels
+started by a real Jupyter server.
+"""
+import urllib.request
+import configparser
+import subprocess
+import importlib
+import socket
+import json
+import time
+import uuid
+import sys
+import os
+import types
+import pytest
+
+_package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _decorator(*args, **kwargs):
+    def decorator(func):
+        return func
+    return decorator
+
+
+def _stub_pyxll(xl_funcs):
+    pyxll = types.ModuleType("pyxll")
+
+    def xl_func(signature=None, **kwargs):
+        def decorator(func):
+            assert callable(func)
+            xl_funcs[func.__name__] = signature
+            return func
+        return decorator
+
+    class RTD:
+        def __init__(self, value=None):
+            self.value = value
+
+    pyxll.xl_func = xl_func
+    pyxll.xl_menu = _decorator
+    pyxll.xl_on_open = lambda func: func
+    pyxll.xl_on_reload = lambda func: func
+    pyxll.xl_on_close = lambda func: func
+    pyxll.get_config = configparser.ConfigParser
+    pyxll.get_event_loop = lambda: None
+    pyxll.xlcAlert = lambda message: None
+    pyxll.xlfCaller = lambda: None
+    pyxll.xl_app = lambda: None
+    pyxll.schedule_call = lambda func, *args, **kwargs: None
+    pyxll.rebind = lambda: None
+    pyxll.RTD = RTD
+    return pyxll
+
+
+@pytest.fixture
+def xl_funcs(monkeypatch):
+    """Install a stand-in pyxll module and return the functions registered with its xl_func.
+
+    The client package is removed from sys.modules so it's imported again using the stand-in.
+    """
+    pytest.importorskip("websockets")
+    pytest.importorskip("aiohttp")
+
+    xl_funcs = {}
+    monkeypatch.setitem(sys.modules, "pyxll", _stub_pyxll(xl_funcs))
+    for name in list(sys.modules):
+        if name == "pyxll_notebook.client" or name.startswith("pyxll_notebook.client."):
+            monkeypatch.delitem(sys.modules, name)
+    return xl_funcs
+
+
+@pytest.fixture
+def client(xl_funcs, monkeypatch):
+    """Import the client package using the stand-in pyxll module."""
+    # os.getlogin fails when there's no controlling terminal
+    monkeypatch.setattr(os, "getlogin", lambda: "excel")
+    return importlib.import_module("pyxll_notebook.client")
+
+
+@pytest.fixture
+def notebook_server(tmp_path):
+    """Start a Jupyter server with its root in tmp_path and return its url and token."""
+    pytest.importorskip("jupyter_server")
+    pytest.importorskip("ipykernel")
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+
+    # Kernels import pyxll_notebook.server from this checkout
+    token = uuid.uuid4().hex
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [_package_dir, env.get("PYTHONPATH")]))
+    proc = subprocess.Popen([sys.executable, "-m", "jupyter_server",
+                             "--no-browser",
+                             "--allow-root",
+                             "--ip=127.0.0.1",
+                             f"--port={port}",
+                             f"--IdentityProvider.token={token}",
+                             f"--ServerApp.root_dir={tmp_path}",
+                             "--KernelRestarter.time_to_dead=0.5"],
+                            env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                request = urllib.request.Request(url + "/api/status", headers={"Authorization": f"Token {token}"})
+                urllib.request.urlopen(request, timeout=1).close()
+                break
+            except Exception:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    pytest.skip("Unable to start the Jupyter server.")
+                time.sleep(0.2)
+        yield url, token
+    finally:
+        proc.terminate()
+        proc.wait(10)
+
+
+class _Handler:
+    async def on_stream(self, msg):
+        pass
+
+
+@pytest.fixture
+def start_kernel(client, notebook_server, tmp_path):
+    """Return a coroutine function that saves a notebook with the given code cells,
+    then starts a kernel and runs the notebook in it.
+
+    Keyword arguments are passed to the Kernel.
+    """
+    url, token = notebook_server
+
+    async def start_kernel(cells, path="test.ipynb", **kwargs):
+        from pyxll_notebook.client.authenticators.simple import SimpleAuthenticator
+        notebook = {
+            "cells": [{"cell_type": "code", "metadata": {}, "outputs": [], "execution_count": None, "source": c}
+                      for c in cells],
+            "metadata": {},
+            "nbformat": 4,
+            "nbformat_minor": 5
+        }
+        with open(tmp_path / path, "w") as f:
+            json.dump(notebook, f)
+
+        kwargs.setdefault("handler", _Handler())
+        kernel = client.Kernel(url, SimpleAuthenticator(auth_token=token), **kwargs)
+        await kernel.start()
+        try:
+            await kernel.run_notebook(path)
+        except Exception:
+            await kernel.shutdown()
+            raise
+        return kernel
+
+    return start_kernel
@@ -0,0 +1,146 @@
+"""
+Checks the client side cache used for the results of pure remote functions.
+"""
+import importlib
+import threading
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def cache(client):
+    return importlib.import_module("pyxll_notebook.client.cache")
+
+
+def test_maxsize(cache):
+    c = cache.LRUCache(maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1
+
+    # "b" is the least recently used entry so is evicted first
+    c.set("c", 3)
+    assert len(c) == 2
+    assert c.get("b") is cache.LRUCache.missing
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert (c.hits, c.misses) == (3, 1)
+
+    c.clear()
+    assert len(c) == 0
+    assert c.get("a") is cache.LRUCache.missing
+
+
+def test_ttl(cache, monkeypatch):
+    now = 1000.0
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now)
+    c = cache.LRUCache(ttl=10)
+    c.set("a", 1)
+
+    now += 9
+    assert c.get("a") == 1
+
+    now += 2
+    assert c.get("a") is cache.LRUCache.missing
+    assert len(c) == 0
+    assert (c.hits, c.misses) == (1, 1)
+
+
+def test_cached_values_can_be_none(cache):
+    c = cache.LRUCache()
+    c.set("a", None)
+    assert c.get("a") is None
+
+
+class _Kernel:
+    closed = False
+
+    def __init__(self):
+        self.calls = []
+
+    def select_kernel(self, pinned=True):
+        return self
+
+    async def call_xl_func(self, name, args, **kwargs):
+        self.calls.append(args)
+        return sum(args)
+
+
+@pytest.fixture
+def event_loop_thread(xl_funcs, monkeypatch):
+    """Run an event loop in a background thread, as PyXLL does."""
+    import pyxll
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(pyxll, "get_event_loop", lambda: loop)
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(10)
+    loop.close()
+
+
+def _bind(loop, xl_func, kernel, func_name, **kwargs):
+    async def bind():
+        xl_func.bind_xl_func(kernel, func_name, rebind=False, args=["a", "b"], **kwargs)
+    asyncio.run_coroutine_threadsafe(bind(), loop).result()
+    return xl_func._bound_functions[func_name].wrapper
+
+
+def test_pure_function_results_cached(client, event_loop_thread):
+    xl_func = importlib.import_module("pyxll_notebook.client.xl_func")
+    kernel = _Kernel()
+    add = _bind(event_loop_thread, xl_func, kernel, "add", pure=True)
+    assert add(1, 2) == 3
+    assert add(1, 2) == 3
+    assert add(2, 2) == 4
+    assert kernel.calls == [(1, 2), (2, 2)]
+
+    cache = xl_func._bound_functions["add"].cache
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    # Running the notebook again clears the cache
+    _bind(event_loop_thread, xl_func, kernel, "add", pure=True)
+    assert add(1, 2) == 3
+    assert kernel.calls == [(1, 2), (2, 2), (1, 2)]
+
+    # Functions that aren't pure are always called
+    sub = _bind(event_loop_thread, xl_func, kernel, "sub")
+    assert xl_func._bound_functions["sub"].cache is None
+    sub(1, 2)
+    sub(1, 2)
+    assert len(kernel.calls) == 5
+
+
+def test_cache_maxsize_from_registration(client, event_loop_thread):
+    xl_func = importlib.import_module("pyxll_notebook.client.xl_func")
+    _bind(event_loop_thread, xl_func, _Kernel(), "add", cache_ttl=60, cache_maxsize=10)
+    cache = xl_func._bound_functions["add"].cache
+    assert (cache.maxsize, cache.ttl) == (10, 60)
+
+
+class _Handler:
+    def __init__(self):
+        self.funcs = {}
+
+    async def on_xl_funcs(self, msg):
+        self.funcs.update((f["func"], f) for f in msg["content"]["funcs"])
+
+
+def test_cache_policy_sent_by_server(start_kernel):
+    handler = _Handler()
+    cells = [
+        "from pyxll_notebook.server import xl_func",
+        "@xl_func(pure=True, cache_maxsize=100)\ndef pure():\n    return 1",
+        "@xl_func(cache_ttl=5)\ndef ttl():\n    return 2",
+    ]
+
+    async def run():
+        kernel = await start_kernel(cells, handler=handler)
+        await kernel.shutdown()
+
+    asyncio.run(run())
+    assert handler.funcs["pure"]["pure"] is True
+    assert handler.funcs["pure"]["cache_maxsize"] == 100
+    assert handler.funcs["ttl"]["pure"] is False
+    assert handler.funcs["ttl"]["cache_ttl"] == 5
@@ -0,0 +1,65 @@
+"""
+Checks calls that time out interrupt the kernel, using a real Jupyter
+server started for the test.
+"""
+import asyncio
+import time
+import pytest
+
+_cells = [
+    "from pyxll_notebook.server import xl_func\nimport time",
+    "@xl_func\ndef add(a, b):\n    return a + b",
+    "@xl_func\ndef wait(seconds):\n    time.sleep(seconds)\n    return seconds",
+]
+
+
+@pytest.mark.parametrize("use_rpc_comm", [True, False])
+def test_timeout_interrupts_kernel(client, start_kernel, use_rpc_comm):
+    async def run():
+        kernel = await start_kernel(_cells, use_rpc_comm=use_rpc_comm)
+        try:
+            with pytest.raises(client.ExecuteTimeoutError):
+                await kernel.call_xl_func("wait", (60,), timeout=1)
+
+            # The kernel was interrupted, so doesn't wait for the first call to finish
+            start_time = time.monotonic()
+            assert await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30) == 3
+            return time.monotonic() - start_time
+        finally:
+            await kernel.shutdown()
+
+    assert asyncio.run(run()) < 10
+
+
+def test_default_call_timeout(client, start_kernel):
+    async def run():
+        kernel = await start_kernel(_cells, call_timeout=1)
+        try:
+            with pytest.raises(client.ExecuteTimeoutError):
+                await kernel.call_xl_func("wait", (60,))
+
+            # An explicit timeout overrides the default
+            return await kernel.call_xl_func("wait", (1.5,), timeout=30)
+        finally:
+            await kernel.shutdown()
+
+    assert asyncio.run(run()) == 1.5
+
+
+def test_cancelled_call_interrupts_kernel(start_kernel):
+    async def run():
+        kernel = await start_kernel(_cells)
+        try:
+            task = asyncio.ensure_future(kernel.call_xl_func("wait", (60,)))
+            await asyncio.sleep(1)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+            start_time = time.monotonic()
+            assert await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30) == 3
+            return time.monotonic() - start_time
+        finally:
+            await kernel.shutdown()
+
+    assert asyncio.run(run()) < 10
@@ -0,0 +1,12 @@
+"""
+Checks the client package can be imported and registers its worksheet functions.
+"""
+import importlib
+
+
+def test_client_registers_xl_funcs(xl_funcs):
+    client = importlib.import_module("pyxll_notebook.client")
+    assert callable(client.pyxll_notebook_metrics)
+    assert callable(client.pyxll_notebook_server_cache_stats)
+    assert xl_funcs["pyxll_notebook_metrics"] == "bool reset: var[][]"
+    assert xl_funcs["pyxll_notebook_server_cache_stats"] == ": var[][]"
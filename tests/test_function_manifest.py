@@ -0,0 +1,59 @@
+"""
+Checks the functions registered by a notebook are saved in the function manifest.
+"""
+import configparser
+import importlib
+import asyncio
+import json
+
+
+def _config(manifest_file):
+    cfg = configparser.ConfigParser()
+    cfg["NOTEBOOK"] = {
+        "url": "http://localhost:8888",
+        "auth_class": "SimpleAuthenticator",
+        "notebooks": "functions.ipynb; other.ipynb",
+        "function_manifest": "1",
+        "manifest_file": str(manifest_file),
+    }
+    return cfg
+
+
+def test_manifest_saves_functions_for_single_kernel(client, tmp_path):
+    manifest_file = tmp_path / "manifest.json"
+    km = client.KernelManager(_config(manifest_file))
+    kernel = client.Kernel("http://localhost:8888", authenticator=None)
+
+    handler = client.Handler(kernel)
+    msg = {"content": {"funcs": [{"func": "add", "signature": "int a, int b: int"}]}}
+    asyncio.run(handler.on_xl_funcs(msg))
+
+    km._KernelManager__kernels["functions.ipynb"] = kernel
+    km._KernelManager__update_manifest("functions.ipynb")
+
+    with open(manifest_file) as fh:
+        manifest = json.load(fh)
+    funcs = manifest["notebooks"]["functions.ipynb"]["funcs"]
+    assert funcs == [{"func": "add", "signature": "int a, int b: int"}]
+
+
+def test_manifest_functions_registered_if_notebook_unchanged(client, tmp_path):
+    manifest_file = tmp_path / "manifest.json"
+    with open(manifest_file, "w") as fh:
+        json.dump({"url": "http://localhost:8888", "notebooks": {
+            "functions.ipynb": {"last_modified": "2024-01-01", "funcs": [{"func": "add"}]},
+            "other.ipynb": {"last_modified": "2024-01-01", "funcs": [{"func": "removed"}]},
+        }}, fh)
+
+    km = client.KernelManager(_config(manifest_file))
+    last_modified = {"functions.ipynb": "2024-01-01", "other.ipynb": "2024-02-01"}
+
+    async def get_notebook_last_modified(notebook):
+        return last_modified[notebook]
+
+    km._KernelManager__get_notebook_last_modified = get_notebook_last_modified
+    asyncio.run(km.register_manifest_functions())
+
+    bound_functions = importlib.import_module("pyxll_notebook.client.xl_func")._bound_functions
+    assert "add" in bound_functions
+    assert "removed" not in bound_functions
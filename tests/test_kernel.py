@@ -0,0 +1,88 @@
+"""
+Checks Kernel behaviour that doesn't need a running kernel.
+"""
+import asyncio
+
+
+class _Handler:
+    async def on_stream(self, msg):
+        pass
+
+    async def on_xl_rtd_set_value(self, msg):
+        pass
+
+
+def test_handler_queue_drops_only_output(client):
+    async def run():
+        handler = _Handler()
+        kernel = client.Kernel("http://localhost:8888", authenticator=None, handler=handler,
+                               handler_concurrency=1, handler_queue_size=2)
+        kernel._Kernel__start_handler_tasks()
+        try:
+            for i in range(5):
+                kernel._Kernel__queue_handler(handler.on_stream, "stream", {"content": {}})
+            for i in range(5):
+                kernel._Kernel__queue_handler(handler.on_xl_rtd_set_value, "xl_rtd_set_value",
+                                              {"content": {"id": "rtd"}})
+            queue, = kernel._Kernel__handler_queues
+            msg_types = [func.__name__ for func, msg in queue._queue]
+        finally:
+            kernel._Kernel__stop_handler_tasks()
+        return msg_types
+
+    msg_types = asyncio.run(run())
+    assert msg_types.count("on_stream") == 2
+    assert msg_types.count("on_xl_rtd_set_value") == 5
+
+
+def test_raw_message_filter(client):
+    kernel = client.Kernel("http://localhost:8888", authenticator=None, handler=_Handler())
+    is_handled = kernel._Kernel__is_handled
+
+    assert is_handled('{"header": {"msg_type": "execute_reply"}}')
+    assert is_handled('{"header": {"msg_type": "status"}}')
+    assert is_handled('{"header": {"msg_type": "stream"}}')
+    assert is_handled('{"header": {"msg_type": "pyxll.xl_rtd_set_value"}}')
+    assert not is_handled('{"header": {"msg_type": "execute_input"}}')
+    assert not is_handled('{"header": {"msg_type": "display_data"}}')
+
+
+def test_rtd_messages_processed_in_order(client):
+    processed = []
+
+    class Handler:
+        async def on_xl_rtd_set_value(self, msg):
+            # Later messages for other RTD instances may be processed while this one waits
+            await asyncio.sleep(0.01 if msg["content"]["value"] == 0 else 0)
+            processed.append((msg["content"]["id"], msg["content"]["value"]))
+
+    async def run():
+        handler = Handler()
+        kernel = client.Kernel("http://localhost:8888", authenticator=None, handler=handler,
+                               handler_concurrency=4)
+        kernel._Kernel__start_handler_tasks()
+        try:
+            for value in range(3):
+                for rtd_id in ("a", "b", "c"):
+                    kernel._Kernel__queue_handler(handler.on_xl_rtd_set_value, "xl_rtd_set_value",
+                                                  {"content": {"id": rtd_id, "value": value}})
+            await kernel._Kernel__wait_for_handlers()
+        finally:
+            kernel._Kernel__stop_handler_tasks()
+
+    asyncio.run(run())
+    for rtd_id in ("a", "b", "c"):
+        assert [v for i, v in processed if i == rtd_id] == [0, 1, 2]
+
+
+def test_kernel_restart_resets_session_options(client):
+    kernel = client.Kernel("http://localhost:8888", authenticator=None, compression_threshold=1024)
+    kernel._Kernel__compression_threshold = 1024
+    kernel._Kernel__out_of_band_threshold = 65536
+    kernel._Kernel__rtd_interval_set = True
+
+    kernel._Kernel__on_kernel_restarted()
+
+    assert kernel._Kernel__compression_threshold == 0
+    assert kernel._Kernel__out_of_band_threshold == 0
+    assert not kernel._Kernel__rtd_interval_set
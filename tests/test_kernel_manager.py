@@ -0,0 +1,98 @@
+"""
+Checks KernelManager behaviour that doesn't need a notebook server.
+"""
+import configparser
+import asyncio
+import pytest
+
+
+def _config(**options):
+    cfg = configparser.ConfigParser()
+    cfg["NOTEBOOK"] = {
+        "url": "http://localhost:8888",
+        "auth_class": "SimpleAuthenticator",
+        "auth_token": "token",
+        "notebooks": "functions.ipynb",
+    }
+    cfg["NOTEBOOK"].update(options)
+    return cfg
+
+
+def test_http_session_shared(client):
+    async def run():
+        km = client.KernelManager(_config())
+        get_http_session = km._KernelManager__get_http_session
+
+        session = get_http_session()
+        assert get_http_session() is session
+
+        # Resetting the authenticator replaces its cookie jar, and so the session
+        km._KernelManager__get_authenticator().reset()
+        new_session = get_http_session()
+        assert new_session is not session
+        assert new_session.cookie_jar is km._KernelManager__get_authenticator().cookie_jar
+        await asyncio.sleep(0.01)
+        assert session.closed
+
+        # The session is closed once the kernels using it have been stopped
+        await km.stop_all_kernels()
+        assert new_session.closed
+
+    asyncio.run(run())
+
+
+def test_kernel_uses_shared_http_session(start_kernel):
+    import aiohttp
+
+    async def run():
+        async with aiohttp.ClientSession() as session:
+            kernel = await start_kernel(["from pyxll_notebook.server import xl_func",
+                                         "@xl_func\ndef add(a, b):\n    return a + b"],
+                                        http_session=lambda: session,
+                                        use_rpc_comm=False)
+            try:
+                assert await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30) == 3
+            finally:
+                await kernel.shutdown()
+
+            # Kernels don't close the shared session
+            assert not session.closed
+
+    asyncio.run(run())
+
+
+def test_circular_notebook_dependencies(client):
+    with pytest.raises(AssertionError, match="a.ipynb -> b.ipynb -> c.ipynb -> a.ipynb"):
+        client.KernelManager(_config(notebooks="a.ipynb; b.ipynb; c.ipynb",
+                                     notebook_dependencies="a.ipynb = b.ipynb; b.ipynb = c.ipynb; c.ipynb = a.ipynb"))
+
+    with pytest.raises(AssertionError, match="a.ipynb -> a.ipynb"):
+        client.KernelManager(_config(notebooks="a.ipynb", notebook_dependencies="a.ipynb = a.ipynb"))
+
+    # Shared dependencies aren't circular, and notebooks that aren't configured are ignored
+    client.KernelManager(_config(notebooks="a.ipynb; b.ipynb; c.ipynb",
+                                 notebook_dependencies="a.ipynb = b.ipynb, c.ipynb; b.ipynb = c.ipynb, d.ipynb;"
+                                                       "d.ipynb = a.ipynb"))
+
+
+def test_notebooks_start_after_dependencies(client):
+    async def run():
+        km = client.KernelManager(_config(notebooks="a.ipynb; b.ipynb; c.ipynb",
+                                          notebook_dependencies="a.ipynb = b.ipynb; b.ipynb = c.ipynb",
+                                          function_manifest="0",
+                                          event_loop_monitor_interval="0"))
+        events = []
+
+        async def start_notebook(notebook, saved=None):
+            events.append(("start", notebook))
+            await asyncio.sleep(0.01)
+            events.append(("end", notebook))
+
+        km._KernelManager__start_notebook = start_notebook
+        await km.start_all_kernels()
+        assert events == [("start", "c.ipynb"), ("end", "c.ipynb"),
+                          ("start", "b.ipynb"), ("end", "b.ipynb"),
+                          ("start", "a.ipynb"), ("end", "a.ipynb")]
+        assert km.status == "Kernels ready"
+
+    asyncio.run(run())
@@ -0,0 +1,77 @@
+"""
+Checks how a KernelPool chooses the kernel to send each call to.
+"""
+import configparser
+import asyncio
+import pytest
+
+
+class _Kernel:
+    def __init__(self, id, outstanding_calls=0):
+        self.id = id
+        self.outstanding_calls = outstanding_calls
+        self.closed = False
+        self.standby = False
+        self.pool = None
+
+
+def test_pinned_calls_use_primary(client):
+    kernels = [_Kernel("a", 5), _Kernel("b", 0)]
+    pool = client.KernelPool(kernels)
+    assert pool.primary is kernels[0]
+    assert pool.select_kernel(pinned=True) is kernels[0]
+    assert pool.is_primary(kernels[0])
+    assert not pool.is_primary(kernels[1])
+    assert all(k.pool is pool for k in kernels)
+
+
+def test_unpinned_calls_use_least_busy(client):
+    kernels = [_Kernel("a", 2), _Kernel("b", 1), _Kernel("c", 3)]
+    pool = client.KernelPool(kernels)
+    assert pool.select_kernel(pinned=False) is kernels[1]
+
+    kernels[1].outstanding_calls = 4
+    assert pool.select_kernel(pinned=False) is kernels[0]
+
+    # Ties go to the first kernel, so an idle pool uses the primary kernel
+    for k in kernels:
+        k.outstanding_calls = 0
+    assert pool.select_kernel(pinned=False) is kernels[0]
+
+
+def test_standby_applies_to_all_kernels(client):
+    kernels = [_Kernel("a"), _Kernel("b")]
+    pool = client.KernelPool(kernels)
+    pool.standby = True
+    assert pool.standby
+    assert all(k.standby for k in kernels)
+
+
+def test_empty_pool(client):
+    with pytest.raises(AssertionError):
+        client.KernelPool([])
+
+
+def test_pool_sizes(client):
+    cfg = configparser.ConfigParser()
+    cfg["NOTEBOOK"] = {
+        "url": "http://localhost:8888",
+        "auth_class": "SimpleAuthenticator",
+        "auth_token": "token",
+        "notebooks": "a.ipynb; b.ipynb",
+        "pool_size": "2",
+        "pool_sizes": "b.ipynb = 1",
+    }
+
+    async def run():
+        km = client.KernelManager(cfg)
+        pool = km._KernelManager__new_kernel("a.ipynb")
+        assert isinstance(pool, client.KernelPool)
+        assert len(pool.kernels) == 2
+
+        # pool_sizes overrides pool_size for individual notebooks
+        kernel = km._KernelManager__new_kernel("b.ipynb")
+        assert isinstance(kernel, client.Kernel)
+        await km.stop_all_kernels()
+
+    asyncio.run(run())
@@ -0,0 +1,55 @@
+"""
+Checks the client recovers when the kernel dies or is deleted, using a real
+Jupyter server started for the test.
+"""
+import urllib.request
+import asyncio
+import signal
+import os
+import pytest
+
+_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "@xl_func\ndef add(a, b):\n    return a + b",
+]
+
+
+async def _start_kernel(start_kernel, **kwargs):
+    kernel = await start_kernel(_cells, reconnect_delay=0.1, kernel_check_interval=0.5, **kwargs)
+    assert await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30) == 3
+    return kernel
+
+
+@pytest.mark.parametrize("use_rpc_comm", [True, False])
+def test_call_after_kernel_killed(start_kernel, use_rpc_comm):
+    async def run():
+        kernel = await _start_kernel(start_kernel, use_rpc_comm=use_rpc_comm)
+        try:
+            reply = await kernel.execute("", user_expressions={"pid": "__import__('os').getpid()"})
+            pid = int(reply["user_expressions"]["pid"]["data"]["text/plain"])
+            os.kill(pid, signal.SIGKILL)
+
+            # The kernel is restarted with the same id and the notebook is run in it again
+            return await asyncio.wait_for(kernel.call_xl_func("add", (3, 4)), 60)
+        finally:
+            await kernel.shutdown()
+
+    assert asyncio.run(run()) == 7
+
+
+def test_call_after_kernel_deleted(start_kernel, notebook_server):
+    async def run():
+        kernel = await _start_kernel(start_kernel)
+        try:
+            url, token = notebook_server
+            request = urllib.request.Request(f"{url}/api/kernels/{kernel.id}",
+                                             method="DELETE",
+                                             headers={"Authorization": f"Token {token}"})
+            urllib.request.urlopen(request, timeout=10).close()
+
+            # A new kernel is started and the notebook is run in it
+            return await asyncio.wait_for(kernel.call_xl_func("add", (3, 4)), 60)
+        finally:
+            await kernel.shutdown()
+
+    assert asyncio.run(run()) == 7
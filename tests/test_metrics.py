@@ -0,0 +1,88 @@
+"""
+Checks the histograms, counters and gauges used to collect call metrics.
+"""
+import importlib
+import pytest
+
+
+@pytest.fixture
+def metrics(client):
+    return importlib.import_module("pyxll_notebook.client.metrics")
+
+
+def test_histogram_percentiles(metrics):
+    h = metrics.Histogram(buckets=(1, 2, 5, 10))
+    assert h.percentile(50) == 0.0
+    for value in (0.5, 1.5, 1.5, 4, 20):
+        h.observe(value)
+
+    assert h.count == 5
+    assert h.sum == 27.5
+    assert h.mean == 5.5
+    assert h.max == 20
+    assert h.counts == [1, 2, 1, 0, 1]
+
+    # Percentiles are the upper bound of the bucket, capped at the max
+    assert h.percentile(20) == 1
+    assert h.percentile(50) == 2
+    assert h.percentile(80) == 5
+    assert h.percentile(100) == 20
+
+    h = metrics.Histogram(buckets=(1, 2, 5, 10))
+    h.observe(3)
+    assert h.percentile(99) == 3
+
+
+def test_table(metrics):
+    m = metrics.Metrics()
+    m.observe("latency", 0.5, buckets=(1,), kernel="a")
+    m.inc("calls", kernel="a")
+    m.inc("calls", 2, kernel="a")
+    m.add_gauge("outstanding", 3)
+    m.add_gauge("outstanding", -1)
+
+    rows = m.table()
+    assert rows[0] == ["metric", "labels", "count", "mean", "p50", "p95", "p99", "max"]
+    assert rows[1] == ["latency", "kernel=a", 1, 0.5, 0.5, 0.5, 0.5, 0.5]
+    assert rows[2] == ["calls", "kernel=a", 3, None, None, None, None, None]
+    assert rows[3] == ["outstanding", "", 2, None, None, None, None, None]
+
+
+def test_to_prometheus(metrics):
+    m = metrics.Metrics()
+    m.observe("latency", 0.5, buckets=(1, 2), kernel='a"b')
+    m.observe("latency", 1.5, buckets=(1, 2), kernel='a"b')
+    m.inc("calls")
+    m.set_gauge("outstanding", 4)
+
+    assert m.to_prometheus().splitlines() == [
+        "# TYPE latency histogram",
+        'latency_bucket{kernel="a\\"b",le="1.0"} 1',
+        'latency_bucket{kernel="a\\"b",le="2.0"} 2',
+        'latency_bucket{kernel="a\\"b",le="+Inf"} 2',
+        'latency_sum{kernel="a\\"b"} 2.0',
+        'latency_count{kernel="a\\"b"} 2',
+        "# TYPE calls counter",
+        "calls 1",
+        "# TYPE outstanding gauge",
+        "outstanding 4",
+    ]
+
+
+def test_reset_keeps_gauges(metrics):
+    m = metrics.Metrics()
+    m.observe("latency", 0.5)
+    m.inc("calls")
+    m.set_gauge("outstanding", 4)
+    m.reset()
+    assert m.table()[1:] == [["outstanding", "", 4, None, None, None, None, None]]
+
+
+def test_write_prometheus_file(metrics, tmp_path):
+    m = metrics.Metrics()
+    m.inc("calls")
+    path = str(tmp_path / "metrics.prom")
+    m.write_prometheus_file(path)
+    with open(path) as fh:
+        assert fh.read() == m.to_prometheus()
+    assert list(tmp_path.iterdir()) == [tmp_path / "metrics.prom"]
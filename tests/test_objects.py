@@ -0,0 +1,59 @@
+"""
+Checks object types in xl_func signatures, and the objects kept for handles.
+"""
+from pyxll_notebook.server.objects import uses_objects, client_signature, ObjectCache
+import pytest
+
+
+def test_object_types():
+    assert uses_objects("int a, object b: object") == (True, True)
+    assert client_signature("int a, object b: object") == "int a, str b: str"
+
+
+def test_args_named_object():
+    assert uses_objects("int object: float") == (False, False)
+    assert client_signature("int object: float") == "int object: float"
+    assert client_signature("object x, float object: var") == "str x, float object: var"
+
+
+class _Value(object):
+    pass
+
+
+def test_owned_objects_released():
+    cache = ObjectCache()
+    obj = _Value()
+    handle = cache.add(obj, owner="[Book1]Sheet1!A1")
+    assert cache.resolve(handle) is obj
+
+    # Recalculating the cell replaces its object
+    cache.add(_Value(), owner="[Book1]Sheet1!A1")
+    assert len(cache) == 1
+    with pytest.raises(KeyError):
+        cache.get(handle)
+
+    cache.release(["[Book1]Sheet1!A1"])
+    assert len(cache) == 0
+
+
+def test_unowned_objects_bounded():
+    cache = ObjectCache(max_unowned=2)
+    owned = _Value()
+    owned_handle = cache.add(owned, owner="[Book1]Sheet1!A1")
+    assert cache.add(owned) == owned_handle
+
+    handles = [cache.add(_Value()) for i in range(3)]
+    assert len(cache) == 3
+    assert cache.get(owned_handle) is owned
+    with pytest.raises(KeyError):
+        cache.get(handles[0])
+
+    # Using an object keeps it, and the least recently used is removed instead
+    cache.get(handles[1])
+    cache.add(_Value())
+    cache.get(handles[1])
+    with pytest.raises(KeyError):
+        cache.get(handles[2])
+
+    cache.resize(0)
+    assert len(cache) == 1
@@ -0,0 +1,140 @@
+"""
+Checks functions registered before their kernel is ready return a placeholder
+value, and that Excel doesn't wait for the kernels to start when it opens.
+"""
+import configparser
+import importlib
+import threading
+import asyncio
+import pytest
+
+
+class _Kernel:
+    closed = False
+
+
+class _Cell:
+    def __init__(self, name):
+        self.name = name
+        self.dirty = False
+
+    def to_range(self):
+        return self
+
+    def Dirty(self):
+        self.dirty = True
+
+
+class _Excel:
+    def __init__(self):
+        self.calculated = False
+
+    def Calculate(self):
+        self.calculated = True
+
+
+@pytest.fixture
+def xl_func(client):
+    return importlib.import_module("pyxll_notebook.client.xl_func")
+
+
+@pytest.fixture
+def scheduled_calls(xl_funcs, monkeypatch):
+    """Record the functions scheduled to be called in Excel's main thread."""
+    import pyxll
+    calls = []
+    monkeypatch.setattr(pyxll, "schedule_call", lambda func, *args: calls.append((func, args)))
+    return calls
+
+
+def test_stub_function_returns_placeholder_until_bound(xl_func, xl_funcs, scheduled_calls, monkeypatch):
+    import pyxll
+    cell = _Cell("A1")
+    monkeypatch.setattr(pyxll, "xlfCaller", lambda: cell)
+
+    kwargs = {"signature": "int a, int b: int", "args": ["a", "b"]}
+    xl_func.register_stub_functions([dict(kwargs, func="add")])
+    assert xl_funcs["add"] == "int a, int b: int"
+
+    wrapper = xl_func._bound_functions["add"].wrapper
+    assert wrapper.__name__ == "add"
+    assert wrapper(1, 2) == "#LOADING"
+
+    # Nothing is recalculated until the function's kernel is ready
+    xl_func.recalculate_waiting_cells()
+    assert scheduled_calls == []
+
+    async def bind():
+        xl_func.bind_xl_func(_Kernel(), "add", **kwargs)
+
+    # Binding the function with the same signature doesn't register it again
+    asyncio.run(bind())
+    assert xl_func._bound_functions["add"].wrapper is wrapper
+    xl_func.recalculate_waiting_cells()
+    assert scheduled_calls == [(xl_func._recalculate, ([cell],))]
+
+    # The cells that returned the placeholder value are recalculated
+    excel = _Excel()
+    monkeypatch.setattr(pyxll, "xl_app", lambda: excel)
+    xl_func._recalculate([cell])
+    assert cell.dirty and excel.calculated
+
+
+def test_stub_function_not_bound(xl_func, scheduled_calls, monkeypatch):
+    import pyxll
+    cell = _Cell("A1")
+    monkeypatch.setattr(pyxll, "xlfCaller", lambda: cell)
+
+    xl_func.register_stub_functions([{"func": "removed"}])
+    wrapper = xl_func._bound_functions["removed"].wrapper
+    assert wrapper() == "#LOADING"
+
+    # Functions the notebook no longer registers raise an error once the notebook has run
+    xl_func.unbind_stub_functions(["removed"])
+    assert scheduled_calls == [(xl_func._recalculate, ([cell],))]
+    with pytest.raises(RuntimeError):
+        wrapper()
+
+
+class _KernelManager:
+    def __init__(self):
+        self.started = threading.Event()
+        self.finish = asyncio.Event()
+
+    async def register_manifest_functions(self):
+        pass
+
+    async def start_all_kernels(self):
+        self.started.set()
+        await self.finish.wait()
+
+
+@pytest.mark.parametrize("wait_on_open", [False, True])
+def test_on_open(client, monkeypatch, wait_on_open):
+    cfg = configparser.ConfigParser()
+    cfg["NOTEBOOK"] = {"start_on_open": "1", "wait_on_open": str(int(wait_on_open))}
+    monkeypatch.setattr(client, "get_config", lambda: cfg)
+
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(client, "get_event_loop", lambda: loop)
+
+    km = _KernelManager()
+    monkeypatch.setattr(client.KernelManager, "_instance", km)
+    try:
+        on_open = threading.Thread(target=client.on_open, args=(None,))
+        on_open.start()
+        assert km.started.wait(10)
+
+        # on_open returns while the kernels are still starting, unless wait_on_open is set
+        on_open.join(0.5)
+        assert on_open.is_alive() == wait_on_open
+
+        loop.call_soon_threadsafe(km.finish.set)
+        on_open.join(10)
+        assert not on_open.is_alive()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(10)
+        loop.close()
@@ -0,0 +1,104 @@
+"""
+Checks re-attaching to kernels left running, using a real Jupyter server
+started for the test.
+"""
+import configparser
+import importlib
+import asyncio
+import json
+
+_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "total = 0",
+    "@xl_func\ndef add(a, b):\n    global total\n    total += 1\n    return a + b + total",
+]
+
+
+def _write_notebook(path, cells):
+    notebook = {
+        "cells": [{"cell_type": "code", "metadata": {}, "outputs": [], "execution_count": None, "source": c}
+                  for c in cells],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5
+    }
+    with open(path, "w") as f:
+        json.dump(notebook, f)
+
+
+def test_attach(client, start_kernel, notebook_server):
+    from pyxll_notebook.client.authenticators.simple import SimpleAuthenticator
+    xl_func = importlib.import_module("pyxll_notebook.client.xl_func")
+    url, token = notebook_server
+
+    async def run():
+        kernel = await start_kernel(_cells, handler=None)
+        assert await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30) == 4
+        await kernel.disconnect()
+        assert kernel.closed
+
+        # Attaching with the same session keeps the kernel's state
+        attached = client.Kernel(url, SimpleAuthenticator(auth_token=token), session_id=kernel.session_id)
+        try:
+            assert await attached.attach(kernel.id)
+            assert attached.id == kernel.id
+            await attached.restore_notebook("test.ipynb", kernel.notebook_last_modified("test.ipynb"))
+            assert [f["func"] for f in xl_func.get_bound_functions(attached)] == ["add"]
+            assert await asyncio.wait_for(attached.call_xl_func("add", (1, 2)), 30) == 5
+        finally:
+            await attached.shutdown()
+
+        # The kernel has been shutdown so can't be attached to
+        missing = client.Kernel(url, SimpleAuthenticator(auth_token=token))
+        assert not await missing.attach(kernel.id)
+
+    asyncio.run(run())
+
+
+def test_persistent_sessions(client, notebook_server, tmp_path):
+    url, token = notebook_server
+    _write_notebook(tmp_path / "test.ipynb", _cells)
+    cfg = configparser.ConfigParser()
+    cfg["NOTEBOOK"] = {
+        "url": url,
+        "auth_class": "SimpleAuthenticator",
+        "auth_token": token,
+        "notebooks": "test.ipynb",
+        "persistent_sessions": "1",
+        "event_loop_monitor_interval": "0",
+        "session_file": str(tmp_path / "sessions.json"),
+        "manifest_file": str(tmp_path / "manifest.json"),
+    }
+
+    async def run():
+        km = client.KernelManager(cfg)
+        await km.start_all_kernels()
+        kernel = await km.get_kernel("test.ipynb")
+        assert await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30) == 4
+        await km.close_all_kernels()
+
+        with open(tmp_path / "sessions.json") as f:
+            saved = json.load(f)["notebooks"]["test.ipynb"]["kernels"]
+        assert saved == [{"kernel_id": kernel.id, "session_id": kernel.session_id}]
+
+        # A new KernelManager (e.g. after restarting Excel) re-attaches to the running kernel
+        km = client.KernelManager(cfg)
+        try:
+            await km.start_all_kernels()
+            attached = await km.get_kernel("test.ipynb")
+            assert attached.id == kernel.id
+            assert await asyncio.wait_for(attached.call_xl_func("add", (1, 2)), 30) == 5
+        finally:
+            await km.stop_all_kernels()
+
+        # The kernel isn't re-attached to once it's been shutdown
+        km = client.KernelManager(cfg)
+        try:
+            await km.start_all_kernels()
+            new_kernel = await km.get_kernel("test.ipynb")
+            assert new_kernel.id != kernel.id
+            assert await asyncio.wait_for(new_kernel.call_xl_func("add", (1, 2)), 30) == 4
+        finally:
+            await km.stop_all_kernels()
+
+    asyncio.run(run())
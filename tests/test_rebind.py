@@ -0,0 +1,107 @@
+"""
+Checks functions are registered in batches, with Excel's functions only
+updated once per batch.
+"""
+import importlib
+import asyncio
+import pytest
+
+
+class _Kernel:
+    closed = False
+    standby = False
+    pool = None
+
+
+@pytest.fixture
+def rebinds(xl_funcs, monkeypatch):
+    """Count the calls to pyxll.rebind."""
+    import pyxll
+    calls = []
+    monkeypatch.setattr(pyxll, "rebind", lambda: calls.append(None))
+    return calls
+
+
+def test_batch_rebinds_once(client, xl_funcs, rebinds):
+    xl_funcs.clear()
+    kernel = _Kernel()
+    handler = client.Handler(kernel)
+    msg = {"content": {"funcs": [{"func": f"func{i}", "signature": "int x: int"} for i in range(3)]}}
+    asyncio.run(handler.on_xl_funcs(msg))
+    assert sorted(xl_funcs) == ["func0", "func1", "func2"]
+    assert len(rebinds) == 1
+
+    # Re-running the notebook with the same functions doesn't register them again
+    xl_funcs.clear()
+    asyncio.run(handler.on_xl_funcs(msg))
+    assert xl_funcs == {}
+    assert len(rebinds) == 1
+
+
+def test_single_registrations_debounced(client, xl_funcs, rebinds):
+    xl_funcs.clear()
+    kernel = _Kernel()
+    handler = client.Handler(kernel)
+
+    async def run():
+        for i in range(3):
+            await handler.on_xl_func({"content": {"func": f"func{i}"}})
+            await asyncio.sleep(0.01)
+        assert sorted(xl_funcs) == ["func0", "func1", "func2"]
+        assert rebinds == []
+
+        # Excel's functions are updated once no more functions have been registered for a short time
+        await asyncio.sleep(0.3)
+        assert len(rebinds) == 1
+
+    asyncio.run(run())
+
+
+def test_rebind_max_delay(client, rebinds, monkeypatch):
+    xl_func = importlib.import_module("pyxll_notebook.client.xl_func")
+    monkeypatch.setattr(xl_func, "_rebind_delay", 0.05)
+    monkeypatch.setattr(xl_func, "_rebind_max_delay", 0.2)
+    kernel = _Kernel()
+    handler = client.Handler(kernel)
+
+    async def run():
+        # Functions registered continually don't stop Excel's functions from being updated
+        for i in range(20):
+            await handler.on_xl_func({"content": {"func": f"func{i}"}})
+            await asyncio.sleep(0.02)
+        assert len(rebinds) >= 1
+
+        await asyncio.sleep(0.1)
+        count = len(rebinds)
+        await asyncio.sleep(0.1)
+        assert len(rebinds) == count
+
+    asyncio.run(run())
+
+
+class _Handler:
+    def __init__(self):
+        self.messages = []
+
+    async def on_xl_func(self, msg):
+        self.messages.append([msg["content"]["func"]])
+
+    async def on_xl_funcs(self, msg):
+        self.messages.append([f["func"] for f in msg["content"]["funcs"]])
+
+
+def test_registrations_sent_per_cell(start_kernel):
+    handler = _Handler()
+    cells = [
+        "from pyxll_notebook.server import xl_func",
+        "@xl_func\ndef a():\n    return 1\n\n@xl_func\ndef b():\n    return 2",
+        "x = 1",
+        "@xl_func\ndef c():\n    return 3",
+    ]
+
+    async def run():
+        kernel = await start_kernel(cells, handler=handler)
+        await kernel.shutdown()
+
+    asyncio.run(run())
+    assert handler.messages == [["a", "b"], ["c"]]
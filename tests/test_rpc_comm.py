@@ -0,0 +1,39 @@
+"""
+Checks the RPC comm used to call functions in the kernel, using a real
+Jupyter server started for the test.
+"""
+import asyncio
+import json
+import pytest
+
+
+def test_rpc_comm_opened_once_server_imported(client, start_kernel, tmp_path):
+    notebook = {
+        "cells": [{"cell_type": "code", "metadata": {}, "outputs": [], "execution_count": None,
+                   "source": "from pyxll_notebook.server import xl_func"}],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5
+    }
+    with open(tmp_path / "server.ipynb", "w") as f:
+        json.dump(notebook, f)
+
+    async def run():
+        kernel = await start_kernel(["x = 1"])
+        try:
+            # pyxll_notebook.server hasn't been imported, so the comm target doesn't exist
+            with pytest.raises(AssertionError):
+                await kernel.ping(use_rpc_comm=True)
+
+            # Running a notebook that imports it makes the comm available
+            await kernel.run_notebook("server.ipynb")
+            await kernel.ping(use_rpc_comm=True)
+            await kernel.ping(use_rpc_comm=False)
+
+            # Errors raised by RPC methods are raised in the client
+            with pytest.raises(client.ExecuteRequestError):
+                await kernel.call_xl_rtd_method("missing", "connect")
+        finally:
+            await kernel.shutdown()
+
+    asyncio.run(run())
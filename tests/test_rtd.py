@@ -0,0 +1,226 @@
+"""
+Checks RTD deltas computed in the kernel rebuild the new value on the client.
+"""
+import importlib
+import asyncio
+import pickle
+import time
+import pytest
+from pyxll_notebook.server.rtd import _diff, _shape, _copy, _RTDPublisher
+from pyxll_notebook.serialization import serialize_args, deserialize_args
+
+
+def test_diff_lists():
+    old = [[1.0, 2.0, 3.0, 4.0], [5.0, 6.0, 7.0, 8.0], [9.0, 10.0, 11.0, 12.0]]
+    new = _copy(old)
+    new[1][2] = 70.0
+    assert _diff(old, new, _shape(new)) == [(1, 2, 70.0)]
+    assert _diff(old, old, _shape(old)) == []
+
+
+def test_diff_whole_rows_and_snapshots():
+    old = [[1.0, 2.0, 3.0, 4.0] for i in range(4)]
+    new = _copy(old)
+    new[0] = [10.0, 20.0, 30.0, 4.0]
+    assert _diff(old, new, _shape(new)) == [(0, None, [10.0, 20.0, 30.0, 4.0])]
+
+    # Most cells changed, so a snapshot should be sent instead
+    new = [[x + 1 for x in row] for row in old]
+    assert _diff(old, new, _shape(new)) is None
+
+
+def test_diff_ignores_nan_in_lists():
+    nan = float("nan")
+    old = [[nan, 1.0], [2.0, 3.0]]
+    new = [[float("nan"), 1.0], [2.0, 4.0]]
+    assert _diff(old, new, _shape(new)) == [(1, 1, 4.0)]
+    assert _diff([nan, 1.0], [float("nan"), 2.0], (2,)) == [(1, None, 2.0)]
+
+
+def test_diff_ignores_nan_in_arrays():
+    numpy = pytest.importorskip("numpy")
+    old = numpy.array([[numpy.nan, 1.0], [2.0, 3.0]])
+    new = old.copy()
+    new[1, 1] = 4.0
+    assert _diff(old, new, new.shape) == [(1, 1, 4.0)]
+
+
+def test_diff_patch_round_trip(client):
+    from pyxll_notebook.client.rtd import _patch
+    old = [[float(i * 10 + j) for j in range(10)] for i in range(10)]
+    new = _copy(old)
+    new[3][4] = -1.0
+    new[7] = [0.0] * 10
+    changes = _diff(old, new, _shape(new))
+    assert _patch(old, changes) == new
+    assert old[3][4] == 34.0
+
+
+def test_diff_patch_round_trip_arrays(client):
+    numpy = pytest.importorskip("numpy")
+    from pyxll_notebook.client.rtd import _patch
+    old = numpy.arange(100, dtype=float).reshape(10, 10)
+    new = old.copy()
+    new[2, 5] = numpy.nan
+    new[9, 0] = -1.0
+    changes = _diff(old, new, new.shape)
+    patched = _patch(old, changes)
+    assert numpy.array_equal(patched, new, equal_nan=True)
+
+
+@pytest.fixture
+def messages(monkeypatch):
+    """Record the messages the RTD publisher sends to the client."""
+    from pyxll_notebook import serialization
+    from pyxll_notebook.server import rtd
+    monkeypatch.setattr(serialization, "_default_pickle_protocol", pickle.HIGHEST_PROTOCOL)
+    monkeypatch.setattr(rtd, "get_session", lambda: "session")
+    messages = []
+    monkeypatch.setattr(rtd, "send_message", lambda session, msg_type, content: messages.append((msg_type, content)))
+    return messages
+
+
+def _updates(message):
+    msg_type, content = message
+    assert msg_type == "xl_rtd_set_values"
+    return deserialize_args(content["updates"])
+
+
+def test_publish_without_batches(messages):
+    publisher = _RTDPublisher()
+    publisher.publish("a", "value", (1,))
+    publisher.publish("a", "value", (2,))
+    assert [m[0] for m in messages] == ["xl_rtd_set_value", "xl_rtd_set_value"]
+    assert deserialize_args(messages[1][1]["args"]) == (2,)
+
+
+def test_publish_batches_without_interval(messages):
+    publisher = _RTDPublisher()
+    publisher.batches = True
+    publisher.publish("a", "value", (1,))
+    publisher.publish("b", "error", (ValueError, "oops", None))
+    assert [_updates(m) for m in messages] == [[("a", "value", (1,))], [("b", "error", (ValueError, "oops", None))]]
+
+
+def test_publish_conflates_updates(messages):
+    publisher = _RTDPublisher()
+    publisher.batches = True
+    publisher.interval = 0.2
+    for i in range(100):
+        publisher.publish("a", "value", (i,))
+        publisher.publish("b", "value", (-i,))
+
+    for i in range(50):
+        if messages:
+            break
+        time.sleep(0.1)
+
+    # Only the latest value for each RTD instance is sent, in one message
+    assert len(messages) == 1
+    assert _updates(messages[0]) == [("a", "value", (99,)), ("b", "value", (-99,))]
+
+    publisher.publish("a", "value", (100,))
+    for i in range(50):
+        if len(messages) > 1:
+            break
+        time.sleep(0.1)
+    assert _updates(messages[1]) == [("a", "value", (100,))]
+
+
+def test_publish_deltas(messages):
+    publisher = _RTDPublisher()
+    publisher.batches = True
+    value = [[float(i * 10 + j) for j in range(10)] for i in range(10)]
+    publisher.publish("a", "value", (value,))
+
+    new_value = _copy(value)
+    new_value[1][2] = -1.0
+    publisher.publish("a", "value", (new_value,))
+
+    # The shape changed, so a snapshot is sent
+    publisher.publish("a", "value", ([1.0, 2.0],))
+
+    # Once forgotten (e.g. when the client asks for it) a snapshot is sent
+    publisher.send_snapshot("a", [1.0, 3.0])
+
+    assert [_updates(m) for m in messages] == [
+        [("a", "snapshot", (1, value))],
+        [("a", "delta", (2, 1, [(1, 2, -1.0)]))],
+        [("a", "snapshot", (3, [1.0, 2.0]))],
+        [("a", "snapshot", (1, [1.0, 3.0]))],
+    ]
+
+
+def test_publish_unserializable_value(messages):
+    publisher = _RTDPublisher()
+    publisher.batches = True
+    publisher.publish("a", "value", (lambda: None,))
+    (id, kind, args), = _updates(messages[0])
+    assert (id, kind) == ("a", "error")
+    assert issubclass(args[0], Exception)
+
+
+def test_set_rtd_interval(monkeypatch):
+    from pyxll_notebook.server import rtd
+    publisher = _RTDPublisher()
+    monkeypatch.setattr(rtd, "_publisher", publisher)
+    rtd.set_rtd_interval("0.5")
+    assert publisher.interval == 0.5
+    rtd.set_rtd_interval(None)
+    assert publisher.interval == 0
+
+
+def test_client_applies_batches(client, monkeypatch):
+    handler_module = importlib.import_module("pyxll_notebook.client.handler")
+    applied = []
+    for name in ("xl_rtd_set_value", "xl_rtd_set_snapshot", "xl_rtd_apply_delta", "xl_rtd_set_error"):
+        monkeypatch.setattr(handler_module, name, lambda id, *args, name=name: applied.append((name, id) + args))
+
+    updates = [
+        ("a", "value", (1,)),
+        ("b", "snapshot", (1, [1.0, 2.0])),
+        ("b", "delta", (2, 1, [(0, None, 3.0)])),
+        ("c", "error", (ValueError, "oops", None)),
+        ("d", "unknown", ()),
+    ]
+    msg = {"content": {"updates": serialize_args(updates, protocol=pickle.HIGHEST_PROTOCOL)}}
+    asyncio.run(client.Handler.on_xl_rtd_set_values(msg))
+    assert applied == [
+        ("xl_rtd_set_value", "a", 1),
+        ("xl_rtd_set_snapshot", "b", 1, [1.0, 2.0]),
+        ("xl_rtd_apply_delta", "b", 2, 1, [(0, None, 3.0)]),
+        ("xl_rtd_set_error", "c", ValueError, "oops", None),
+    ]
+
+
+class _Handler:
+    def __init__(self):
+        self.updates = []
+
+    async def on_xl_rtd_set_values(self, msg):
+        self.updates.append(deserialize_args(msg["content"]["updates"]))
+
+
+def test_kernel_conflates_updates(start_kernel):
+    handler = _Handler()
+    cells = [
+        "from pyxll_notebook.server import xl_func, RTD",
+        "rtd = RTD(0)",
+        "def tick():\n    for i in range(1000):\n        rtd.value = i",
+    ]
+
+    async def run():
+        kernel = await start_kernel(cells, handler=handler, rtd_interval=0.2)
+        try:
+            await kernel.execute("tick()")
+            for i in range(50):
+                if handler.updates and handler.updates[-1][-1][2] == (999,):
+                    break
+                await asyncio.sleep(0.1)
+        finally:
+            await kernel.shutdown()
+
+    # The client set the interval, so the updates are sent in a few batches rather than one message each
+    asyncio.run(run())
+    assert 0 < len(handler.updates) < 10
+    assert handler.updates[-1] == [(handler.updates[-1][0][0], "value", (999,))]
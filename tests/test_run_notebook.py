@@ -0,0 +1,45 @@
+"""
+Checks notebooks run the same way in each execution mode, using a real
+Jupyter server started for the test.
+"""
+import asyncio
+import pytest
+
+_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "total = 1",
+    "%%capture\ntotal += 1",
+    "@xl_func\ndef add(a, b):\n    return a + b + total",
+]
+
+
+class _Handler:
+    def __init__(self):
+        self.funcs = []
+
+    async def on_xl_funcs(self, msg):
+        self.funcs.extend(f["func"] for f in msg["content"]["funcs"])
+
+
+@pytest.mark.parametrize("execution_mode, chunk_size", [("cells", 0), ("single", 0), ("single", 3)])
+def test_run_notebook(start_kernel, execution_mode, chunk_size):
+    handler = _Handler()
+
+    async def run():
+        kernel = await start_kernel(_cells, handler=handler, execution_mode=execution_mode, chunk_size=chunk_size)
+        try:
+            return await asyncio.wait_for(kernel.call_xl_func("add", (1, 2)), 30)
+        finally:
+            await kernel.shutdown()
+
+    # Magics are run and the functions are registered once the notebook has run
+    assert asyncio.run(run()) == 5
+    assert handler.funcs == ["add"]
+
+
+def test_run_notebook_error(client, start_kernel):
+    async def run():
+        with pytest.raises(client.ExecuteRequestError, match="Error in cell 2 of test.ipynb"):
+            await start_kernel(["x = 1", "1 / 0", "y = 2"], execution_mode="single")
+
+    asyncio.run(run())
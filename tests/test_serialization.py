@@ -0,0 +1,287 @@
+"""
+Checks values are serialized and deserialized correctly between the client and server.
+"""
+from pyxll_notebook import serialization
+from pyxll_notebook.serialization import dumps, loads, array_types, pack_array, pack_args, pack_result
+import asyncio
+import pickle
+import array
+import sys
+import os
+import pytest
+
+
+@pytest.mark.parametrize("signature, expected", [
+    (None, ([], None)),
+    ("int x, float[][] y: float[]", ([None, "list"], "list")),
+    ("numpy_array<float> x, numpy_row y, numpy_column z: numpy_array<float, ndim=2>",
+     (["numpy", "numpy", "numpy"], "numpy")),
+    ("var x, dict<str, float[]> y: var", ([None, None], None)),
+    ("add(int[] a, str b): int[][]", (["list", None], "list")),
+    ("float[] x", (["list"], None)),
+])
+def test_array_types(signature, expected):
+    assert array_types(signature) == expected
+
+
+@pytest.mark.parametrize("protocol", [4, pickle.HIGHEST_PROTOCOL])
+def test_unpack_as_list(protocol):
+    # Lists are rebuilt from the raw bytes, which works without numpy
+    values = array.array("d", [1.5, 2.5, 3.5, 4.5, 5.5, 6.5])
+    dtype = ("<" if sys.byteorder == "little" else ">") + "f8"
+    packed = serialization.NumericArray(dtype, (2, 3), memoryview(values).cast("B"), as_list=True)
+    assert loads(dumps(packed, protocol=protocol)) == [[1.5, 2.5, 3.5], [4.5, 5.5, 6.5]]
+
+    packed = serialization.NumericArray(dtype, (6,), memoryview(values).cast("B"), as_list=True)
+    assert loads(dumps(packed, protocol=protocol)) == values.tolist()
+
+
+def test_unpack_big_endian():
+    values = array.array("i", [1, 2, 3])
+    values.byteswap()
+    dtype = (">" if sys.byteorder == "little" else "<") + "i%d" % values.itemsize
+    packed = serialization.NumericArray(dtype, (3,), memoryview(values).cast("B"), as_list=True)
+    assert loads(dumps(packed, protocol=4)) == [1, 2, 3]
+
+
+def test_unsupported_dtype():
+    with pytest.raises(TypeError):
+        serialization._get_array_typecode("<c16")
+
+
+@pytest.mark.parametrize("protocol", [4, pickle.HIGHEST_PROTOCOL])
+@pytest.mark.parametrize("dtype", ["float64", "float32", "int64", "int32", "uint8"])
+def test_pack_numpy_array(protocol, dtype):
+    numpy = pytest.importorskip("numpy")
+    value = numpy.arange(12, dtype=dtype).reshape(3, 4)
+
+    packed = pack_array(value)
+    assert isinstance(packed, serialization.NumericArray)
+    result = loads(dumps(packed, protocol=protocol))
+    assert isinstance(result, numpy.ndarray)
+    assert result.dtype == value.dtype
+    numpy.testing.assert_array_equal(result, value)
+
+    # Arrays for list types are unpacked as lists
+    result = loads(dumps(pack_array(value, as_list=True), protocol=protocol))
+    assert result == value.tolist()
+
+    # Non-contiguous arrays are copied
+    result = loads(dumps(pack_array(value.T), protocol=protocol))
+    numpy.testing.assert_array_equal(result, value.T)
+
+
+def test_values_not_packed():
+    numpy = pytest.importorskip("numpy")
+    values = [
+        [[1.0, 2.0], [3.0, 4.0]],
+        numpy.zeros((2, 2, 2)),
+        numpy.array(["a", "b"]),
+        numpy.array([1, None], dtype=object),
+        1.0,
+    ]
+    for value in values:
+        assert pack_array(value) is value
+
+
+def test_pack_args_and_result():
+    numpy = pytest.importorskip("numpy")
+    x = numpy.ones((2, 2))
+    y = numpy.ones(3)
+    arg_types, return_type = array_types("float[][] x, var y, numpy_array z: numpy_array")
+
+    packed = pack_args((x, y, x), arg_types)
+    assert packed[0].as_list
+    assert packed[1] is y
+    assert not packed[2].as_list
+
+    # Extra args (e.g. *args) aren't packed
+    packed = pack_args((x, y, x, x), arg_types)
+    assert packed[3] is x
+
+    args = (1, 2)
+    assert pack_args(args, [None, None]) is args
+    assert not pack_result(x, return_type).as_list
+    assert pack_result(x, None) is x
+
+
+_cells = [
+    "from pyxll_notebook.server import xl_func\nimport numpy",
+    "@xl_func('int rows, int columns: float[][]')\n"
+    "def ones(rows, columns):\n"
+    "    return numpy.ones((rows, columns))",
+    "@xl_func('int n: numpy_array<float>')\n"
+    "def arange(n):\n"
+    "    return numpy.arange(n, dtype=float)",
+    "@xl_func('numpy_array<float> x: float')\n"
+    "def total(x):\n"
+    "    return float(x.sum())",
+]
+
+
+def test_array_results(start_kernel):
+    numpy = pytest.importorskip("numpy")
+
+    async def run():
+        kernel = await start_kernel(_cells, handler=None)
+        try:
+            ones = await asyncio.wait_for(kernel.call_xl_func("ones", (2, 3)), 30)
+            arange = await asyncio.wait_for(kernel.call_xl_func("arange", (4,)), 30)
+            total = await asyncio.wait_for(kernel.call_xl_func("total", (pack_array(numpy.ones((3, 3))),)), 30)
+            return ones, arange, total
+        finally:
+            await kernel.shutdown()
+
+    ones, arange, total = asyncio.run(run())
+
+    # Arrays returned for float[][] are converted to lists without the client needing numpy
+    assert isinstance(ones, list)
+    assert ones == [[1.0, 1.0, 1.0], [1.0, 1.0, 1.0]]
+    numpy.testing.assert_array_equal(arange, numpy.arange(4, dtype=float))
+    assert total == 9.0
+
+
+def test_compression():
+    data = pickle.dumps("x" * 10000)
+    compressed = serialization.compress(data, threshold=1000)
+    assert compressed.startswith(serialization.COMPRESSED_PREFIX)
+    assert len(compressed) < len(data)
+    assert serialization.decompress(compressed) == data
+    assert serialization.decompress(memoryview(compressed)) == data
+
+    # Data no larger than the threshold isn't compressed
+    assert serialization.compress(data, threshold=len(data)) is data
+    assert serialization.compress(data, threshold=0) is data
+
+    # Data that doesn't get smaller isn't compressed
+    random = pickle.dumps(os.urandom(4096))
+    assert serialization.compress(random, threshold=100) is random
+
+    # Uncompressed data is returned unchanged
+    assert serialization.decompress(data) is data
+
+
+def test_set_compression(monkeypatch):
+    monkeypatch.setattr(serialization, "_compression_threshold", 0)
+    monkeypatch.setattr(serialization, "_compression_level", 6)
+    value = "x" * 10000
+    assert not dumps(value, protocol=4).startswith(serialization.COMPRESSED_PREFIX)
+
+    serialization.set_compression(1000, level=1)
+    data = dumps(value, protocol=4)
+    assert data.startswith(serialization.COMPRESSED_PREFIX)
+    assert loads(data) == value
+
+    # Compressed args and results are recognized whatever the compression threshold
+    encoded = serialization.serialize_args((value,), protocol=4)
+    serialization.set_compression(0)
+    assert serialization.deserialize_args(encoded) == (value,)
+    assert loads(data) == value
+
+
+def _counter(metrics, name, **labels):
+    labels = ", ".join(f"{k}={v}" for k, v in sorted(labels.items()))
+    return sum(row[2] for row in metrics.table()[1:] if row[0] == name and row[1] == labels)
+
+
+_echo_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "@xl_func\ndef echo(x):\n    return x",
+]
+
+
+@pytest.mark.parametrize("use_rpc_comm", [True, False])
+def test_compressed_calls(client, start_kernel, use_rpc_comm):
+    value = "x" * 100000
+
+    async def run():
+        kernel = await start_kernel(_echo_cells, use_rpc_comm=use_rpc_comm, compression_threshold=1024)
+        try:
+            assert await asyncio.wait_for(kernel.call_xl_func("echo", (value,)), 30) == value
+            assert await asyncio.wait_for(kernel.call_xl_func("echo", ("small",)), 30) == "small"
+        finally:
+            await kernel.shutdown()
+
+    asyncio.run(run())
+
+    # Only the large arguments and result were compressed
+    metrics = client.Metrics.instance()
+    assert _counter(metrics, "pyxll_notebook_compressed_batches_total", direction="sent") == 1
+    assert _counter(metrics, "pyxll_notebook_compressed_batches_total", direction="received") == 1
+
+
+def test_out_of_band_buffers():
+    numpy = pytest.importorskip("numpy")
+    value = {"x": numpy.arange(1000, dtype=float), "small": numpy.arange(10, dtype=float), "bytes": b"x" * 10000}
+
+    buffers = serialization.dumps_buffers(value, protocol=5, out_of_band_threshold=1000)
+    assert len(buffers) == 2
+    assert buffers[1].nbytes == value["x"].nbytes
+
+    # Arrays are views of the buffers, and are only writable if requested
+    result = serialization.loads_buffers([bytes(b) for b in buffers])
+    numpy.testing.assert_array_equal(result["x"], value["x"])
+    numpy.testing.assert_array_equal(result["small"], value["small"])
+    assert result["bytes"] == value["bytes"]
+    assert not result["x"].flags.writeable
+
+    result = serialization.loads_buffers([bytes(b) for b in buffers], writable=True)
+    assert result["x"].flags.writeable
+    result["x"][0] = 1
+    assert value["x"][0] == 0
+
+    # Packed arrays are sent out-of-band too
+    buffers = serialization.dumps_buffers(pack_array(numpy.ones((100, 100)), as_list=True),
+                                          protocol=5,
+                                          out_of_band_threshold=1000)
+    assert len(buffers) == 2
+    assert serialization.loads_buffers(buffers) == numpy.ones((100, 100)).tolist()
+
+
+def test_out_of_band_buffers_disabled():
+    numpy = pytest.importorskip("numpy")
+    value = numpy.arange(1000, dtype=float)
+    for protocol, threshold in [(4, 1000), (5, 0), (5, value.nbytes + 1)]:
+        buffers = serialization.dumps_buffers(value, protocol=protocol, out_of_band_threshold=threshold)
+        assert len(buffers) == 1
+        numpy.testing.assert_array_equal(serialization.loads_buffers(buffers), value)
+
+
+def test_out_of_band_buffers_compressed():
+    numpy = pytest.importorskip("numpy")
+    value = ["x" * 10000, numpy.zeros(1000)]
+    buffers = serialization.dumps_buffers(value, protocol=5, compression_threshold=1000, out_of_band_threshold=1000)
+
+    # Only the pickle stream is compressed
+    assert len(buffers) == 2
+    assert buffers[0].startswith(serialization.COMPRESSED_PREFIX)
+    assert buffers[1].nbytes == value[1].nbytes
+    result = serialization.loads_buffers(buffers)
+    assert result[0] == value[0]
+    numpy.testing.assert_array_equal(result[1], value[1])
+
+
+_array_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "@xl_func('numpy_array<float> x: numpy_array<float>')\ndef double(x):\n    return x * 2",
+]
+
+
+@pytest.mark.parametrize("use_rpc_comm", [True, False])
+def test_out_of_band_calls(client, start_kernel, use_rpc_comm):
+    numpy = pytest.importorskip("numpy")
+    value = numpy.arange(10000, dtype=float)
+
+    async def run():
+        kernel = await start_kernel(_array_cells, use_rpc_comm=use_rpc_comm, out_of_band_threshold=1024)
+        try:
+            return await asyncio.wait_for(kernel.call_xl_func("double", (pack_array(value),)), 30)
+        finally:
+            await kernel.shutdown()
+
+    numpy.testing.assert_array_equal(asyncio.run(run()), value * 2)
+
+    # The arrays are sent as binary message buffers rather than in the pickle stream
+    metrics = client.Metrics.instance()
+    for direction in ("sent", "received"):
+        assert _counter(metrics, "pyxll_notebook_out_of_band_bytes_total", direction=direction) == value.nbytes
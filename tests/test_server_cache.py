@@ -0,0 +1,167 @@
+"""
+Checks the result cache used in the kernel for functions registered with
+xl_func(server_cache=True).
+"""
+from pyxll_notebook.server import cache
+import importlib
+import asyncio
+import pickle
+import pytest
+
+
+class _Func:
+    """Function that counts how many times it's called."""
+
+    def __init__(self, result=None):
+        self.calls = 0
+        self.result = result
+
+    def __call__(self, *args):
+        self.calls += 1
+        return self.result if self.result is not None else list(args)
+
+
+def _size(value):
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def test_hits_and_misses():
+    c = cache.ResultCache()
+    func = _Func()
+    assert c.call("f", func, (1, 2)) == [1, 2]
+    assert c.call("f", func, (1, 2)) == [1, 2]
+    assert c.call("f", func, (2, 3)) == [2, 3]
+    assert c.call("g", func, (1, 2)) == [1, 2]
+    assert func.calls == 3
+
+    # Cached results are copies, so changing a result doesn't change the cache
+    c.call("f", func, (1, 2)).append(3)
+    assert c.call("f", func, (1, 2)) == [1, 2]
+
+    stats = c.stats()
+    assert stats["entries"] == 3
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (3, 3, 0)
+    assert stats["bytes"] == _size([1, 2]) + _size([2, 3]) + _size([1, 2])
+
+
+def test_unpicklable_values_not_cached():
+    c = cache.ResultCache()
+    func = _Func()
+    c.call("f", func, (lambda: None,))
+    c.call("f", func, (lambda: None,))
+    assert func.calls == 2
+
+    func = _Func(lambda: None)
+    c.call("f", func, ())
+    c.call("f", func, ())
+    assert func.calls == 2
+    assert c.stats()["entries"] == 0
+
+
+def test_lru_eviction():
+    size = _size([0])
+    c = cache.ResultCache(max_bytes=size * 2)
+    func = _Func()
+    c.call("f", func, (0,))
+    c.call("f", func, (1,))
+    c.call("f", func, (0,))
+
+    # 1 is the least recently used so is evicted first
+    c.call("f", func, (2,))
+    assert c.stats()["entries"] == 2
+    assert c.stats()["evictions"] == 1
+    assert c.stats()["bytes"] == size * 2
+
+    calls = func.calls
+    c.call("f", func, (0,))
+    c.call("f", func, (2,))
+    assert func.calls == calls
+    c.call("f", func, (1,))
+    assert func.calls == calls + 1
+
+    # Results larger than the cache aren't cached
+    big = _Func(result="x" * size * 3)
+    c.call("big", big, ())
+    c.call("big", big, ())
+    assert big.calls == 2
+    assert c.stats()["entries"] == 2
+
+    # Making the cache smaller evicts entries
+    c.resize(size)
+    assert c.stats()["entries"] == 1
+    assert c.stats()["bytes"] == size
+
+
+def test_invalidate():
+    c = cache.ResultCache()
+    func = _Func()
+    c.call("f", func, (1,), tags=("prices",))
+    c.call("f", func, (2,), tags=("prices", "rates"))
+    c.call("g", func, (1,), tags=("rates",))
+    c.call("h", func, (1,))
+
+    c.invalidate(func_name="f", tag="rates")
+    assert c.stats()["entries"] == 3
+
+    c.invalidate(tag="prices")
+    assert c.stats()["entries"] == 2
+
+    c.invalidate(func_name="g")
+    assert c.stats()["entries"] == 1
+    assert c.stats()["bytes"] == _size([1])
+
+    c.invalidate()
+    assert (c.stats()["entries"], c.stats()["bytes"]) == (0, 0)
+
+
+def test_invalidate_cache_by_function(monkeypatch):
+    server_xl_func = importlib.import_module("pyxll_notebook.server.xl_func")
+    c = cache.ResultCache()
+    monkeypatch.setattr(cache, "_cache", c)
+
+    def price(x):
+        return x
+
+    monkeypatch.setitem(server_xl_func._registered_xl_funcs, "PRICE", price)
+    c.call("PRICE", price, (1,))
+    c.call("other", price, (1,))
+
+    # Functions are found by the name they're registered in Excel with
+    cache.invalidate_cache(price)
+    assert c.stats()["entries"] == 1
+    cache.invalidate_cache("other")
+    assert cache.cache_stats()["entries"] == 0
+
+    cache.set_cache_size(100)
+    assert cache.cache_stats()["max_bytes"] == 100
+
+
+_cells = [
+    "from pyxll_notebook.server import xl_func, invalidate_cache",
+    "calls = 0",
+    "@xl_func(server_cache=True, cache_tags=['prices'])\n"
+    "def price(x):\n"
+    "    global calls\n"
+    "    calls += 1\n"
+    "    return calls",
+]
+
+
+@pytest.mark.parametrize("use_rpc_comm", [True, False])
+def test_server_cache(start_kernel, use_rpc_comm):
+    async def run():
+        kernel = await start_kernel(_cells, use_rpc_comm=use_rpc_comm)
+        try:
+            assert await asyncio.wait_for(kernel.call_xl_func("price", (1,)), 30) == 1
+            assert await asyncio.wait_for(kernel.call_xl_func("price", (1,)), 30) == 1
+            assert await asyncio.wait_for(kernel.call_xl_func("price", (2,)), 30) == 2
+
+            stats = await asyncio.wait_for(kernel.get_server_cache_stats(), 30)
+            assert (stats["entries"], stats["hits"], stats["misses"]) == (2, 1, 2)
+
+            await kernel.execute("invalidate_cache(tag='prices')")
+            assert await asyncio.wait_for(kernel.call_xl_func("price", (1,)), 30) == 3
+        finally:
+            await kernel.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,112 @@
+"""
+Checks restarting kernels uses warm standby kernels, using a real Jupyter
+server started for the test.
+"""
+import configparser
+import importlib
+import asyncio
+import json
+
+_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "@xl_func\ndef add(a, b):\n    return a + b",
+]
+
+
+def _write_notebook(path, cells):
+    notebook = {
+        "cells": [{"cell_type": "code", "metadata": {}, "outputs": [], "execution_count": None, "source": c}
+                  for c in cells],
+        "metadata": {},
+        "nbformat": 4,
+        "nbformat_minor": 5
+    }
+    with open(path, "w") as f:
+        json.dump(notebook, f)
+
+
+def _config(notebook_server, tmp_path):
+    url, token = notebook_server
+    cfg = configparser.ConfigParser()
+    cfg["NOTEBOOK"] = {
+        "url": url,
+        "auth_class": "SimpleAuthenticator",
+        "auth_token": token,
+        "notebooks": "test.ipynb",
+        "warm_standby": "1",
+        "event_loop_monitor_interval": "0",
+        "session_file": str(tmp_path / "sessions.json"),
+        "manifest_file": str(tmp_path / "manifest.json"),
+    }
+    return cfg
+
+
+def test_restart_uses_standby_kernel(client, notebook_server, tmp_path):
+    xl_func = importlib.import_module("pyxll_notebook.client.xl_func")
+    _write_notebook(tmp_path / "test.ipynb", _cells)
+
+    async def run():
+        km = client.KernelManager(_config(notebook_server, tmp_path))
+        try:
+            await km.start_all_kernels()
+            kernel = await km.get_kernel("test.ipynb")
+            assert [f["func"] for f in xl_func.get_bound_functions(kernel)] == ["add"]
+
+            # The standby kernel runs the notebook without replacing the running kernel's functions
+            tasks = km._KernelManager__standby_kernels["test.ipynb"]
+            assert len(tasks) == 1
+            standby = await asyncio.wait_for(tasks[0], 60)
+            assert standby.standby
+            assert xl_func.get_bound_functions(standby) == []
+            assert [f["func"] for f in xl_func.get_bound_functions(kernel)] == ["add"]
+
+            # Restarting switches to the standby kernel and starts a new standby kernel
+            await km.start_all_kernels()
+            assert await km.get_kernel("test.ipynb") is standby
+            assert not standby.standby
+            assert [f["func"] for f in xl_func.get_bound_functions(standby)] == ["add"]
+            assert await asyncio.wait_for(standby.call_xl_func("add", (1, 2)), 30) == 3
+            assert len(tasks) == 1
+            new_standby = await asyncio.wait_for(tasks[0], 60)
+            assert new_standby is not standby and new_standby.standby
+
+            # The old kernel is shutdown in the background
+            for i in range(100):
+                if kernel.closed:
+                    break
+                await asyncio.sleep(0.1)
+            assert kernel.closed
+        finally:
+            await km.stop_all_kernels()
+
+    asyncio.run(run())
+
+
+def test_standby_kernel_not_used_after_notebook_changes(client, notebook_server, tmp_path):
+    xl_func = importlib.import_module("pyxll_notebook.client.xl_func")
+    _write_notebook(tmp_path / "test.ipynb", _cells)
+
+    async def run():
+        km = client.KernelManager(_config(notebook_server, tmp_path))
+        try:
+            await km.start_all_kernels()
+            tasks = km._KernelManager__standby_kernels["test.ipynb"]
+            standby = await asyncio.wait_for(tasks[0], 60)
+
+            # The standby kernel ran the old version of the notebook, so a new kernel is started
+            _write_notebook(tmp_path / "test.ipynb", _cells + ["@xl_func\ndef sub(a, b):\n    return a - b"])
+            await km.start_all_kernels()
+            kernel = await km.get_kernel("test.ipynb")
+            assert kernel is not standby
+            assert sorted(f["func"] for f in xl_func.get_bound_functions(kernel)) == ["add", "sub"]
+            assert await asyncio.wait_for(kernel.call_xl_func("sub", (3, 2)), 30) == 1
+
+            for i in range(100):
+                if standby.closed:
+                    break
+                await asyncio.sleep(0.1)
+            assert standby.closed
+        finally:
+            await km.stop_all_kernels()
+
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+"""
+Checks the binary websocket message format matches the notebook server's.
+"""
+import importlib
+import pytest
+
+_msg = {
+    "channel": "shell",
+    "header": {"msg_id": "1", "msg_type": "execute_request"},
+    "parent_header": {},
+    "metadata": {},
+    "content": {"code": ""},
+}
+
+
+@pytest.fixture
+def wire(client):
+    return importlib.import_module("pyxll_notebook.client.wire")
+
+
+def test_round_trip(wire):
+    buffers = [b"abc", memoryview(b"\x00" * 10), b""]
+    msg = wire.deserialize_binary_message(wire.serialize_binary_message(dict(_msg, buffers=buffers)))
+    assert [bytes(b) for b in msg.pop("buffers")] == [b"abc", b"\x00" * 10, b""]
+    assert msg == _msg
+
+
+def test_round_trip_without_buffers(wire):
+    msg = wire.deserialize_binary_message(wire.serialize_binary_message(_msg), loads=wire.get_json_loads("json"))
+    assert msg.pop("buffers") == []
+    assert msg == _msg
+
+
+def test_notebook_server_format(wire):
+    server = pytest.importorskip("jupyter_server.services.kernels.connection.base")
+
+    # Sent by the client and read by the server
+    msg = server.deserialize_binary_message(wire.serialize_binary_message(dict(_msg, buffers=[b"abc"])))
+    assert [bytes(b) for b in msg.pop("buffers")] == [b"abc"]
+    assert msg == _msg
+
+    # Sent by the server and read by the client
+    msg = wire.deserialize_binary_message(server.serialize_binary_message(dict(_msg, buffers=[b"abc"])))
+    assert [bytes(b) for b in msg.pop("buffers")] == [b"abc"]
+    assert msg == _msg
+
+
+def test_unknown_json_backend(wire):
+    with pytest.raises(AssertionError):
+        wire.get_json_loads("yaml")
@@ -0,0 +1,67 @@
+"""
+Checks xl_func calls are sent in batches, and that one failing call
+doesn't fail the rest of its batch.
+"""
+from pyxll_notebook.serialization import dumps, loads
+import importlib
+import asyncio
+import pickle
+import pytest
+
+# pyxll_notebook.server.xl_func is the decorator, so get the module itself
+server_xl_func = importlib.import_module("pyxll_notebook.server.xl_func")
+
+_cells = [
+    "from pyxll_notebook.server import xl_func",
+    "@xl_func\ndef add(a, b):\n    return a + b",
+    "@xl_func\ndef fail(message):\n    raise ValueError(message)",
+]
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+def test_batch_results(monkeypatch):
+    monkeypatch.setitem(server_xl_func._registered_xl_funcs, "add", lambda a, b: a + b)
+    monkeypatch.setitem(server_xl_func._registered_xl_funcs, "fail", _fail)
+    monkeypatch.setitem(server_xl_func._registered_xl_funcs, "unpicklable", lambda: lambda: None)
+
+    calls = [("add", (1, 2)), ("fail", ("oops",)), ("unpicklable", ()), ("add", (3, 4))]
+    results = server_xl_func._run_xl_func_batch(calls)
+    data = server_xl_func._serialize_results(results, dumps, pickle.HIGHEST_PROTOCOL)
+    results = loads(data)
+
+    assert [r[0] for r in results] == ["ok", "error", "error", "ok"]
+    assert results[0][1] == 3
+    assert results[1][1]["ename"] == "ValueError"
+    assert results[1][1]["evalue"] == "oops"
+    assert results[3][1] == 7
+
+    # Each result includes the time taken to run the function
+    assert all(len(r) == 3 and r[2] >= 0 for r in results)
+
+
+@pytest.mark.parametrize("use_rpc_comm", [True, False])
+def test_concurrent_calls_batched(client, start_kernel, use_rpc_comm):
+    metrics = importlib.import_module("pyxll_notebook.client.metrics").Metrics.instance()
+
+    async def run():
+        kernel = await start_kernel(_cells, batch_window=0.05, use_rpc_comm=use_rpc_comm)
+        try:
+            metrics.reset()
+            return await asyncio.wait_for(asyncio.gather(kernel.call_xl_func("add", (1, 2)),
+                                                         kernel.call_xl_func("fail", ("oops",)),
+                                                         kernel.call_xl_func("add", (3, 4)),
+                                                         return_exceptions=True), 30)
+        finally:
+            await kernel.shutdown()
+
+    first, error, second = asyncio.run(run())
+    assert first == 3
+    assert second == 7
+    assert isinstance(error, client.ExecuteRequestError)
+    assert "oops" in str(error)
+
+    batch_sizes = [r for r in metrics.table() if r[0] == "pyxll_notebook_batch_size"]
+    assert [(r[2], r[3]) for r in batch_sizes] == [(1, 3)]